@@ -85,6 +85,7 @@ const ops = {
   "SHR":  { type: 2, code: '10101101' },
   "ST":   { type: 2, code: '10000100' },
   "SUB":  { type: 2, code: '10100001' },
+  "TAS":  { type: 2, code: '10000101' },
   "XOR":  { type: 2, code: '10101011' },
 };
 
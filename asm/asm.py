@@ -14,61 +14,57 @@
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
 
-import sys
+import heapq
+import os
 import re
+import sys
+
+# The instruction set lives in ls8/opcodes.py, shared with the emulator
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "ls8"))
+
+import opcodes
+from program import Program
 
 # Opcodes
+#
+# type is the operands the assembler expects: 0, 1 or 2 registers, or 8 for
+# a register and an immediate value (LDI)
 OPCODES = {
-    "ADD":  {"type": 2, "code": "10100000"},
-    "AND":  {"type": 2, "code": "10101000"},
-    "CALL": {"type": 1, "code": "01010000"},
-    "CMP":  {"type": 2, "code": "10100111"},
-    "DEC":  {"type": 1, "code": "01100110"},
-    "DIV":  {"type": 2, "code": "10100011"},
-    "HLT":  {"type": 0, "code": "00000001"},
-    "INC":  {"type": 1, "code": "01100101"},
-    "INT":  {"type": 1, "code": "01010010"},
-    "IRET": {"type": 0, "code": "00010011"},
-    "JEQ":  {"type": 1, "code": "01010101"},
-    "JGE":  {"type": 1, "code": "01011010"},
-    "JGT":  {"type": 1, "code": "01010111"},
-    "JLE":  {"type": 1, "code": "01011001"},
-    "JLT":  {"type": 1, "code": "01011000"},
-    "JMP":  {"type": 1, "code": "01010100"},
-    "JNE":  {"type": 1, "code": "01010110"},
-    "LD":   {"type": 2, "code": "10000011"},
-    "LDI":  {"type": 8, "code": "10000010"},
-    "MOD":  {"type": 2, "code": "10100100"},
-    "MUL":  {"type": 2, "code": "10100010"},
-    "NOP":  {"type": 0, "code": "00000000"},
-    "NOT":  {"type": 1, "code": "01101001"},
-    "OR":   {"type": 2, "code": "10101010"},
-    "POP":  {"type": 1, "code": "01000110"},
-    "PRA":  {"type": 1, "code": "01001000"},
-    "PRN":  {"type": 1, "code": "01000111"},
-    "PUSH": {"type": 1, "code": "01000101"},
-    "RET":  {"type": 0, "code": "00010001"},
-    "SHL":  {"type": 2, "code": "10101100"},
-    "SHR":  {"type": 2, "code": "10101101"},
-    "ST":   {"type": 2, "code": "10000100"},
-    "SUB":  {"type": 2, "code": "10100001"},
-    "XOR":  {"type": 2, "code": "10101011"},
+    name: {
+        "type": 8 if code in opcodes.IMMEDIATE else opcodes.operand_count(code),
+        "code": "{:08b}".format(code),
+        "byte": code,
+    }
+    for name, code in opcodes.OPCODES.items()
 }
 
 # Regex for matching lines
 # Capturing groups: label, opcode, operandA, operandB
-REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
+REGEX = re.compile(r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?")
 
 # Regex for capturing DS and DB data
-REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
-REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+REGEX_DS = re.compile(r"(?:(\w+?):)?\s*DS\s*(.+)", re.IGNORECASE)
+REGEX_DB = re.compile(r"(?:(\w+?):)?\s*DB\s*(.+)", re.IGNORECASE)
+
+# Register operands: R0-R7
+REGISTERS = {f"R{n}": n for n in range(8)}
+
+# .ls8 text lines for bytes without a comment
+BYTE_LINES = ["{:08b}\n".format(v) for v in range(256)]
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-O] [inputfile] [outputfile]
+
+    An outputfile ending in .ls8b gets a binary program image instead of
+    .ls8 text. -O runs the peephole optimizer, see peephole.py.
     """
 
+    optimize = "-O" in argv[1:]
+    argv = [arg for arg in argv if arg != "-O"]
+
     if len(argv) == 1:
         inputfile = "-"
         outputfile = "-"
@@ -82,10 +78,11 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [-O] [infile.asm] [outfile.ls8|outfile.ls8b]",
+              file=sys.stderr)
         sys.exit(1)
 
-    return inputfile, outputfile
+    return inputfile, outputfile, optimize
 
 
 def open_files(inputfile, outputfile):
@@ -101,302 +98,309 @@ def open_files(inputfile, outputfile):
 
     if outputfile == "-":
         outputfile = sys.stdout
+    elif outputfile.endswith(".ls8b"):
+        outputfile = open(outputfile, "wb")
     else:
         outputfile = open(outputfile, "w")
 
     return inputfile, outputfile
 
 
-def normalize_line(groups):
-    """
-    Takes match groups and uppercases them if they're not None.
-    """
-
-    result = []
-
-    for g in groups:
-        if g is None:
-            result.append(None)
-        else:
-            result.append(g.upper())
+class AssemblerError(Exception):
+    """A problem with the source; status is the exit status asm.py uses."""
 
-    return result
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
 
 
-def p8(v):
-    return "{:08b}".format(v)
+def error(message, status):
+    raise AssemblerError(message, status)
 
 
-def pass1(inputfile, sym, code):
+class Assembly:
     """
-    Pass 1
-
-    * Read the source code lines
-    * Parse labels, opcodes, and operands
-    * Record label offsets
-    * Emit machine code
+    The output of the assembler: machine code, the symbol table, and, for
+    .ls8 text output, the comments that go with the code.
     """
 
-    # Source line number
-    line_num = 0
-
-    # Current code address (for labels)
-    addr = 0
-
-    def get_reg(op, fatal=True):
-        """Get a register number from a string, e.g. "R2" -> 2"""
-
-        nonlocal line_num
-
-        m = re.match(r"R([0-7])", op)
-
-        if m is None:
-            if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
+    def __init__(self, annotate=True):
+        self.code = bytearray()
+        self.sym = {}
+        # (address, symbol) for every operand that refers to a label, filled
+        # in by resolve() once all the labels are known
+        self.fixups = []
+        # address of every DS and DB line; the rest of the lines are code
+        self.data = []
+        # for .ls8 text output, (address, comment) for every byte with a
+        # comment and (address, label) for every label, in address order
+        self.annotate = annotate
+        self.comments = []
+        self.labels = []
+        # address -> source line number, for every instruction and data byte
+        # that starts a line
+        self.source_map = {}
+
+    def resolve(self):
+        """Backpatch every label reference."""
+        code = self.code
+        sym = self.sym
+
+        for address, s in self.fixups:
+            if s not in sym:
+                error(f"unknown symbol: {s}", 2)
+            # addresses past 255 wrap round, as the PC does
+            code[address] = sym[s] & 0xff
+
+    def text(self):
+        """The .ls8 text output."""
+        code = self.code
+        out = []
+        # the next byte to write out
+        position = 0
+
+        # labels go before the byte at their address
+        events = heapq.merge(
+            ((address, 0, label) for address, label in self.labels),
+            ((address, 1, comment) for address, comment in self.comments))
+
+        for address, is_comment, text in events:
+            out.extend(BYTE_LINES[v] for v in code[position:address])
+            position = max(position, address)
+            if is_comment:
+                out.append("{:08b} # {}\n".format(code[address], text))
+                position = address + 1
             else:
-                return None
-
-        return int(m.group(1))
-
-    def out0(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with zero operands"""
-
-        nonlocal addr
-
-        code.append(f"{machine_code} # {opcode}")
-        addr += 1
+                out.append(f"# {text} (address {address}):\n")
 
-    def out1(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with one operand"""
+        out.extend(BYTE_LINES[v] for v in code[position:])
+        return "".join(out)
 
-        nonlocal addr
-
-        reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
-        addr += 2
+    def program(self, source=None):
+        """
+        The code as a Program, with the labels as its symbol table and the
+        source map. source names the file the code came from. The code has
+        to fit in RAM, which .ls8 text output doesn't need.
+        """
+        if len(self.code) > 256:
+            error(f"program is {len(self.code)} bytes, RAM only holds 256", 2)
+        for label, address in self.sym.items():
+            if address > 0xff:
+                error(f"label {label} is at address {address}, past the end of RAM", 2)
+        return Program(self.code, symbols=self.sym,
+                       source_map=self.source_map, source=source)
 
-    def out2(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with two operands"""
 
-        nonlocal addr
+def assemble_lines(lines, annotate=True):
+    """
+    Assemble source lines (any iterable, such as an open file) in a single
+    pass, emitting machine code as it goes and backpatching label references
+    at the end. Returns an Assembly. annotate=False skips the comments only
+    .ls8 text output needs.
+    """
 
-        reg_a = get_reg(op_a)
-        reg_b = get_reg(op_b)
+    assembly = Assembly(annotate)
+    code = assembly.code
+    sym = assembly.sym
+    fixups = assembly.fixups
+    comments = assembly.comments
+    labels = assembly.labels
+    source_map = assembly.source_map
+    data_lines = assembly.data
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
+    match_line = REGEX.match
+    registers = REGISTERS
+    opcodes_by_name = OPCODES
 
-        addr += 3
+    line_num = 0
 
-    def out8(opcode, op_a, op_b, machine_code):
-        """Handle LDI opcode (type 8)"""
+    def get_reg(op):
+        """Get a register number from a string, e.g. "R2" -> 2"""
 
-        nonlocal addr
+        reg = registers.get(op[:2])
+        if reg is None:
+            error(f"Line {line_num}: unknown register {op}", 1)
+        return reg
 
-        reg_a = get_reg(op_a)
+    def check_ops_count(opcode, desired, found):
+        # Makes sure we have right operand count
+        if found < desired:
+            error(f"Line {line_num}: missing operand to {opcode}", 1)
+        elif found > desired:
+            error(f"Line {line_num}: unexpected operand to {opcode}", 1)
 
+    def value_or_symbol(value):
+        """A number, or a label to fill in later (None is returned)."""
         try:
-            val_b = int(op_b, 0)
-            out_b = p8(val_b)
-
+            return int(value, 0) & 0xff
         except ValueError:
             # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
+            fixups.append((len(code), value.upper()))
+            return None
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
-
-        addr += 3
+    for line in lines:
+        line_num += 1
 
-    def handle_ds(line):
-        """
-        Handle DS pseudo-opcode
-        """
+        # Strip comments
+        comment_index = line.find(';')
+        if comment_index != -1:
+            line = line[:comment_index]
 
-        nonlocal addr
+        # Normalize
+        line = line.strip()
 
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+        # Ignore blank lines
+        if line == '':
+            continue
 
-        if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
-            sys.exit(2)
+        m = match_line(line)
 
-        data = m.group(2)
+        if m is None:
+            error(f"No match: {line}", 3)
 
-        for i in range(len(data)):
-            print_char = data[i]
+        label, opcode, op_a, op_b = m.groups()
 
-            if print_char == ' ':
-                print_char = '[space]'
+        # Track label address
+        if label is not None:
+            label = label.upper()
+            sym[label] = len(code)
+            if annotate:
+                labels.append((len(code), label))
 
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
+        if opcode is None:
+            continue
 
-        addr += len(data)
+        opcode = opcode.upper()
+        source_map[len(code)] = line_num
 
-    def handle_db(line):
-        """
-        Handle the DB pseudo-opcode
-        """
+        if opcode == 'DS':
+            m = REGEX_DS.match(line)
 
-        nonlocal addr
+            if m is None or m.group(2) is None:
+                error(f"line {line_num}: missing argument to DS", 2)
 
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+            data = m.group(2)
+            data_lines.append(len(code))
 
-        if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
-            sys.exit(2)
+            if annotate:
+                comments.extend(
+                    (i, '[space]' if ch == ' ' else ch)
+                    for i, ch in enumerate(data, len(code)))
 
-        data = m.group(2)
+            code.extend(ord(ch) & 0xff for ch in data)
+            continue
 
-        try:
-            val = int(data, 0)
+        if opcode == 'DB':
+            m = REGEX_DB.match(line)
 
-        except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
-                  file=sys.stderr)
-            sys.exit(2)
+            if m is None or m.group(2) is None:
+                error(f"line {line}: missing argument to DB", 2)
 
-        # Force to byte size
-        val &= 0xff
+            data = m.group(2)
+            data_lines.append(len(code))
 
-        code.append(f"{p8(val)} # {data}")
+            try:
+                val = int(data, 0)
 
-        addr += 1
+            except ValueError:
+                # a label, to put its address here
+                if not re.fullmatch(r"\w+", data.strip()):
+                    error(f"line {line_num}: invalid integer argument to DB", 2)
+                val = value_or_symbol(data.strip())
 
-    def check_ops(opcode, op_a, op_b):
-        """Check operands for sanity with a particular opcode"""
+            if annotate:
+                comments.append((len(code), data))
 
-        def check_ops_count(desired, found):
-            # Makes sure we have right operand count
-            if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
-            elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+            # Force to byte size
+            code.append((val or 0) & 0xff)
+            continue
 
         # Make sure we know this opcode at all
-        if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
-
-        op_type = OPCODES[opcode]["type"]
-
-        total_operands = 0
+        op_info = opcodes_by_name.get(opcode)
+        if op_info is None:
+            error(f"line {line_num}: unknown opcode {opcode}", 2)
+
+        op_type = op_info["type"]
+        total_operands = (op_a is not None) + (op_b is not None)
+        check_ops_count(opcode, 2 if op_type == 8 else op_type, total_operands)
+
+        if annotate:
+            if op_type == 0:
+                comments.append((len(code), opcode))
+            elif op_type == 1:
+                comments.append((len(code), f"{opcode} {op_a.upper()}"))
+            else:
+                comments.append((len(code), f"{opcode} {op_a.upper()},{op_b.upper()}"))
 
-        if op_a is not None:
-            total_operands += 1
+        code.append(op_info["byte"])
 
-        if op_b is not None:
-            total_operands += 1
+        if op_type == 0:
+            continue
 
-        if op_type == 0 or op_type == 1 or op_type == 2:
-            # 0, 1, or 2 register operands
-            check_ops_count(op_type, total_operands)
+        code.append(get_reg(op_a.upper()))
 
+        if op_type == 2:
+            code.append(get_reg(op_b.upper()))
         elif op_type == 8:
             # LDI r,i or LDI r,label
-            check_ops_count(2, total_operands)
-
-    # Type to function mapping
-    type_f = {
-        0: out0,
-        1: out1,
-        2: out2,
-        8: out8,
-    }
-
-    for line in inputfile:
-        line_num += 1
-
-        # Strip comments
-        comment_index = line.find(';')
-        if comment_index != -1:
-            line = line[:comment_index]
-
-        # Normalize
-        line = line.strip()
-
-        # Ignore blank lines
-        if input == '':
-            continue
-
-        # print(line)  # debug
-
-        m = re.match(REGEX, line)
-
-        if m is not None:
-            label, opcode, op_a, op_b = normalize_line(m.groups())
+            val = value_or_symbol(op_b)
+            code.append(0 if val is None else val)
 
-            # print(label, opcode, op_a, op_b)  # debug
+    assembly.resolve()
+    return assembly
 
-            # Track label address
-            if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
 
-            if opcode is not None:
-                if opcode == 'DS':
-                    handle_ds(line)
-                elif opcode == 'DB':
-                    handle_db(line)
-                else:
-                    # Check operand count
-                    check_ops(opcode, op_a, op_b)
-
-                    # Handle opcodes
-                    op_info = OPCODES[opcode]
-                    handler = type_f[op_info["type"]]
-                    handler(opcode, op_a, op_b, op_info["code"])
-        else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
-
-
-def pass2(outputfile, sym, code):
+def run_optimizer(assembly, report=None):
     """
-    Output the code, substituting in any symbols.
+    Run the peephole optimizer over an Assembly and return the optimized
+    one. A summary of what it did is printed to report, if given.
     """
+    import peephole
 
-    for c in code:
-        # Replace symbols
-        if c[:4] == 'sym:':
-            s = c[4:].strip()
-
-            if s in sym:
-                c = p8(sym[s])
+    assembly, stats = peephole.optimize(assembly)
+    if report is not None:
+        rules = ", ".join(f"{rule} {n}" for rule, n in stats["rules"].items())
+        print(f"optimizer: removed {stats['before'] - stats['after']} of "
+              f"{stats['before']} instructions" + (f" ({rules})" if rules else ""),
+              file=report)
+    return assembly
 
-            else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
 
-        outputfile.write(f"{c}\n")
+def assemble(source, name=None, optimize=False):
+    """
+    Assemble source, a string or an iterable of lines, straight to a Program
+    that CPU.load_program() can run, with no .ls8 text in between. name is
+    the file the source came from, for the source map; optimize runs the
+    peephole optimizer. Raises AssemblerError if the source is bad.
+    """
+    if isinstance(source, str):
+        source = source.splitlines()
+    assembly = assemble_lines(source, annotate=False)
+    if optimize:
+        assembly = run_optimizer(assembly)
+    return assembly.program(name)
 
 
 def main(argv):
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
+    inputfile, outputfile, optimize = parse_commandline(argv)
 
     # Open files
     inputfile, outputfile = open_files(inputfile, outputfile)
 
-    # Set up the symbol table
-    sym = {}
-
-    # Set up the machine code output
-    code = []
-
     # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    try:
+        binary = "b" in getattr(outputfile, "mode", "")
+        assembly = assemble_lines(inputfile, annotate=not binary)
+        if optimize:
+            assembly = run_optimizer(assembly, report=sys.stderr)
+        if binary:
+            outputfile.write(assembly.program().to_bytes())
+        else:
+            outputfile.write(assembly.text())
+    except AssemblerError as e:
+        print(e, file=sys.stderr)
+        return e.status
 
     return 0
 
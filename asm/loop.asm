@@ -0,0 +1,27 @@
+; loop.asm
+;
+; Long-running nested counting loop. Handy for timing the emulator.
+;
+; Expected output:
+; 250
+
+    LDI R0,0             ; Outer counter
+    LDI R2,250           ; Loop limit
+    LDI R3,1             ; Increment
+
+Outer:
+    LDI R1,0             ; Reset inner counter
+
+Inner:
+    ADD R1,R3
+    LDI R4,Inner
+    CMP R1,R2
+    JNE R4               ; Loop until R1 == 250
+
+    ADD R0,R3
+    LDI R4,Outer
+    CMP R0,R2
+    JNE R4               ; Loop until R0 == 250
+
+    PRN R0
+    HLT
@@ -0,0 +1,91 @@
+; multicore.ls8
+;
+; Run with ls8/multicore.py. Every core adds 1 to a shared counter 50 times,
+; holding a spinlock around each add. The last core to finish interrupts
+; core 0 through the inter-core register (F5), and core 0 prints the total.
+;
+; Each core starts with its number in R0 and the number of cores in R1. It
+; needs 10 bytes of stack, so up to 6 cores fit with the default 16 bytes
+; each, and 8 with --stack-size 10.
+;
+; Expected output: 50 times the number of cores, e.g. 200 on 4 cores
+
+    LDI R2,0xFA          ; I2 vector, the inter-core interrupt
+    LDI R3,Finished
+    ST R2,R3
+    LDI R5,4             ; unmask I2
+    LDI R2,50            ; R2 counts the adds left
+
+AddLoop:
+    LDI R4,Acquire
+    CALL R4
+    LDI R3,Counter
+    LD R0,R3
+    INC R0
+    ST R3,R0
+    LDI R4,Release
+    CALL R4
+    DEC R2
+    LDI R4,0
+    CMP R2,R4
+    LDI R4,AddLoop
+    JNE R4
+
+    LDI R4,Acquire       ; one more core done
+    CALL R4
+    LDI R3,Done
+    LD R0,R3
+    INC R0
+    ST R3,R0
+    LDI R4,Release
+    CALL R4
+    CMP R0,R1            ; the last one?
+    LDI R4,Others
+    JNE R4
+    LDI R3,0xF5          ; interrupt core 0
+    LDI R0,0
+    ST R3,R0
+
+Others:
+    LDI R3,0xF5          ; which core is this?
+    LD R0,R3
+    LDI R4,0
+    CMP R0,R4
+    LDI R4,Wait
+    JEQ R4
+    HLT
+
+Wait:
+    JMP R4               ; core 0 spins until the interrupt
+
+; Interrupt handler: all the cores are done
+Finished:
+    LDI R3,Counter
+    LD R0,R3
+    PRN R0
+    HLT
+
+; Subroutine: Acquire, takes the lock; clobbers R0, R3 and R4
+Acquire:
+    LDI R3,Lock
+    LDI R4,0
+Spin:
+    TAS R0,R3            ; R0 = the lock, and it's ours if that was 0
+    CMP R0,R4
+    LDI R0,Spin
+    JNE R0
+    RET
+
+; Subroutine: Release, lets the lock go; clobbers R3 and R4
+Release:
+    LDI R3,Lock
+    LDI R4,0
+    ST R3,R4
+    RET
+
+Lock:
+    DB 0
+Counter:
+    DB 0
+Done:
+    DB 0
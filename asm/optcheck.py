@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""
+Differential test for the peephole optimizer.
+
+Every program is assembled with and without -O and both are run on the
+emulator. Programs that halt must print the same thing and halt on the
+same source line with the same flags and registers, where a register
+holding a label's address may hold the label's new address instead. For
+programs that don't halt within the budget, the output of the shorter run
+must be the start of the other's.
+
+Besides the .asm files given (by default every one in this directory), a
+synthetic program full of the patterns the optimizer rewrites is checked.
+
+Usage: optcheck.py [file.asm ...]
+"""
+
+import argparse
+import glob
+import os
+import sys
+
+from asm import AssemblerError, assemble
+
+from cpu import CPU, HALTED
+from output import CaptureOutput
+
+# instructions to run each program for
+MAX_CYCLES = 100000
+
+# keystrokes for programs that read the keyboard
+KEYS = b"hello"
+
+SYNTHETIC = """\
+    NOP
+    LDI R0,1          ; dead, overwritten below
+    LDI R0,5
+    LDI R1,1
+    LDI R2,Hop        ; jumps through Hop to Start
+    JMP R2
+    PRN R0            ; unreachable
+Hop:
+    LDI R2,Start
+    JMP R2
+Start:
+    PUSH R0
+    POP R0
+    CMP R0,R1         ; flags overwritten by the next CMP
+    CMP R1,R0
+    LDI R3,Next
+    JGT R3
+Next:
+    PRN R0
+    SUB R0,R1
+    LDI R3,Done
+    CMP R0,R1
+    JLT R3
+    LDI R3,Next
+    JMP R3
+Done:
+    LDI R4,End
+    JMP R4            ; jump to the next line
+End:
+    PRN R1
+    LDI R2,Start      ; a label's address left in a register
+    HLT
+    NOP               ; unreachable
+"""
+
+
+def run(program):
+    cpu = CPU(output=CaptureOutput(), virtual_time=1000)
+    cpu.load_program(program)
+    cpu.press(KEYS)
+    return cpu.run(max_cycles=MAX_CYCLES)
+
+
+def relocation(plain, optimized):
+    """Old label address -> new label address."""
+    return {address: optimized.symbols[name]
+            for name, address in plain.symbols.items()}
+
+
+def compare(name, source):
+    """Check one program. Returns a list of the differences found."""
+    plain = assemble(source, name)
+    optimized = assemble(source, name, optimize=True)
+    a = run(plain)
+    b = run(optimized)
+
+    if a.reason != HALTED or b.reason != HALTED:
+        short, long = sorted((a.output, b.output), key=len)
+        if a.reason != b.reason and HALTED in (a.reason, b.reason):
+            return [f"stopped with {a.reason}, optimized {b.reason}"]
+        if not long.startswith(short):
+            return ["output differs"]
+        return []
+
+    problems = []
+    if a.output != b.output:
+        problems.append(f"output {a.output!r}, optimized {b.output!r}")
+    if plain.source_map.get(a.pc) != optimized.source_map.get(b.pc):
+        problems.append(f"halted on line {plain.source_map.get(a.pc)}, "
+                        f"optimized {optimized.source_map.get(b.pc)}")
+    if a.fl != b.fl:
+        problems.append(f"FL {a.fl:03b}, optimized {b.fl:03b}")
+    moved = relocation(plain, optimized)
+    for r, (x, y) in enumerate(zip(a.registers, b.registers)):
+        if x != y and moved.get(x) != y:
+            problems.append(f"R{r} {x:02X}, optimized {y:02X}")
+    return problems
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Check that asm.py -O doesn't change what programs do.")
+    parser.add_argument("files", nargs="*", help="the .asm files to check")
+    args = parser.parse_args(argv[1:])
+
+    files = args.files or sorted(
+        glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.asm")))
+    programs = [(os.path.basename(path), open(path).read()) for path in files]
+    programs.append(("synthetic", SYNTHETIC))
+
+    failures = 0
+    for name, source in programs:
+        try:
+            problems = compare(name, source)
+        except AssemblerError as e:
+            problems = [str(e)]
+        print(f"{name:<20} {'FAIL' if problems else 'ok'}")
+        for problem in problems:
+            print(f"    {problem}")
+        failures += bool(problems)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
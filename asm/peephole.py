@@ -0,0 +1,346 @@
+"""
+Peephole optimizer for the assembler (asm.py -O).
+
+The assembled code is split back into statements, one per source line, and
+cut into basic blocks at labels and at instructions that transfer control.
+The rewrites below are applied until none of them changes anything, then
+the code is laid out again and every label reference is patched with the
+label's new address.
+
+* NOP is dropped.
+* PUSH Rx followed straight away by POP Rx is dropped as a pair.
+* LDI Rx is dropped if Rx is written again in the same block before
+  anything reads it.
+* CMP is dropped if another CMP follows in the same block before any
+  conditional jump reads the flags.
+* LDI Rx,L then JMP Rx (or CALL Rx), where L is itself LDI Rx,M then
+  JMP Rx, loads M instead and skips the hop.
+* LDI Rx,L then JMP Rx, where L is the next instruction, drops the JMP.
+* Code after JMP, RET, IRET or HLT is dropped up to the next label.
+
+Removing code moves everything after it, so this assumes the program only
+ever refers to code and data through labels, never by a number, and doesn't
+modify its own code. R5-R7 are left alone. A handler can see whatever is in
+the registers and flags when an interrupt comes in, so programs that write
+IM (R5) don't get the dead LDI and CMP rewrites.
+"""
+
+from opcodes import *
+
+SP = 7
+IM = 5
+
+# instructions that never fall through to the next one
+TERMINATORS = {JMP, RET, IRET, HLT}
+
+
+class Statement:
+    """One line of assembled source."""
+
+    __slots__ = ("line", "code", "data", "labels", "refs", "comments")
+
+    def __init__(self, line, code, data):
+        self.line = line
+        self.code = bytearray(code)
+        self.data = data
+        # labels on this line
+        self.labels = []
+        # offset in code -> symbol, for operands that hold a label's address
+        self.refs = {}
+        # (offset in code, comment) for .ls8 text output
+        self.comments = []
+
+    @property
+    def op(self):
+        """The opcode, or None for data."""
+        return None if self.data else self.code[0]
+
+    def register(self, n=1):
+        return self.code[n] & 0b111
+
+
+def effects(st):
+    """
+    The registers an instruction reads and writes, as (reads, writes), or
+    None for one that transfers control, which ends the block.
+    """
+    op = st.op
+    a = st.register(1) if len(st.code) > 1 else None
+    b = st.register(2) if len(st.code) > 2 else None
+
+    if op == LDI:
+        return (), (a,)
+    if op == LD:
+        return (b,), (a,)
+    if op == ST:
+        return (a, b), ()
+    if op == TAS:
+        return (b,), (a,)
+    if op == PUSH:
+        return (a, SP), (SP,)
+    if op == POP:
+        return (SP,), (a, SP)
+    if op in (PRN, PRA):
+        return (a,), ()
+    if op == NOP:
+        return (), ()
+    if op == CMP:
+        return (a, b), ()
+    if op is not None and is_alu(op):
+        return (a, b)[:operand_count(op)], (a,)
+    return None
+
+
+def split(assembly):
+    """Split an Assembly into Statements. Returns (statements, end labels)."""
+    code = assembly.code
+    data = set(assembly.data)
+    starts = sorted(assembly.source_map)
+    comments = dict(assembly.comments)
+    refs = dict(assembly.fixups)
+
+    statements = []
+    by_address = {}
+    for i, address in enumerate(starts):
+        end = starts[i + 1] if i + 1 < len(starts) else len(code)
+        st = Statement(assembly.source_map[address], code[address:end],
+                       address in data)
+        for offset in range(end - address):
+            if address + offset in refs:
+                st.refs[offset] = refs[address + offset]
+            if address + offset in comments:
+                st.comments.append((offset, comments[address + offset]))
+        statements.append(st)
+        by_address[address] = st
+
+    end_labels = []
+    for name, address in assembly.sym.items():
+        st = by_address.get(address)
+        if st is None:
+            end_labels.append(name)
+        else:
+            st.labels.append(name)
+
+    return statements, end_labels
+
+
+def join(statements, end_labels, assembly):
+    """Lay statements out as a new Assembly like assembly."""
+    out = type(assembly)(assembly.annotate)
+    code = out.code
+
+    for st in statements:
+        address = len(code)
+        for name in st.labels:
+            out.sym[name] = address
+            if out.annotate:
+                out.labels.append((address, name))
+        out.source_map[address] = st.line
+        if st.data:
+            out.data.append(address)
+        for offset, s in st.refs.items():
+            out.fixups.append((address + offset, s))
+        if out.annotate:
+            out.comments.extend((address + offset, comment)
+                                for offset, comment in st.comments)
+        code.extend(st.code)
+
+    for name in end_labels:
+        out.sym[name] = len(code)
+        if out.annotate:
+            out.labels.append((len(code), name))
+
+    out.resolve()
+    return out
+
+
+def loads_label(st):
+    """The (register, label) of an LDI Rx,label, else None."""
+    if st.op == LDI and 2 in st.refs:
+        return st.register(1), st.refs[2]
+    return None
+
+
+def jumps_through(st, register, ops=(JMP,)):
+    """True if st is one of ops through register, and isn't a jump target."""
+    return st.op in ops and not st.labels and st.register(1) == register
+
+
+def remove(statements, index):
+    """
+    Drop a statement, moving its labels on to the next one. Returns False,
+    and leaves it, if it's labelled and there is no next one.
+    """
+    st = statements[index]
+    if st.labels:
+        if index + 1 >= len(statements):
+            return False
+        statements[index + 1].labels[:0] = st.labels
+    del statements[index]
+    return True
+
+
+def is_dead_store(statements, i):
+    """True if the register LDI'd at i is written before it's read."""
+    register = statements[i].register(1)
+    for st in statements[i + 1:]:
+        if st.labels or st.data:
+            return False
+        rw = effects(st)
+        if rw is None or register in rw[0]:
+            return False
+        if register in rw[1]:
+            return True
+    return False
+
+
+def is_dead_compare(statements, i):
+    """True if another CMP follows i before anything reads the flags."""
+    for st in statements[i + 1:]:
+        if st.labels or st.data or effects(st) is None:
+            return False
+        if st.op == CMP:
+            return True
+    return False
+
+
+def thread_jump(statements, i, targets):
+    """
+    If statement i is LDI Rx,L before a JMP/CALL Rx and L is LDI Rx,M then
+    JMP Rx, load M instead. Returns True if it did.
+    """
+    load = loads_label(statements[i])
+    if load is None or i + 1 >= len(statements):
+        return False
+    register, label = load
+    if not jumps_through(statements[i + 1], register, (JMP, CALL)):
+        return False
+
+    # follow the chain of hops to where it ends
+    seen = {label}
+    while True:
+        t = targets.get(label)
+        if t is None or t + 1 >= len(statements):
+            break
+        hop = loads_label(statements[t])
+        if (hop is None or hop[0] != register
+                or not jumps_through(statements[t + 1], register)):
+            break
+        if hop[1] in seen:
+            # a loop of jumps that never gets anywhere; leave it be
+            return False
+        seen.add(hop[1])
+        label = hop[1]
+
+    st = statements[i]
+    if label == st.refs[2]:
+        return False
+    st.refs[2] = label
+    st.comments = [(0, f"LDI R{register},{label}")]
+    return True
+
+
+def jumps_to_next(statements, i, targets):
+    """True if statement i is LDI Rx,L, then JMP Rx to the line after it."""
+    load = loads_label(statements[i])
+    if load is None or i + 2 >= len(statements):
+        return False
+    register, label = load
+    return (jumps_through(statements[i + 1], register)
+            and targets.get(label) == i + 2)
+
+
+def writes_im(statements):
+    """True if any instruction in the program might change IM or raise INT."""
+    for st in statements:
+        if st.op == INT:
+            return True
+        rw = effects(st)
+        if rw is not None and IM in rw[1]:
+            return True
+    return False
+
+
+def rewrite(statements, interrupts):
+    """Apply one round of rewrites. Returns {rule: times applied}."""
+    applied = {}
+
+    def count(rule):
+        applied[rule] = applied.get(rule, 0) + 1
+
+    targets = {}
+    for i, st in enumerate(statements):
+        for name in st.labels:
+            targets[name] = i
+    for i in range(len(statements)):
+        if thread_jump(statements, i, targets):
+            count("jump threading")
+
+    i = 0
+    while i < len(statements):
+        st = statements[i]
+        op = st.op
+        nxt = statements[i + 1] if i + 1 < len(statements) else None
+
+        if op == NOP and remove(statements, i):
+            count("nop")
+            continue
+
+        if (op == PUSH and nxt is not None and nxt.op == POP
+                and not nxt.labels and st.register(1) == nxt.register(1) != SP
+                and (not st.labels or i + 2 < len(statements))):
+            del statements[i + 1]
+            remove(statements, i)
+            count("push/pop")
+            continue
+
+        if (op == LDI and st.register(1) < IM and not interrupts
+                and is_dead_store(statements, i) and remove(statements, i)):
+            count("dead load")
+            continue
+
+        if (op == CMP and not interrupts and is_dead_compare(statements, i)
+                and remove(statements, i)):
+            count("dead compare")
+            continue
+
+        if jumps_to_next(statements, i, targets) and remove(statements, i + 1):
+            count("jump to next")
+            # statement indexes have moved
+            return applied
+
+        if op in TERMINATORS:
+            removed = 0
+            while (i + 1 < len(statements) and not statements[i + 1].labels
+                   and not statements[i + 1].data):
+                statements.pop(i + 1)
+                removed += 1
+            if removed:
+                count("unreachable")
+
+        i += 1
+
+    return applied
+
+
+def optimize(assembly):
+    """
+    Optimize an Assembly. Returns (the optimized Assembly, stats), where
+    stats has "before" and "after" instruction counts and how many times
+    each rewrite was made.
+    """
+    statements, end_labels = split(assembly)
+    before = sum(not st.data for st in statements)
+    interrupts = writes_im(statements)
+
+    rules = {}
+    while True:
+        applied = rewrite(statements, interrupts)
+        if not applied:
+            break
+        for rule, n in applied.items():
+            rules[rule] = rules.get(rule, 0) + n
+
+    after = sum(not st.data for st in statements)
+    return join(statements, end_labels, assembly), {
+        "before": before, "after": after, "rules": rules}
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite for the LS-8 emulator and assembler.
+
+Usage:
+    bench.py run [options]              run the benchmarks, print and save results
+    bench.py compare OLD.json NEW.json  flag regressions between two runs
+
+Workloads are the synthetic programs in workloads/, the programs in
+ls8/examples, and assembling a large amount of generated source. Each emulator
+workload is run on every engine that can run it (cpu, jit, and vector if
+numpy is installed), in a fresh process so peak memory is per workload.
+Every measurement is repeated after some warmup runs, and reported as
+median, mean, standard deviation, minimum and maximum.
+
+Results are saved as JSON. A workload that fails is recorded with its
+error, and the rest still run. compare matches up the results of two runs
+and exits with status 1 if any workload got slower by more than --threshold
+percent.
+"""
+
+import argparse
+import importlib.metadata
+import importlib.util
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+WORKLOAD_DIR = os.path.join(BENCH_DIR, "workloads")
+EXAMPLES_DIR = os.path.join(ROOT, "ls8", "examples")
+
+sys.path.insert(0, os.path.join(ROOT, "ls8"))
+sys.path.insert(0, os.path.join(ROOT, "asm"))
+
+import asm
+from cpu import CPU
+from jit import JITCPU
+from output import BufferedOutput
+
+try:
+    import resource
+except ImportError:  # not on Unix, no peak memory figures
+    resource = None
+
+# the vector engine is only imported where it runs, so numpy doesn't count
+# towards the other engines' memory
+ENGINES = {
+    "cpu": CPU,
+    "jit": JITCPU,
+    "vector": None,
+}
+
+# lanes the vector engine runs, and the most steps it gets per run, since
+# each of its steps costs as much as thousands of instructions elsewhere
+VECTOR_LANES = 1024
+VECTOR_MAX_STEPS = 20000
+
+# per-workload settings: virtual time for the timer, and an instruction
+# budget for programs that never halt
+SETTINGS = {
+    "timer": {"virtual_time": 50},
+    "interrupts": {"virtual_time": 1000, "max_cycles": 200000},
+    "keyboard": {"max_cycles": 200000},
+    # run as one core, it waits for the others forever
+    "multicore": {"max_cycles": 200000},
+}
+
+# workloads that need interrupts, which the vector engine doesn't model
+NEEDS_INTERRUPTS = {"timer", "interrupts", "keyboard"}
+
+# lines in the generated assembler workload, and the blocks of generated
+# code in each of its programs; a block is 26 bytes, so 8 fill 208 of RAM
+ASM_LINES = 20000
+ASM_BLOCKS = 8
+
+
+def summarize(values):
+    """Statistics for a list of measurements."""
+    return {
+        "median": statistics.median(values),
+        "mean": statistics.mean(values),
+        "stdev": statistics.stdev(values) if len(values) > 1 else 0.0,
+        "min": min(values),
+        "max": max(values),
+    }
+
+
+def peak_memory_kb():
+    """Peak resident set size of this process, in KB, or None."""
+    # on Linux ru_maxrss carries over from the parent process through exec,
+    # so prefer the kernel's own high water mark for this process image
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB everywhere else
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def assemble(source, image):
+    """Assemble the .asm file source into the binary image file image."""
+    with open(source) as f:
+        assembly = asm.assemble_lines(f, annotate=False)
+    with open(image, "wb") as f:
+        f.write(assembly.program().to_bytes())
+
+
+def workloads(build_dir):
+    """
+    Return {name: program path} for every emulator workload, assembling the
+    synthetic ones into build_dir.
+    """
+    found = {}
+    for name in sorted(os.listdir(WORKLOAD_DIR)):
+        if name.endswith(".asm"):
+            image = os.path.join(build_dir, name[:-4] + ".ls8b")
+            assemble(os.path.join(WORKLOAD_DIR, name), image)
+            found[name[:-4]] = image
+    for name in sorted(os.listdir(EXAMPLES_DIR)):
+        if name.endswith(".ls8"):
+            found["examples/" + name[:-4]] = os.path.join(EXAMPLES_DIR, name)
+    return found
+
+
+def settings(workload):
+    return SETTINGS.get(workload.split("/")[-1], {})
+
+
+def measure(engine, workload, path, repeat, warmup):
+    """Run one workload on one engine, warmup + repeat times."""
+    options = settings(workload)
+    startup = []
+    ips = []
+    cycles = None
+    reason = None
+
+    if engine == "vector":
+        from vector import REASONS, VectorCPU
+
+    with open(os.devnull, "w") as devnull:
+        for i in range(warmup + repeat):
+            started = time.perf_counter()
+            if engine == "vector":
+                cpu = VectorCPU(VECTOR_LANES)
+            else:
+                cpu = ENGINES[engine](output=BufferedOutput(devnull),
+                                      virtual_time=options.get("virtual_time"))
+            cpu.load(path)
+            loaded = time.perf_counter()
+
+            if engine == "vector":
+                state = cpu.run(max_cycles=min(options.get("max_cycles", VECTOR_MAX_STEPS),
+                                               VECTOR_MAX_STEPS))
+                cycles = int(state["cycles"].sum())
+                reason = REASONS[int(state["status"][0])]
+            else:
+                result = cpu.run(max_cycles=options.get("max_cycles"))
+                cycles = result.cycles
+                reason = result.reason
+            finished = time.perf_counter()
+
+            if i >= warmup:
+                startup.append(loaded - started)
+                ips.append(cycles / max(finished - loaded, 1e-9))
+
+    return {
+        "engine": engine,
+        "workload": workload,
+        "instructions": cycles,
+        "reason": reason,
+        "ips": summarize(ips),
+        "startup": summarize(startup),
+        "peak_memory_kb": peak_memory_kb(),
+    }
+
+
+def generate_asm(lines):
+    """
+    Deterministic assembler sources, about the given number of lines in all,
+    each a program that fits in RAM.
+    """
+    sources = []
+    out = []
+    for i in range(lines // 8):
+        out.append(f"Label{i}:")
+        out.append(f"    LDI R{i % 5},{i % 256}  ; load")
+        out.append(f"    ADD R{i % 5},R{(i + 1) % 5}")
+        out.append(f"    PUSH R{i % 8}")
+        out.append(f"    LDI R4,Label{i}")
+        out.append("    JNE R4")
+        out.append(f"    DB 0x{i % 256:02x}")
+        out.append("    DS Hello, world")
+        if (i + 1) % ASM_BLOCKS == 0:
+            out.append("    HLT")
+            sources.append("\n".join(out) + "\n")
+            out = []
+    if out:
+        out.append("    HLT")
+        sources.append("\n".join(out) + "\n")
+    return sources
+
+
+def measure_assembler(repeat, warmup):
+    """Time assembling ASM_LINES lines of generated source."""
+    sources = generate_asm(ASM_LINES)
+    lines = sum(source.count("\n") for source in sources)
+    lps = []
+
+    for i in range(warmup + repeat):
+        started = time.perf_counter()
+        for source in sources:
+            assembly = asm.assemble_lines(io.StringIO(source))
+            io.StringIO().write(assembly.text())
+            assembly.program().to_bytes()
+        elapsed = time.perf_counter() - started
+        if i >= warmup:
+            lps.append(lines / elapsed)
+
+    return {
+        "engine": "asm",
+        "workload": "asm/generated",
+        "programs": len(sources),
+        "lines": lines,
+        "lines_per_second": summarize(lps),
+        "peak_memory_kb": peak_memory_kb(),
+    }
+
+
+def run_worker(args):
+    """Take one measurement and print it as JSON, in a process of its own."""
+    if args.engine == "asm":
+        result = measure_assembler(args.repeat, args.warmup)
+    else:
+        result = measure(args.engine, args.workload, args.path, args.repeat,
+                         args.warmup)
+    json.dump(result, sys.stdout)
+    return 0
+
+
+def spawn(argv):
+    """Run a worker process and return the result it prints."""
+    process = subprocess.run([sys.executable, os.path.abspath(__file__),
+                              "worker", *argv],
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip())
+    return json.loads(process.stdout)
+
+
+def try_spawn(engine, workload, argv):
+    """
+    spawn(), but a worker that fails gives a result with its error rather
+    than stopping the suite.
+    """
+    try:
+        return spawn(argv)
+    except RuntimeError as e:
+        return {"engine": engine, "workload": workload,
+                "error": str(e).splitlines()[-1] if str(e) else "worker failed"}
+
+
+def have_numpy():
+    """The numpy version, or None if it isn't installed."""
+    if importlib.util.find_spec("numpy") is None:
+        return None
+    return importlib.metadata.version("numpy")
+
+
+def metadata():
+    return {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "numpy": have_numpy(),
+    }
+
+
+def print_result(result, file=sys.stdout):
+    if "error" in result:
+        print(f"{result['workload']:<28} {result['engine']:<7} "
+              f"FAILED: {result['error']}", file=file)
+        return
+
+    if result["engine"] == "asm":
+        stats = result["lines_per_second"]
+        print(f"{result['workload']:<28} {'asm':<7} "
+              f"{stats['median'] / 1e3:>9.1f}k lines/s "
+              f"(±{stats['stdev'] / 1e3:.1f}k)", file=file)
+        return
+
+    stats = result["ips"]
+    memory = result["peak_memory_kb"]
+    print(f"{result['workload']:<28} {result['engine']:<7} "
+          f"{stats['median'] / 1e6:>9.3f}M instr/s "
+          f"(±{stats['stdev'] / 1e6:.3f}M)  "
+          f"startup {result['startup']['median'] * 1e3:7.2f}ms  "
+          f"peak {'-' if memory is None else f'{memory / 1024:.1f}MB'}",
+          file=file)
+
+
+def run_suite(args):
+    engines = args.engines.split(",")
+    if "vector" in engines and have_numpy() is None:
+        print("numpy isn't installed, skipping the vector engine",
+              file=sys.stderr)
+        engines.remove("vector")
+
+    results = []
+    with tempfile.TemporaryDirectory() as build_dir:
+        for workload, path in workloads(build_dir).items():
+            if args.filter and args.filter not in workload:
+                continue
+            for engine in engines:
+                if engine == "vector" and workload.split("/")[-1] in NEEDS_INTERRUPTS:
+                    continue
+                result = try_spawn(engine, workload,
+                                   ["--engine", engine, "--workload", workload,
+                                    "--path", path, "--repeat", str(args.repeat),
+                                    "--warmup", str(args.warmup)])
+                print_result(result)
+                results.append(result)
+
+        if not args.filter or args.filter in "asm/generated":
+            result = try_spawn("asm", "asm/generated",
+                               ["--engine", "asm", "--repeat", str(args.repeat),
+                                "--warmup", str(args.warmup)])
+            print_result(result)
+            results.append(result)
+
+    report = {"meta": metadata(), "repeat": args.repeat,
+              "warmup": args.warmup, "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results saved to {args.output}", file=sys.stderr)
+
+    failures = sum("error" in result for result in results)
+    if failures:
+        print(f"{failures} workloads failed", file=sys.stderr)
+    return 1 if failures else 0
+
+
+def compare(args):
+    """Compare two saved runs; returns 1 if anything regressed."""
+    with open(args.old) as f:
+        old = {(r["engine"], r["workload"]): r for r in json.load(f)["results"]}
+    with open(args.new) as f:
+        new = json.load(f)["results"]
+
+    regressions = 0
+    for result in new:
+        before = old.get((result["engine"], result["workload"]))
+        if before is None or "error" in before or "error" in result:
+            continue
+
+        key = "lines_per_second" if result["engine"] == "asm" else "ips"
+        was = before[key]["median"]
+        now = result[key]["median"]
+        change = (now - was) / was * 100 if was else 0.0
+
+        flag = ""
+        if change < -args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        elif change > args.threshold:
+            flag = "  faster"
+        print(f"{result['workload']:<28} {result['engine']:<7} "
+              f"{was:>14,.0f} -> {now:>14,.0f} {change:+7.1f}%{flag}")
+
+    print(f"{regressions} regressions beyond {args.threshold}%",
+          file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the LS-8 emulator and assembler.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmarks")
+    run.add_argument("--engines", default=",".join(ENGINES),
+                     help="comma-separated engines to run (default: %(default)s)")
+    run.add_argument("--repeat", type=int, default=5,
+                     help="measured runs per workload (default: %(default)s)")
+    run.add_argument("--warmup", type=int, default=1,
+                     help="unmeasured runs first (default: %(default)s)")
+    run.add_argument("--filter", help="only workloads with this in their name")
+    run.add_argument("-o", "--output", default="bench.json",
+                     help="where to save the results (default: %(default)s)")
+
+    cmp = commands.add_parser("compare", help="compare two saved runs")
+    cmp.add_argument("old")
+    cmp.add_argument("new")
+    cmp.add_argument("--threshold", type=float, default=5.0,
+                     help="percent slowdown that counts as a regression (default: %(default)s)")
+
+    worker = commands.add_parser("worker")
+    worker.add_argument("--engine", required=True)
+    worker.add_argument("--workload")
+    worker.add_argument("--path")
+    worker.add_argument("--repeat", type=int, default=5)
+    worker.add_argument("--warmup", type=int, default=1)
+
+    args = parser.parse_args(argv[1:])
+    if args.command == "run":
+        return run_suite(args)
+    if args.command == "compare":
+        return compare(args)
+    return run_worker(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
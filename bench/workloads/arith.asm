@@ -0,0 +1,30 @@
+; arith.asm
+;
+; Tight arithmetic loop: 250 x 250 passes over a handful of ALU
+; instructions, about 440,000 instructions in all.
+;
+; Expected output: the accumulator, 209
+
+        LDI R0,0            ; accumulator
+        LDI R1,250          ; outer count
+        LDI R3,0            ; zero, to compare against
+
+Outer:
+        LDI R2,250          ; inner count
+
+Inner:
+        ADD R0,R2
+        MUL R0,R1
+        XOR R0,R2
+        DEC R2
+        CMP R2,R3
+        LDI R4,Inner
+        JNE R4
+
+        DEC R1
+        CMP R1,R3
+        LDI R4,Outer
+        JNE R4
+
+        PRN R0
+        HLT
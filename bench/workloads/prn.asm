@@ -0,0 +1,28 @@
+; prn.asm
+;
+; Output-heavy loop: print 0-249 250 times over, 62,500 lines and about
+; 375,000 instructions in all.
+;
+; Expected output: 0 to 249, 250 times
+
+        LDI R3,0            ; zero, to compare against
+        LDI R4,250          ; outer count
+
+Outer:
+        LDI R0,0            ; number to print
+        LDI R1,250          ; inner count
+
+Inner:
+        PRN R0
+        INC R0
+        DEC R1
+        CMP R1,R3
+        LDI R2,Inner
+        JNE R2
+
+        DEC R4
+        CMP R4,R3
+        LDI R2,Outer
+        JNE R2
+
+        HLT
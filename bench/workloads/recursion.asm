@@ -0,0 +1,37 @@
+; recursion.asm
+;
+; Deep CALL/RET recursion: 250 times, recurse 150 levels deep and back,
+; about 300,000 instructions in all.
+;
+; Expected output: the number of returns mod 256, 124
+
+        LDI R1,0            ; returns counted so far
+        LDI R3,0            ; zero, to compare against
+        LDI R4,250          ; repetitions
+
+Again:
+        LDI R0,150          ; depth
+        LDI R2,Down
+        CALL R2
+        DEC R4
+        CMP R4,R3
+        LDI R2,Again
+        JNE R2
+
+        PRN R1
+        HLT
+
+; Down
+;
+; Call itself R0 times, counting the returns in R1
+
+Down:
+        CMP R0,R3
+        LDI R2,Done
+        JEQ R2
+        DEC R0
+        LDI R2,Down
+        CALL R2
+        INC R1
+Done:
+        RET
@@ -0,0 +1,43 @@
+; stack.asm
+;
+; Stack-heavy loop: 250 x 250 passes, each pushing and popping four
+; registers twice, about 1,250,000 instructions in all.
+;
+; Expected output: 7
+
+        LDI R0,7
+        LDI R3,0            ; zero, to compare against
+        LDI R4,250          ; outer count
+
+Outer:
+        LDI R1,250          ; inner count
+
+Inner:
+        PUSH R0
+        PUSH R1
+        PUSH R2
+        PUSH R4
+        POP R4
+        POP R2
+        POP R1
+        POP R0
+        PUSH R4
+        PUSH R2
+        PUSH R1
+        PUSH R0
+        POP R0
+        POP R1
+        POP R2
+        POP R4
+        DEC R1
+        CMP R1,R3
+        LDI R2,Inner
+        JNE R2
+
+        DEC R4
+        CMP R4,R3
+        LDI R2,Outer
+        JNE R2
+
+        PRN R0
+        HLT
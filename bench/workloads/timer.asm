@@ -0,0 +1,49 @@
+; timer.asm
+;
+; Interrupt-heavy: wait in a loop for 40 x 256 timer interrupts, each
+; counted by the handler in a 16-bit counter in memory. Meant to be run
+; in virtual time, with the timer firing every 50 instructions, which
+; comes to about 510,000 instructions.
+;
+; Expected output: 40
+
+        LDI R0,0xF8         ; R0 holds the interrupt vector for I0 (timer)
+        LDI R1,Handler
+        ST R0,R1            ; Store handler addr in int vector
+        LDI R2,40           ; high byte of the count to wait for
+        LDI R3,CountHigh
+        LDI R4,Wait
+        LDI R5,1            ; Enable timer interrupts
+
+Wait:
+        LD R1,R3
+        CMP R1,R2
+        JNE R4
+
+        PRN R1
+        HLT
+
+; Handler
+;
+; Add one to the count; R0-R6 are restored by IRET
+
+Handler:
+        LDI R0,CountLow
+        LD R1,R0
+        INC R1
+        ST R0,R1
+        LDI R2,0
+        CMP R1,R2
+        LDI R2,HandlerDone
+        JNE R2
+        LDI R0,CountHigh
+        LD R1,R0
+        INC R1
+        ST R0,R1
+HandlerDone:
+        IRET
+
+CountLow:
+        DB 0
+CountHigh:
+        DB 0
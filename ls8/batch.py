@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Run a batch of LS-8 programs across a pool of worker processes.
+
+Usage: batch.py [options] DIR|MANIFEST
+
+Given a directory, every .ls8 and .ls8b file in it is a job. A manifest is a
+JSON Lines file with one job per line:
+
+    {"program": "examples/mult.ls8"}
+    {"id": "echo-1", "program": "keyboard.ls8", "input": "hi",
+     "max_cycles": 100000, "max_time": 1.5}
+
+Relative program paths are relative to the manifest. Each worker keeps one
+CPU and resets it between jobs. Results are written as JSON Lines, in the
+order jobs finish.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cpu import CPU
+from jit import JITCPU
+from output import CaptureOutput
+from program import Program
+from runcache import RunCache
+
+# the CPU each worker process reuses for all its jobs, and its run cache
+_cpu = None
+_cache = None
+
+
+def read_jobs(path):
+    """Return the list of jobs (dicts) in a directory or manifest."""
+
+    if os.path.isdir(path):
+        return [
+            {"program": os.path.join(path, name)}
+            for name in sorted(os.listdir(path))
+            if name.endswith((".ls8", ".ls8b"))
+        ]
+
+    jobs = []
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            job = json.loads(line)
+            job["program"] = os.path.join(base, job["program"])
+            jobs.append(job)
+    return jobs
+
+
+def init_worker(jit, cache=None):
+    """
+    Process pool initializer: build the worker's CPU once, and open the
+    run cache at cache, if given.
+    """
+    global _cpu, _cache
+    _cpu = JITCPU() if jit else CPU()
+    _cache = None if cache is None else RunCache(cache)
+
+
+def run_job(job, max_cycles=None, max_time=None):
+    """Run one job on the worker's CPU and return its result as a dict."""
+
+    cpu = _cpu
+    cpu.reset()
+    cpu.output = CaptureOutput()
+
+    result = {"id": job.get("id", job.get("program"))}
+    if "program" in job:
+        result["program"] = job["program"]
+    started = time.perf_counter()
+
+    try:
+        if "image" in job:
+            # a binary image sent over by server.py
+            cpu.load_program(Program.from_bytes(job["image"]))
+        else:
+            cpu.load(job["program"])
+        if "input" in job:
+            cpu.press(job["input"])
+        limits = dict(max_cycles=job.get("max_cycles", max_cycles),
+                      max_time=job.get("max_time", max_time))
+        if _cache is None:
+            run = cpu.run(**limits)
+        else:
+            run = _cache.run(cpu, **limits)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        result["wall_time"] = time.perf_counter() - started
+        return result
+
+    result.update(
+        reason=run.reason,
+        cycles=run.cycles,
+        output=run.output,
+        pc=run.pc,
+        fl=run.fl,
+        registers=list(run.registers),
+        wall_time=time.perf_counter() - started,
+    )
+    if _cache is not None:
+        result["cached"] = run.cached
+    return result
+
+
+def run_jobs(jobs, max_cycles=None, max_time=None):
+    """Run a chunk of jobs in a worker, to save on inter-process overhead."""
+    return [run_job(job, max_cycles, max_time) for job in jobs]
+
+
+def run_batch(jobs, workers=None, chunksize=16, jit=False,
+              max_cycles=None, max_time=None, cache=None):
+    """
+    Run jobs across a process pool. Yields result dicts as chunks of jobs
+    complete. With cache, the path of a run cache, jobs run before come from
+    there.
+    """
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(jit, cache)) as pool:
+        futures = [
+            pool.submit(run_jobs, jobs[i:i + chunksize], max_cycles, max_time)
+            for i in range(0, len(jobs), chunksize)
+        ]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run a batch of LS-8 programs in parallel.")
+    parser.add_argument("jobs", help="directory of programs, or a JSON Lines manifest")
+    parser.add_argument("-j", "--workers", type=int,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--chunksize", type=int, default=16,
+                        help="jobs handed to a worker at a time")
+    parser.add_argument("--jit", action="store_true",
+                        help="run on the basic-block JIT")
+    parser.add_argument("--max-cycles", type=int,
+                        help="default instruction budget per job")
+    parser.add_argument("--max-time", type=float,
+                        help="default time budget per job, in seconds")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="reuse the results of identical runs from this cache, see runcache.py")
+    parser.add_argument("-o", "--output", default="-",
+                        help="where to write the results (default: stdout)")
+    args = parser.parse_args(argv[1:])
+
+    jobs = read_jobs(args.jobs)
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+
+    for result in run_batch(jobs, args.workers, args.chunksize, args.jit,
+                            args.max_cycles, args.max_time, args.cache):
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
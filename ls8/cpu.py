@@ -1,310 +1,531 @@
 """CPU functionality."""
 
+import io
+import operator
 import sys
+import time
+from collections import deque
+
+from fusion import FUSED
+from opcodes import *
+from output import *
+from program import read as read_program
+from snapshot import Snapshot
+
+# ALU operations indexed by instruction identifier (the DDDD bits of the
+# opcode). Each takes the values of registers A and B and returns the new
+# value of register A, wrapped to 8 bits. CMP sets FL instead, see
+# CPU.handle_cmp.
+ALU_OPS = [None] * 16
+ALU_OPS[instruction_id(ADD)] = lambda a, b: (a + b) & 0xff
+ALU_OPS[instruction_id(SUB)] = lambda a, b: (a - b) & 0xff
+ALU_OPS[instruction_id(MUL)] = lambda a, b: (a * b) & 0xff
+ALU_OPS[instruction_id(DIV)] = operator.floordiv
+ALU_OPS[instruction_id(MOD)] = operator.mod
+ALU_OPS[instruction_id(INC)] = lambda a, b: (a + 1) & 0xff
+ALU_OPS[instruction_id(DEC)] = lambda a, b: (a - 1) & 0xff
+ALU_OPS[instruction_id(AND)] = operator.and_
+ALU_OPS[instruction_id(NOT)] = lambda a, b: ~a & 0xff
+ALU_OPS[instruction_id(OR)] = operator.or_
+ALU_OPS[instruction_id(XOR)] = operator.xor
+ALU_OPS[instruction_id(SHL)] = lambda a, b: (a << b) & 0xff
+ALU_OPS[instruction_id(SHR)] = operator.rshift
+
+# reasons run() stops
+HALTED = "halted"  # HLT
+BUDGET = "budget exhausted"  # max_cycles or max_time ran out, can resume
+UNKNOWN_OPCODE = "unknown opcode"
+DIVISION_BY_ZERO = "division by zero"
+BREAKPOINT = "breakpoint"
+IDLE = "idle"  # waiting for an interrupt that can never come
+
+# how many instructions run between clock checks
+TIME_SLICE = 10000
+
+# buffered output is flushed at least this often during a run, in seconds,
+# so a long-running program's output shows up as it goes
+FLUSH_INTERVAL = 0.1
+
+# registers with special meaning
+IM = 5  # interrupt mask
+IS = 6  # interrupt status
+SP = 7  # stack pointer
+
+# interrupt numbers, and where the vector table and the last key live
+TIMER_INTERRUPT = 0
+KEYBOARD_INTERRUPT = 1
+VECTOR_TABLE = 0xf8
+KEY_ADDRESS = 0xf4
+
+# flags in CPU.code, per address of RAM
+CODE_FLAG = 0b01  # a cached instruction was decoded from it
+DEVICE_FLAG = 0b10  # a memory-mapped device is there, see mmio.py
+
+# seconds between timer interrupts
+TIMER_PERIOD = 1.0
+
+# while IM is nonzero, the clock and the keyboard are checked every
+# POLL_INTERVAL instructions
+POLL_INTERVAL = 1000
+
+
+class Halt(Exception):
+    """Raised by instruction handlers to stop the CPU."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Reschedule(Exception):
+    """
+    Raised after an instruction that may have changed IM or IS, so the
+    dispatch loop stops and checks for interrupts before going on.
+    """
+
+
+def touches_interrupts(ir, operand_a):
+    """
+    True if the instruction can change IM, IS or whether interrupts are
+    enabled: INT, IRET, and anything that writes R5 or R6 (LDI, LD, POP,
+    TAS and the ALU instructions but CMP).
+    """
+    if ir in (INT, IRET):
+        return True
+    writes_a = ir in (LDI, LD, POP, TAS) or (is_alu(ir) and ir != CMP)
+    return writes_a and operand_a in (IM, IS)
+
+
+class RunResult:
+    """Outcome of a call to CPU.run()."""
+
+    def __init__(self, cpu, reason, cycles, elapsed):
+        self.reason = reason
+        self.cycles = cycles  # instructions executed by this run
+        self.elapsed = elapsed  # wall time in seconds
+        self.pc = cpu.pc
+        self.ir = cpu.ram[cpu.pc]
+        self.fl = cpu.fl
+        self.registers = bytes(cpu.reg)
+        getvalue = getattr(cpu.output, "getvalue", None)
+        self.output = getvalue() if getvalue is not None else None
+
+    @property
+    def halted(self):
+        """True if the program ran HLT."""
+        return self.reason == HALTED
+
+    def __repr__(self):
+        return (f"<RunResult {self.reason}, {self.cycles} cycles, "
+                f"pc={self.pc:02X} fl={self.fl:03b} "
+                f"registers={self.registers.hex(' ')}>")
 
-LDI = 0b10000010
-PRN = 0b01000111
-HLT = 0b00000001
-PUSH = 0b01000101
-POP = 0b01000110
-ST = 0b10000100
-# LD = 0b10000010
-# NOP = 0b00000000
-# PRA = 0b01001000
-
-# handled by ALU
-ADD = 0b10100000
-AND = 0b10100000
-CMP = 0b10100111
-# DEC = 0b01100110
-DIV = 0b10100011
-# INC = 0b01100101
-MOD = 0b10100100
-MUL = 0b10100010
-NOT = 0b01101001
-OR = 0b10101010
-SHL = 0b10101100
-SHR = 0b10101101
-SUB = 0b10100001
-XOR = 0b10101011
-
-# the following explicityy set the PC
-CALL = 0b01010000
-# INT = 0b01010010
-IRET = 0b00010011
-JEQ = 0b01010101
-JGE = 0b01011010
-JGT = 0b01010111
-JLE = 0b01011001
-JLT = 0b01011000
-JMP = 0b01010100
-JNE = 0b01010110
-RET = 0b00010001
 
 class CPU:
     """Main CPU class."""
 
-    def __init__(self):
-        """Construct a new CPU."""
-        self.ram = [0] * 256
-        self.reg = [0] * 8
+    def __init__(self, ram=None, reg=None, output=None, virtual_time=None,
+                 fuse=True, devices=()):
+        """
+        Construct a new CPU. RAM and the register file are 256 and 8 bytes;
+        pass any writable buffer of that size as ram/reg (a bytearray, mmap,
+        shared memory...) to have the CPU work on it in place.
+
+        PRN and PRA write to output, a BufferedOutput on stdout by default.
+        Pass a CaptureOutput to get the output in the RunResult instead, or a
+        NullOutput to drop it. A plain text stream gets wrapped in a
+        BufferedOutput.
+
+        The timer interrupt fires once a second of wall clock time. With
+        virtual_time=N it fires every N instructions instead, which makes
+        interrupt delivery the same on every run.
+
+        fuse=False turns off superinstructions (see fusion.py), so the
+        dispatch loop runs every instruction on its own, for debugging.
+
+        devices are memory-mapped devices to attach, as classes taking the
+        CPU, see mmio.py.
+        """
+        self.ram = bytearray(256) if ram is None else ram
+        self.reg = bytearray(8) if reg is None else reg
+        # read-only, zero-copy views of the machine state
+        self.ram_view = memoryview(self.ram).toreadonly()
+        self.reg_view = memoryview(self.reg).toreadonly()
         self.pc = 0 # program counter, the address of the current instruction
         self.fl = 0b00000000 # 00000LGE
-        self.sp = 7 # stack pointer aka R7 of register
+        self.cycles = 0 # instructions executed since power on
+        self.output = BufferedOutput() if output is None else output
+        # keystrokes waiting to be delivered to the keyboard device
+        self.keys = deque()
+        self.sp = SP # stack pointer aka R7 of register
+        self.reg[self.sp] = 0xf4
+        # R5 (IM) and R6 (IS) power on as 0, all interrupts masked
+        self.interrupts_enabled = True # False while a handler runs
+        self.virtual_time = virtual_time
+        self.next_tick = None # when the timer fires next, see poll_interrupts
+        self.program = None # the last Program loaded
+        # handler for every opcode, None where the opcode is unknown
+        self.branchtable = [None] * 256
+        for ir, name in MNEMONICS.items():
+            if is_alu(ir):
+                handler = self.alu_handler(instruction_id(ir))
+            else:
+                handler = getattr(self, 'handle_' + name.lower(), None)
+            self.branchtable[ir] = handler
+        # decode cache: address -> (handler, operand_a, operand_b, next_pc),
+        # filled in the first time the instruction at that address runs
+        self.decoded = [None] * 256
+        # flags for every byte of RAM that a store there has to act on:
+        # CODE_FLAG if a cached instruction was decoded from it, DEVICE_FLAG
+        # if a device is mapped there
+        self.code = bytearray(256)
+        # what dispatch() runs from: the decoded entries, with a fused pair
+        # in place of the first instruction of each pair, see decode_fused()
+        self.fuse = fuse
+        self.dispatch_table = [None] * 256
+        # the device at every address, None for plain RAM, and DEVICE_FLAG
+        # for every address with one, to put back when the cache is flushed
+        self.devices = [None] * 256
+        self.device_map = bytearray(256)
+        self.device_types = tuple(devices)
+        self.mapped = False # any devices at all
+        self.exact_cycles = False # a device reads self.cycles
+        for device in self.device_types:
+            device(self)
+
+    @property
+    def output(self):
+        """The output device PRN and PRA write to."""
+        return self._output
+
+    @output.setter
+    def output(self, output):
+        if not hasattr(output, "flush") or isinstance(output, io.TextIOBase):
+            output = BufferedOutput(output)
+        self._output = output
+        # the handlers call this directly, to save an attribute lookup
+        self.emit = output.write
+
+    def reset(self):
+        """
+        Put the CPU back in its power on state, so one instance can run many
+        programs without being reallocated.
+        """
+        self.ram[:] = bytes(256)
+        self.reg[:] = bytes(8)
         self.reg[self.sp] = 0xf4
-        # self.is = 6 # interrupt status aka R6 of register
-        # self.reg[self.is] = ?
-        # self.im = 5 # interrupt mask aka R5 of register
-        # self.reg[self.im] = ?
-        self.branchtable = {
-            LDI: self.handle_ldi,
-            PRN: self.handle_prn,
-            HLT: self.handle_hlt,
-            ADD: self.handle_add,
-            SUB: self.handle_sub,
-            MUL: self.handle_mul,
-            DIV: self.handle_div,
-            PUSH: self.push,
-            POP: self.pop,
-            CALL: self.call,
-            RET: self.ret,
-            ST: self.st,
-            IRET: self.iret,
-            CMP: self.cmp,
-            JEQ: self.jeq,
-            JGE: self.jge,
-            JGT: self.jgt,
-            JLE: self.jle,
-            JLT: self.jlt,
-            JMP: self.jmp,
-            JNE: self.jne,
-            AND: self.handle_and,
-            OR: self.handle_or,
-            XOR: self.handle_xor,
-            NOT: self.handle_not,
-            SHL: self.handle_shl,
-            SHR: self.handle_shr,
-            MOD: self.handle_mod,
-        }        
+        self.pc = 0
+        self.fl = 0
+        self.cycles = 0
+        self.keys.clear()
+        self.interrupts_enabled = True
+        self.next_tick = None
+        self.flush_decoded()
+
+    def press(self, keys):
+        """Queue keystrokes (a str or bytes) for the keyboard."""
+        if isinstance(keys, str):
+            keys = keys.encode()
+        self.keys.extend(keys)
 
     def load(self, file):
-        """Load a program into memory."""
+        """
+        Load a program into memory, from a binary image, an .ls8 text file or
+        .asm source. Returns the Program.
+        """
+
+        return self.load_program(read_program(file))
 
-        address = 0
+    def load_program(self, program):
+        """
+        Copy a Program, e.g. from asm.assemble(), into memory and point the
+        PC at its entry. Returns the Program.
+        """
 
-        with open(file) as f: # what about case to handle if index out of range
-            # aka no argument provided to command line
-            for line in f:
-                val = line.split("#")[0].strip()
-                if val == '':
-                    continue
-                cmd = int(val, 2)
-                self.ram[address] = cmd
-                address += 1
+        self.ram[:len(program.code)] = program.code
+        self.pc = program.entry
+        # kept for its symbols and source map
+        self.program = program
+
+        self.flush_decoded()
+
+        return program
+
+    def snapshot(self):
+        """Capture the machine state as an immutable Snapshot."""
+        return Snapshot(
+            bytes(self.ram), bytes(self.reg), self.pc, self.fl, self.cycles,
+            self.interrupts_enabled,
+            self.next_tick if self.virtual_time is not None else None,
+            bytes(self.keys))
+
+    def restore(self, snapshot):
+        """
+        Put the machine back in the state captured by snapshot(). Cached code
+        is kept wherever RAM doesn't change, so restoring costs little more
+        than copying the bytes back.
+        """
+        ram = self.ram
+        if self.ram_view != snapshot.ram:
+            code = self.code
+            for address in range(256):
+                if code[address] and ram[address] != snapshot.ram[address]:
+                    self.invalidate(address)
+            ram[:] = snapshot.ram
+
+        self.reg[:] = snapshot.reg
+        self.pc = snapshot.pc
+        self.fl = snapshot.fl
+        self.cycles = snapshot.cycles
+        self.interrupts_enabled = snapshot.interrupts_enabled
+        self.next_tick = snapshot.next_tick
+        self.keys.clear()
+        self.keys.extend(snapshot.keys)
+
+    def fork(self, output=None, **kwargs):
+        """
+        Return a new CPU of the same class, in the same state as this one,
+        to run on independently. kwargs go to the constructor. The child
+        writes to output, by default a copy of this CPU's output device if it
+        can be copied (CaptureOutput), else the same device.
+        """
+        if output is None:
+            fork_output = getattr(self.output, "fork", None)
+            output = self.output if fork_output is None else fork_output()
+
+        kwargs.setdefault("fuse", self.fuse)
+        kwargs.setdefault("devices", self.device_types)
+        child = type(self)(output=output, virtual_time=self.virtual_time,
+                           **kwargs)
+        # RAM is 256 bytes, smaller than any page, so copying it outright is
+        # cheaper than having every store check for sharing
+        child.restore(self.snapshot())
+        return child
 
     def alu(self, op, reg_a, reg_b):
-        """ALU operations."""
-
-        if op == "ADD":
-            self.reg[reg_a] += self.reg[reg_b]
-        elif op == 'SUB':
-            self.reg[reg_a] -= self.reg[reg_b]
-        elif op == 'MUL':
-            self.reg[reg_a] *= self.reg[reg_b]
-        elif op == 'DIV':
-            self.reg[reg_a] /= self.reg[reg_b]
-        elif op == 'CMP':
-            diff = self.reg[reg_a] - self.reg[reg_b]
-            if diff == 0:
-                self.fl = 0b00000001
-            elif diff > 0:
-                self.fl = 0b00000010
-            elif diff < 0:
-                self.fl = 0b00000100
-        elif op == 'AND':
-            ans = self.reg[reg_a] & self.reg[reg_b]
-            self.reg[reg_a] = ans
-        elif op == 'OR':
-            ans = self.reg[reg_a] | self.reg[reg_b]
-            self.reg[reg_a] = ans
-        elif op == 'XOR':
-            ans = self.reg[reg_a] ^ self.reg[reg_b]
-            self.reg[reg_a] = ans
-        elif op == 'NOT':
-            self.reg[reg_a] = ~self.reg[reg_a]
-        elif op == 'SHL':
-            ans = self.reg[reg_a] << self.reg[reg_b]
-            self.reg[reg_a] = ans
-        elif op == 'SHR':
-            ans = self.reg[reg_a] >> self.reg[reg_b]
-            self.reg[reg_a] = ans
-        elif op == 'MOD':
-            ans = self.reg[reg_a] % self.reg[reg_b]
-            self.reg[reg_a] = ans
+        """ALU operations. op is the instruction identifier (DDDD) of the opcode."""
+
+        if op == instruction_id(CMP):
+            self.handle_cmp(reg_a, reg_b)
+        elif ALU_OPS[op] is not None:
+            self.reg[reg_a] = ALU_OPS[op](self.reg[reg_a], self.reg[reg_b])
         else:
             raise Exception("Unsupported ALU operation")
 
+    def alu_handler(self, op):
+        """Return the instruction handler for ALU operation op."""
+
+        if op == instruction_id(CMP):
+            return self.handle_cmp
+
+        fn = ALU_OPS[op]
+        if fn is None:
+            return None
+
+        def handle_alu(operand_a, operand_b):
+            reg = self.reg
+            reg[operand_a] = fn(reg[operand_a], reg[operand_b])
+
+        return handle_alu
+
     def handle_ldi(self, operand_a, operand_b):
         self.reg[operand_a] = operand_b
-        self.pc += 3
 
     def handle_prn(self, operand_a, operand_b):
-        value = self.reg[operand_a]
-        print(value)
-        self.pc += 2
-
-    def handle_hlt(self, operand_a, operand_b):
-        running = False
-        sys.exit()
+        self.emit(PRN_TEXT[self.reg[operand_a]])
 
-    def handle_add(self, operand_a, operand_b):
-        self.alu('ADD', operand_a, operand_b)
-        self.pc += 3
+    def handle_pra(self, operand_a, operand_b):
+        self.emit(PRA_TEXT[self.reg[operand_a]])
 
-    def handle_sub(self, operand_a, operand_b):
-        self.alu('SUB', operand_a, operand_b)
-        self.pc += 3
+    def handle_hlt(self, operand_a, operand_b):
+        # stay on the HLT, so running a halted CPU again halts right away
+        self.pc = (self.pc - 1) & 0xff
+        raise Halt(HALTED)
 
-    def handle_mul(self, operand_a, operand_b):
-        self.alu('MUL', operand_a, operand_b)
-        self.pc += 3
+    def handle_nop(self, operand_a, operand_b):
+        pass
 
-    def handle_div(self, operand_a, operand_b):
-        self.alu('DIV', operand_a, operand_b)
-        self.pc += 3
+    def handle_ld(self, reg_a, reg_b):
+        '''Load regA with the value at the address stored in regB.'''
+        self.reg[reg_a] = self.ram_read(self.reg[reg_b])
 
-    def push(self, opa, opb):
+    def handle_push(self, opa, opb):
         # decrement stack pointer
-        self.reg[self.sp] -= 1
+        self.reg[self.sp] = (self.reg[self.sp] - 1) & 0xff
         # get value from register
         val = self.reg[opa]
         # copy it in memory
         self.ram_write(self.reg[self.sp], val)
-        self.pc += 2
 
-    def pop(self, opa, opb):
+    def handle_pop(self, opa, opb):
         # copy the value from address pointed to by SP  in memory
         val = self.ram_read(self.reg[self.sp])
         # and save value to given register
         self.reg[opa] = val
         # increment SP
-        self.reg[self.sp] += 1
-        self.pc += 2
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xff
 
-    def call(self, opa, opb):
+    def handle_call(self, opa, opb):
         '''return address gets pushed on the stack'''
 
-        # compute return address
-        return_addr = self.pc + 2
+        # return address is the instruction after CALL, which run() has
+        # already advanced the pc to
+        return_addr = self.pc
 
-        # push the return address aka opb aka pc+2 on the stack
-        self.reg[self.sp] -= 1
+        # push the return address on the stack
+        self.reg[self.sp] = (self.reg[self.sp] - 1) & 0xff
         self.ram_write(self.reg[self.sp], return_addr)
 
         # set the pc to the value in the given register
-        self.pc = self.reg[self.ram[self.pc + 1]]
-
-    def cmp(self, reg_a, reg_b):
-        self.alu('CMP', reg_a, reg_b)
-        self.pc += 3
+        self.pc = self.reg[opa]
+
+    def handle_cmp(self, reg_a, reg_b):
+        diff = self.reg[reg_a] - self.reg[reg_b]
+        if diff == 0:
+            self.fl = 0b00000001
+        elif diff > 0:
+            self.fl = 0b00000010
+        else:
+            self.fl = 0b00000100
 
-    def jmp(self, reg_a, *kwargs):
+    def handle_jmp(self, reg_a, *kwargs):
         self.pc = self.reg[reg_a]
 
-    def jeq(self, reg_a, *kwargs):
+    def handle_jeq(self, reg_a, *kwargs):
         '''If equal flag is set (true), jump to the address stored in given register.'''
         if self.fl & 0b00000001:
-            self.jmp(reg_a)
-        else:
-            self.pc += 2
+            self.handle_jmp(reg_a)
     
-    def jge(self, reg_a, *kwargs):
+    def handle_jge(self, reg_a, *kwargs):
         '''If greater than or equal flag is set (true), jump to address stored in given register.'''
         if self.fl >> 1 == 1 or self.fl & 0b00000001:
-            self.jmp(reg_a)
-        else:
-            self.pc += 2
+            self.handle_jmp(reg_a)
 
-    def jgt(self, reg_a, *kwargs):
+    def handle_jgt(self, reg_a, *kwargs):
         '''If greater than flag is set (true), jump to address stored in given register.'''
         if self.fl >> 1 == 1:
-            self.jmp(reg_a)
-        else:
-            self.pc += 2
+            self.handle_jmp(reg_a)
 
-    def jle(self, reg_a, *kwargs):
+    def handle_jle(self, reg_a, *kwargs):
         '''If less than or equal flag is set (true), jump to address stored in given register.''' 
         if self.fl >> 2 or self.fl & 0b00000001:
-            self.jmp(reg_a)
-        else:
-            self.pc += 2
+            self.handle_jmp(reg_a)
     
-    def jlt(self, reg_a, *kwargs):
+    def handle_jlt(self, reg_a, *kwargs):
         '''If less than flag is set (true), jump to address stored in given register.'''
         if self.fl >> 2:
-            self.jmp(reg_a)
-        else:
-            self.pc += 2
+            self.handle_jmp(reg_a)
 
-    def jne(self, reg_a, *kwargs):
+    def handle_jne(self, reg_a, *kwargs):
         '''If equal flag is clear (false, 0), jump to address stored in given register.'''
-        if self.fl & 0b00000001:
-            self.pc += 2
-        else:
-            self.jmp(reg_a)
+        if not self.fl & 0b00000001:
+            self.handle_jmp(reg_a)
 
-    def ret(self, opa, opb):
+    def handle_ret(self, opa, opb):
         '''return address gets popped off the stack and stored in PC'''
 
         # pop return address from top of stack
         return_addr = self.ram_read(self.reg[self.sp])
-        self.reg[self.sp] += 1
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xff
 
         # set the pc
         self.pc = return_addr
 
-    def st(self, reg_a, reg_b):
+    def handle_st(self, reg_a, reg_b):
         '''Store value in regB in the address stored in regA.'''
         self.ram_write(self.reg[reg_a], self.reg[reg_b])
 
-    def handle_and(self, operand_a, operand_b):
-        self.alu('AND', operand_a, operand_b)
-        self.pc += 3
-
-    def handle_or(self, operand_a, operand_b):
-        self.alu('OR', operand_a, operand_b)
-        self.pc += 3 
-
-    def handle_xor(self, operand_a, operand_b):
-        self.alu('XOR', operand_a, operand_b)
-        self.pc += 3
-
-    def handle_not(self, operand_a, operand_b):
-        self.alu('NOT', operand_a, operand_b)
-        self.pc += 2
-
-    def handle_shl(self, operand_a, operand_b):
-        self.alu('SHL', operand_a, operand_b)
-        self.pc += 3
-
-    def handle_shr(self, operand_a, operand_b):
-        self.alu('SHR', operand_a, operand_b)
-        self.pc += 3
-
-    def handle_mod(self, operand_a, operand_b):
-        self.alu('MOD', operand_a, operand_b)
-        self.pc += 3
-
-    def iret(self):
+    def handle_tas(self, reg_a, reg_b):
+        '''
+        Test and set: load regA with the value at the address stored in regB,
+        and if it was 0, store 1 there. Atomic across cores, see multicore.py.
+        '''
+        address = self.reg[reg_b]
+        value = self.ram_read(address)
+        if value == 0:
+            self.ram_write(address, 1)
+        self.reg[reg_a] = value
+
+    def handle_int(self, reg_a, reg_b):
+        '''Issue the interrupt number stored in the given register.'''
+        self.reg[IS] |= 1 << (self.reg[reg_a] & 0b111)
+
+    def handle_iret(self, opa, opb):
         '''return from an interrupt handler.'''
 
         # registers R6-R0 are popped off the stack, in that order
         for i in range(6, -1, -1):
-            self.pop(i)
+            self.handle_pop(i, None)
         # FL register is popped off the stack
+        self.fl = self.pop_value()
         # return address is popped off the stack and stored in PC
+        self.pc = self.pop_value()
         # interrupts are re-enabled
-        pass
+        self.interrupts_enabled = True
+
+    def push_value(self, value):
+        '''Push a value (rather than a register) on the stack.'''
+        self.reg[self.sp] = (self.reg[self.sp] - 1) & 0xff
+        self.ram_write(self.reg[self.sp], value)
+
+    def pop_value(self):
+        '''Pop a value off the stack and return it.'''
+        value = self.ram_read(self.reg[self.sp])
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xff
+        return value
+
+    def poll_interrupts(self, stop):
+        """
+        Raise the timer and keyboard interrupts if they are due, and service
+        the lowest pending unmasked interrupt. Returns the cycle count at
+        which the next check is due, at most stop. Only called while IM is
+        nonzero, so programs without interrupts never pay for it.
+        """
+        reg = self.reg
+        cycles = self.cycles
+        # checks are at fixed instruction counts, so when they happen doesn't
+        # depend on how the run was sliced up
+        next_check = (cycles // POLL_INTERVAL + 1) * POLL_INTERVAL
+
+        # the timer
+        if self.virtual_time is not None:
+            # in virtual time the timer fires every time the instruction
+            # count reaches a multiple of the period; ticks that come while
+            # IM is 0 add up to one pending interrupt
+            period = self.virtual_time
+            if self.next_tick is not None and cycles >= self.next_tick:
+                reg[IS] |= 1 << TIMER_INTERRUPT
+            self.next_tick = (cycles // period + 1) * period
+            next_check = min(next_check, self.next_tick)
+        else:
+            now = time.perf_counter()
+            if self.next_tick is None:
+                self.next_tick = now + TIMER_PERIOD
+            elif now >= self.next_tick:
+                reg[IS] |= 1 << TIMER_INTERRUPT
+                self.next_tick = now + TIMER_PERIOD
+
+        # the keyboard: one key at a time, once the handler is done with the
+        # last one; in virtual time only on the fixed checks
+        if (self.keys and self.interrupts_enabled
+                and not reg[IS] & 1 << KEYBOARD_INTERRUPT
+                and (self.virtual_time is None or cycles % POLL_INTERVAL == 0)):
+            self.ram_write(KEY_ADDRESS, self.keys.popleft())
+            reg[IS] |= 1 << KEYBOARD_INTERRUPT
+
+        masked_interrupts = reg[IM] & reg[IS]
+        if masked_interrupts and self.interrupts_enabled:
+            # lowest set bit first
+            i = (masked_interrupts & -masked_interrupts).bit_length() - 1
+            self.interrupts_enabled = False
+            reg[IS] &= ~(1 << i) & 0xff
+            self.push_value(self.pc)
+            self.push_value(self.fl)
+            for r in range(7):
+                self.push_value(reg[r])
+            self.pc = self.ram_read(VECTOR_TABLE + i)
+
+        return min(stop, next_check)
 
     def trace(self):
         """
@@ -324,29 +545,257 @@ class CPU:
         for i in range(8):
             print(" %02X" % self.reg[i], end='')
 
+        if self.program is not None and self.program.source_map:
+            print(f"  {self.program.location(self.pc)}", end="")
+
         print()
 
-    def run(self):
-        """Run the CPU."""
-        running = True
+    def decode(self, address):
+        """
+        Decode the instruction at address into a cache entry. Returns None for
+        an unknown opcode.
+        """
+        ir = self.ram[address]
+        handler = self.branchtable[ir]
+        if handler is None:
+            return None
+
+        size = SIZES[ir]
+        # register operands are 00000rrr, so only the low three bits count
+        operand_a = self.ram[(address + 1) & 0xff] & 0b111
+        operand_b = self.ram[(address + 2) & 0xff]
+        if ir not in IMMEDIATE:
+            operand_b &= 0b111
+        if touches_interrupts(ir, operand_a):
+            handler = self.rescheduling(handler)
+        entry = (handler, operand_a, operand_b, (address + size) & 0xff)
+        self.decoded[address] = entry
+        for i in range(size):
+            self.code[(address + i) & 0xff] |= CODE_FLAG
+        return entry
+
+    def decode_fused(self, address):
+        """
+        Decode the instruction at address into a dispatch_table entry: the
+        decoded entry, or one running it and the instruction after it
+        together if they're a pair in FUSED. Returns None for an unknown
+        opcode.
+        """
+        entry = self.decoded[address] or self.decode(address)
+        if entry is None:
+            return None
+
+        ram = self.ram
+        ir = ram[address]
+        second_pc = entry[3]
+        second_ir = ram[second_pc]
+        make = FUSED.get((ir, second_ir)) if self.fuse else None
+        if make is not None and not touches_interrupts(ir, entry[1]):
+            second = self.decoded[second_pc] or self.decode(second_pc)
+            if second is not None and not touches_interrupts(second_ir, second[1]):
+                handler = make(self, (ir,) + entry[1:],
+                               (second_ir, second[1], second[2]), ALU_OPS)
+                if handler is not None:
+                    entry = (handler, 0, 0, second[3])
+
+        self.dispatch_table[address] = entry
+        return entry
+
+    def rescheduling(self, handler):
+        """Wrap handler to leave the dispatch loop once it has run."""
+
+        def handle_and_reschedule(operand_a, operand_b):
+            handler(operand_a, operand_b)
+            raise Reschedule
+
+        return handle_and_reschedule
+
+    def invalidate(self, mar):
+        """Drop every cached instruction that was decoded from address mar."""
+        decoded = self.decoded
+        for address in range(mar - 2, mar + 1):
+            address &= 0xff
+            entry = decoded[address]
+            # entry[3] is the next pc, so this is the instruction's length
+            if entry is not None and (mar - address) & 0xff < (entry[3] - address) & 0xff:
+                decoded[address] = None
+        # a fused pair is up to six bytes long
+        dispatch_table = self.dispatch_table
+        for address in range(mar - 5, mar + 1):
+            address &= 0xff
+            entry = dispatch_table[address]
+            if entry is not None and (mar - address) & 0xff < (entry[3] - address) & 0xff:
+                dispatch_table[address] = None
+        self.code[mar] &= DEVICE_FLAG
+
+    def flush_decoded(self):
+        """Empty the whole decode cache, e.g. after loading a new program."""
+        self.decoded[:] = [None] * 256
+        self.dispatch_table[:] = [None] * 256
+        self.code[:] = self.device_map
+
+    def execute(self, stop):
+        """
+        Run instructions until self.cycles reaches stop, handling interrupts.
+        Returns the reason the CPU stopped early, or None.
+        """
+        reg = self.reg
 
-        while running:
-            # read the mar stored in PC, and store in IR
-            ir = self.ram_read(self.pc)
-            operand_a = self.ram_read(self.pc + 1)
-            operand_b = self.ram_read(self.pc + 2)
+        while self.cycles < stop:
+            limit = stop
+            if reg[IM]:
+                limit = self.poll_interrupts(stop)
+            reason = self.dispatch(limit)
+            if reason is not None:
+                return reason
 
-            if ir in self.branchtable:
-                self.branchtable[ir](operand_a, operand_b)
-            else:
-                print('Unknown instruction')
-                print(ir, self.pc)
-                running = False
+        return None
+
+    def dispatch(self, stop):
+        """
+        The dispatch loop: run instructions until self.cycles reaches stop,
+        or an instruction touches the interrupt registers. Returns the reason
+        the CPU stopped early, or None.
+        """
+        if self.exact_cycles:
+            return self.dispatch_exact(stop)
+
+        dispatch_table = self.dispatch_table
+        cycles = self.cycles
+        # a fused pair runs two instructions, so it needs room for both
+        last = stop - 1
+
+        try:
+            while cycles < last:
+                entry = dispatch_table[self.pc]
+                if entry is None:
+                    entry = self.decode_fused(self.pc)
+                    if entry is None:
+                        return UNKNOWN_OPCODE
+
+                # advance the pc before running the handler, so instructions
+                # that set the pc themselves simply overwrite it; a fused
+                # handler returns the number of instructions it ran
+                handler, operand_a, operand_b, self.pc = entry
+                cycles += handler(operand_a, operand_b) or 1
+
+            if cycles < stop:
+                # one instruction to go, which runs on its own
+                entry = self.decoded[self.pc] or self.decode(self.pc)
+                if entry is None:
+                    return UNKNOWN_OPCODE
+                handler, operand_a, operand_b, self.pc = entry
+                handler(operand_a, operand_b)
+                cycles += 1
+        except Reschedule:
+            cycles += 1
+        except Halt as e:
+            cycles += 1
+            return e.reason
+        except ZeroDivisionError:
+            # point back at the DIV/MOD (3 bytes) that failed
+            self.pc = (self.pc - 3) & 0xff
+            return DIVISION_BY_ZERO
+        finally:
+            self.cycles = cycles
+
+        return None
+
+    def dispatch_exact(self, stop):
+        """
+        The dispatch loop for CPUs with a device that reads self.cycles:
+        like dispatch(), but without fused pairs, and self.cycles is kept
+        up to date as every instruction runs.
+        """
+        decoded = self.decoded
+
+        try:
+            while self.cycles < stop:
+                entry = decoded[self.pc] or self.decode(self.pc)
+                if entry is None:
+                    return UNKNOWN_OPCODE
+
+                handler, operand_a, operand_b, self.pc = entry
+                handler(operand_a, operand_b)
+                self.cycles += 1
+        except Reschedule:
+            self.cycles += 1
+        except Halt as e:
+            self.cycles += 1
+            return e.reason
+        except ZeroDivisionError:
+            self.pc = (self.pc - 3) & 0xff
+            return DIVISION_BY_ZERO
+
+        return None
+
+    def step(self):
+        """Execute one instruction. Returns the reason the CPU stopped, or None."""
+        return CPU.execute(self, self.cycles + 1)
+
+    def run(self, max_cycles=None, max_time=None):
+        """
+        Run the CPU until it halts, or until max_cycles instructions or
+        max_time seconds have gone by. Returns a RunResult. A run that ran out
+        of budget can be resumed by calling run() again.
+        """
+        start = self.cycles
+        started = time.perf_counter()
+        limit = float('inf') if max_cycles is None else start + max_cycles
+        deadline = None if max_time is None else started + max_time
+        next_flush = started + FLUSH_INTERVAL
+
+        while True:
+            reason = self.execute(min(limit, self.cycles + TIME_SLICE))
+            if reason is not None:
+                break
+            if self.cycles >= limit:
+                reason = BUDGET
+                break
+            now = time.perf_counter()
+            if deadline is not None and now >= deadline:
+                reason = BUDGET
+                break
+            if now >= next_flush:
+                self.output.flush()
+                next_flush = now + FLUSH_INTERVAL
+
+        self.output.flush()
+        return RunResult(self, reason, self.cycles - start,
+                         time.perf_counter() - started)
 
     def ram_read(self, mar):
         '''Return value stored at address (mar) param.'''
+        device = self.devices[mar]
+        if device is not None:
+            return device.read(mar)
         return self.ram[mar]
 
     def ram_write(self, mar, mdr):
         '''Should write given value (mdr) to given address (mar).'''
-        self.ram[mar] = mdr
\ No newline at end of file
+        self.ram[mar] = mdr
+        if self.code[mar]:
+            self.written(mar)
+
+    def written(self, mar):
+        """
+        Act on a store to an address with flags in self.code: drop the code
+        cached from it, and hand the byte to the device mapped there.
+        """
+        flags = self.code[mar]
+        if flags & CODE_FLAG:
+            self.invalidate(mar)
+        if flags & DEVICE_FLAG:
+            self.devices[mar].write(mar, self.ram[mar])
+
+    def attach(self, device, addresses):
+        """Map device at addresses, see mmio.Device."""
+        for address in addresses:
+            if self.devices[address] is not None:
+                raise ValueError(f"address {address:02X} already has a device")
+            self.devices[address] = device
+            self.device_map[address] = DEVICE_FLAG
+            self.code[address] |= DEVICE_FLAG
+        self.mapped = True
+        if device.needs_cycles:
+            self.exact_cycles = True
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+
+"""
+Breakpoints, watchpoints and a monitor to drive them.
+
+A Debugger attached to a CPU stops it at breakpoints on a PC, optionally
+only while a register condition holds ("R0 == 5"), at conditions checked
+on every instruction, and at watchpoints on loads from and stores to an
+address or range of addresses. run() then returns with the reason
+BREAKPOINT, and Debugger.hit says which one it was.
+
+None of that is checked in the CPU's own loops. While anything is set, the
+debugger installs its own dispatch loop and ram_read()/ram_write() on the
+CPU instance, which shadow the class's; once everything is deleted it takes
+them away again, and the CPU runs exactly as fast as one that was never
+debugged. The instrumented loop runs every instruction on its own, without
+superinstructions or JIT blocks, so all loads and stores go through
+ram_read() and ram_write().
+
+Monitor is a command line for it, interactive or fed a script:
+
+    debugger.py program.asm
+    debugger.py program.asm -x commands.txt
+
+Usage: debugger.py [-x SCRIPT] program
+"""
+
+import argparse
+import cmd
+import operator
+import re
+import sys
+
+from cpu import *
+from jit import JITCPU
+from output import CaptureOutput
+from tracedump import disassemble
+
+# comparisons a condition can make
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+CONDITION = re.compile(r"\s*R([0-7])\s*(==|!=|<=|>=|<|>)\s*(\w+)\s*$", re.I)
+
+
+class Condition:
+    """A test of a register against a value, e.g. R0 == 5."""
+
+    def __init__(self, register, op, value):
+        self.register = register
+        self.op = op
+        self.value = value
+        self.test = COMPARISONS[op]
+
+    @classmethod
+    def parse(cls, text):
+        m = CONDITION.match(text)
+        if m is None:
+            raise ValueError(f"bad condition {text!r}, try e.g. R0 == 5")
+        return cls(int(m.group(1)), m.group(2), parse_number(m.group(3)))
+
+    def __call__(self, reg):
+        return self.test(reg[self.register], self.value)
+
+    def __str__(self):
+        return f"R{self.register} {self.op} {self.value}"
+
+
+class Breakpoint:
+    """
+    A breakpoint at address, or with address None on every instruction,
+    taken when condition (a Condition or None) holds.
+    """
+
+    def __init__(self, number, address, condition=None):
+        self.number = number
+        self.address = address
+        self.condition = condition
+
+    def __str__(self):
+        where = "anywhere" if self.address is None else f"at {self.address:02X}"
+        when = "" if self.condition is None else f" if {self.condition}"
+        return f"#{self.number} break {where}{when}"
+
+
+class Watchpoint:
+    """A watchpoint on loads and/or stores to addresses start-end."""
+
+    def __init__(self, number, start, end, read, write):
+        self.number = number
+        self.start = start
+        self.end = end
+        self.read = read
+        self.write = write
+
+    def __contains__(self, address):
+        return self.start <= address <= self.end
+
+    def __str__(self):
+        kind = "r" * self.read + "w" * self.write
+        where = f"{self.start:02X}"
+        if self.end != self.start:
+            where += f"-{self.end:02X}"
+        return f"#{self.number} watch {kind} {where}"
+
+
+def parse_number(text, symbols=None):
+    """A number in any base Python takes, or a label in symbols."""
+    if symbols:
+        # the assembler keeps labels in upper case
+        for name in (text, text.upper()):
+            if name in symbols:
+                return symbols[name]
+    return int(text, 0)
+
+
+class Debugger:
+    """Breakpoints and watchpoints on a CPU (or JITCPU)."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.numbers = 0
+        self.breakpoints = {}  # number -> Breakpoint
+        self.watchpoints = {}  # number -> Watchpoint
+        # what the instrumented loop checks: the breakpoints by address,
+        # those with no address, and flags per address for watched loads
+        # and stores
+        self.at = {}
+        self.anywhere = []
+        self.watch_reads = bytearray(256)
+        self.watch_writes = bytearray(256)
+        # watchpoints hit by the instruction running, as (Watchpoint, kind,
+        # address, value)
+        self.accesses = []
+        # why the CPU last stopped, and where: a breakpoint isn't taken
+        # again straight away when the CPU goes on from it
+        self.hit = None
+        self.stopped_at = None
+
+        cls = type(cpu)
+        self.class_ram_read = cls.ram_read.__get__(cpu)
+        self.class_ram_write = cls.ram_write.__get__(cpu)
+
+    def add_breakpoint(self, address=None, condition=None):
+        """Break at address (or anywhere) when condition holds (or always)."""
+        self.numbers += 1
+        bp = Breakpoint(self.numbers, address, condition)
+        self.breakpoints[bp.number] = bp
+        self.update()
+        return bp
+
+    def add_watchpoint(self, start, end=None, read=False, write=True):
+        """Break after a load and/or store to any address start-end."""
+        self.numbers += 1
+        wp = Watchpoint(self.numbers, start, start if end is None else end,
+                        read, write)
+        self.watchpoints[wp.number] = wp
+        self.update()
+        return wp
+
+    def delete(self, number=None):
+        """Delete a breakpoint or watchpoint by number, or all of them."""
+        if number is None:
+            self.breakpoints.clear()
+            self.watchpoints.clear()
+        elif self.breakpoints.pop(number, None) is None:
+            if self.watchpoints.pop(number, None) is None:
+                raise KeyError(f"no breakpoint #{number}")
+        self.update()
+
+    @property
+    def enabled(self):
+        """True while anything is set, and the CPU runs instrumented."""
+        return bool(self.breakpoints or self.watchpoints)
+
+    def update(self):
+        """Rebuild the tables, and switch the CPU's loop to match."""
+        self.at = {}
+        self.anywhere = []
+        for bp in self.breakpoints.values():
+            if bp.address is None:
+                self.anywhere.append(bp)
+            else:
+                self.at.setdefault(bp.address, []).append(bp)
+
+        self.watch_reads[:] = bytes(256)
+        self.watch_writes[:] = bytes(256)
+        for wp in self.watchpoints.values():
+            for address in range(wp.start, wp.end + 1):
+                self.watch_reads[address] |= wp.read
+                self.watch_writes[address] |= wp.write
+
+        cpu = self.cpu
+        for name in ("execute", "dispatch", "ram_read", "ram_write"):
+            cpu.__dict__.pop(name, None)
+        if self.enabled:
+            # the plain execute loop, also on a JITCPU, with this dispatch
+            cpu.execute = CPU.execute.__get__(cpu)
+            cpu.dispatch = self.dispatch
+        if self.watchpoints:
+            cpu.ram_read = self.ram_read
+            cpu.ram_write = self.ram_write
+
+    def ram_read(self, mar):
+        value = self.class_ram_read(mar)
+        if self.watch_reads[mar]:
+            self.accessed("read", mar, value)
+        return value
+
+    def ram_write(self, mar, mdr):
+        self.class_ram_write(mar, mdr)
+        if self.watch_writes[mar]:
+            self.accessed("write", mar, mdr)
+
+    def accessed(self, kind, address, value):
+        for wp in self.watchpoints.values():
+            if address in wp and getattr(wp, kind):
+                self.accesses.append((wp, kind, address, value))
+
+    def breakpoint(self):
+        """The breakpoint to take before the instruction at the PC, or None."""
+        cpu = self.cpu
+        if self.stopped_at == (cpu.pc, cpu.cycles):
+            return None
+        for bp in self.at.get(cpu.pc, ()):
+            if bp.condition is None or bp.condition(cpu.reg):
+                return bp
+        for bp in self.anywhere:
+            if bp.condition is None or bp.condition(cpu.reg):
+                return bp
+        return None
+
+    def stop(self, hit):
+        self.hit = hit
+        self.stopped_at = (self.cpu.pc, self.cpu.cycles)
+        return BREAKPOINT
+
+    def dispatch(self, stop):
+        """CPU.dispatch(), checking breakpoints and watchpoints as it goes."""
+        cpu = self.cpu
+        decoded = cpu.decoded
+        accesses = self.accesses
+
+        try:
+            while cpu.cycles < stop:
+                # an interrupt coming in can store to a watched address
+                if accesses:
+                    return self.stop(self.watch_hit())
+                bp = self.breakpoint()
+                if bp is not None:
+                    return self.stop(bp)
+
+                entry = decoded[cpu.pc] or cpu.decode(cpu.pc)
+                if entry is None:
+                    return UNKNOWN_OPCODE
+                handler, operand_a, operand_b, cpu.pc = entry
+                handler(operand_a, operand_b)
+                cpu.cycles += 1
+
+                if accesses:
+                    return self.stop(self.watch_hit())
+        except Reschedule:
+            cpu.cycles += 1
+        except Halt as e:
+            cpu.cycles += 1
+            return e.reason
+        except ZeroDivisionError:
+            cpu.pc = (cpu.pc - 3) & 0xff
+            return DIVISION_BY_ZERO
+
+        return None
+
+    def watch_hit(self):
+        """Describe the watched accesses so far, and forget them."""
+        text = "; ".join(f"#{wp.number} {kind} {address:02X} = {value:02X}"
+                         for wp, kind, address, value in self.accesses)
+        self.accesses.clear()
+        return text
+
+
+class Monitor(cmd.Cmd):
+    """An interactive (or scripted) command line for a Debugger."""
+
+    intro = "LS-8 monitor. Type help or ? for the commands."
+    prompt = "(ls8) "
+
+    def __init__(self, cpu, stdin=None, stdout=None):
+        super().__init__(stdin=stdin, stdout=stdout)
+        if stdin is not None:
+            self.use_rawinput = False
+            self.intro = None
+            self.prompt = ""
+        self.cpu = cpu
+        self.debugger = Debugger(cpu)
+
+    @property
+    def symbols(self):
+        program = self.cpu.program
+        return program.symbols if program is not None else {}
+
+    def print(self, *args):
+        print(*args, file=self.stdout)
+
+    def address(self, text):
+        return parse_number(text, self.symbols) & 0xff
+
+    def onecmd(self, line):
+        try:
+            return super().onecmd(line)
+        except (ValueError, KeyError) as e:
+            self.print(f"error: {e}")
+
+    def emptyline(self):
+        pass
+
+    def where(self):
+        """The PC, and where that is in the program if it's known."""
+        cpu = self.cpu
+        if cpu.program is None:
+            return f"{cpu.pc:02X}"
+        return cpu.program.location(cpu.pc)
+
+    def instruction(self, address):
+        """(length, assembly) of the instruction at address."""
+        ram = self.cpu.ram
+        ir = ram[address]
+        return SIZES[ir], disassemble(ir, ram[(address + 1) & 0xff],
+                                      ram[(address + 2) & 0xff])
+
+    def run(self, max_cycles=None):
+        cpu = self.cpu
+        capture = CaptureOutput()
+        output = cpu.output
+        cpu.output = capture
+        try:
+            result = cpu.run(max_cycles=max_cycles)
+        finally:
+            cpu.output = output
+        text = capture.getvalue()
+        self.stdout.write(text)
+        if text and not text.endswith("\n"):
+            self.stdout.write("\n")
+        self.show(result)
+        return result
+
+    def show(self, result):
+        if result.reason == BREAKPOINT:
+            self.print(f"stopped: {self.debugger.hit}")
+        elif result.reason != BUDGET:
+            self.print(f"{result.reason} after {self.cpu.cycles} instructions")
+        self.print(f"{self.where()}: {self.instruction(self.cpu.pc)[1]}")
+
+    def do_break(self, arg):
+        """break [ADDRESS] [if CONDITION]: break at ADDRESS (a number or a
+        label), or on any instruction, when CONDITION (e.g. R0 == 5) holds"""
+        where, *condition = re.split(r"\bif\b", arg, maxsplit=1)
+        address = self.address(where.strip()) if where.strip() else None
+        condition = Condition.parse(condition[0]) if condition else None
+        if address is None and condition is None:
+            raise ValueError("break needs an address, a condition or both")
+        self.print(self.debugger.add_breakpoint(address, condition))
+
+    def do_watch(self, arg):
+        """watch [r|w|rw] ADDRESS[-END]: break after loads (r) and/or
+        stores (w, the default) to ADDRESS, or ADDRESS to END"""
+        words = arg.split()
+        kind = "w"
+        if len(words) == 2:
+            kind = words.pop(0)
+        if len(words) != 1 or not set(kind) <= set("rw"):
+            raise ValueError("usage: watch [r|w|rw] ADDRESS[-END]")
+        start, _, end = words[0].partition("-")
+        self.print(self.debugger.add_watchpoint(
+            self.address(start), self.address(end) if end else None,
+            read="r" in kind, write="w" in kind))
+
+    def do_delete(self, arg):
+        """delete [N]: delete breakpoint or watchpoint N, or all of them"""
+        self.debugger.delete(int(arg) if arg.strip() else None)
+
+    def do_info(self, arg):
+        """info: list the breakpoints and watchpoints"""
+        points = {**self.debugger.breakpoints, **self.debugger.watchpoints}
+        for number in sorted(points):
+            self.print(points[number])
+        if not points:
+            self.print("no breakpoints or watchpoints")
+
+    def do_step(self, arg):
+        """step [N]: run N instructions (default 1)"""
+        self.run(int(arg) if arg.strip() else 1)
+
+    def do_continue(self, arg):
+        """continue [N]: run until something stops the CPU, or for at most N
+        instructions"""
+        self.run(int(arg) if arg.strip() else None)
+
+    do_s = do_step
+    do_c = do_continue
+
+    def do_regs(self, arg):
+        """regs: show the registers, PC and FL"""
+        cpu = self.cpu
+        self.print(" ".join(f"R{i}={v:02X}" for i, v in enumerate(cpu.reg)))
+        self.print(f"PC={cpu.pc:02X} FL={cpu.fl:03b} "
+                   f"cycles={cpu.cycles}")
+
+    def do_mem(self, arg):
+        """mem ADDRESS [LENGTH]: dump LENGTH bytes of RAM (default 16)"""
+        words = arg.split()
+        if not words:
+            raise ValueError("usage: mem ADDRESS [LENGTH]")
+        start = self.address(words[0])
+        length = int(words[1], 0) if len(words) > 1 else 16
+        ram = self.cpu.ram
+        for row in range(start, min(start + length, 256), 16):
+            end = min(row + 16, start + length, 256)
+            self.print(f"{row:02X}: " + " ".join(f"{ram[a]:02X}" for a in range(row, end)))
+
+    def do_dis(self, arg):
+        """dis [ADDRESS] [N]: disassemble N instructions (default 8) from
+        ADDRESS (default the PC)"""
+        words = arg.split()
+        address = self.address(words[0]) if words else self.cpu.pc
+        count = int(words[1], 0) if len(words) > 1 else 8
+        for _ in range(count):
+            size, text = self.instruction(address)
+            mark = "=>" if address == self.cpu.pc else "  "
+            label = ""
+            if self.cpu.program is not None:
+                label = self.cpu.program.label(address) or ""
+            self.print(f"{mark} {address:02X}  {text:<14} {label}".rstrip())
+            address = (address + size) & 0xff
+
+    def do_quit(self, arg):
+        """quit: leave the monitor"""
+        return True
+
+    do_q = do_quit
+    do_EOF = do_quit
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Debug an LS-8 program from a monitor.")
+    parser.add_argument("program", help="the .asm, .ls8 or .ls8b file to debug")
+    parser.add_argument("-x", "--script", metavar="FILE",
+                        help="read monitor commands from FILE instead of the terminal")
+    parser.add_argument("--jit", action="store_true",
+                        help="run on the basic-block JIT between stops")
+    parser.add_argument("--virtual-time", type=int, metavar="N",
+                        help="fire the timer every N instructions instead of every second")
+    args = parser.parse_args(argv[1:])
+
+    cpu_class = JITCPU if args.jit else CPU
+    cpu = cpu_class(virtual_time=args.virtual_time)
+    cpu.load(args.program)
+
+    stdin = open(args.script) if args.script else None
+    Monitor(cpu, stdin=stdin).cmdloop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
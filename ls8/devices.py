@@ -0,0 +1,272 @@
+"""
+asyncio device layer.
+
+Machine runs a CPU on an asyncio event loop, a slice of instructions at a
+time, so input devices get serviced between slices without threads or
+polling inside the dispatch loop. Devices hand keystrokes to Machine.press(),
+and the CPU delivers them to 0xF4 and raises I1 (see CPU.poll_interrupts).
+
+After every slice the machine probes for a guest that is only waiting for an
+interrupt: it steps a few instructions and checks whether the whole machine
+state comes round again without any output, as with a JMP to itself or a
+short polling loop. Nothing but an interrupt can get such a guest out, so
+rather than spin, the machine suspends on the event loop until a key comes
+in or the timer is due. With virtual time it skips whole trips round the
+loop up to the next tick instead, which leaves the outcome unchanged.
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+from cpu import *
+
+# instructions run between trips through the event loop
+SLICE = 10000
+
+# the longest loop, in instructions, the idle probe recognises
+PROBE_WINDOW = 32
+
+
+class Machine:
+    """A CPU plus the devices that feed it, run on an asyncio event loop."""
+
+    def __init__(self, cpu, slice=SLICE):
+        self.cpu = cpu
+        self.slice = slice
+        # set whenever a device has something for the CPU
+        self.wakeup = asyncio.Event()
+        # input devices that might still send keys
+        self.inputs = 0
+        # seconds spent suspended while the guest was idle
+        self.idle_time = 0.0
+
+    def press(self, keys):
+        """Queue keystrokes for the keyboard interrupt."""
+        self.cpu.press(keys)
+        self.wakeup.set()
+
+    def open_input(self):
+        self.inputs += 1
+
+    def close_input(self):
+        self.inputs -= 1
+        self.wakeup.set()
+
+    def state(self):
+        """Everything that decides what the CPU does next."""
+        cpu = self.cpu
+        return (cpu.pc, cpu.fl, cpu.interrupts_enabled, bytes(cpu.reg),
+                bytes(cpu.ram))
+
+    def probe(self):
+        """
+        Step up to PROBE_WINDOW instructions, looking for the CPU to come back
+        to the state it started in without producing output. Returns
+        (length, reason): the length of the loop, 0 if there isn't one, and
+        the reason the CPU stopped, if it did.
+        """
+        cpu = self.cpu
+        start = self.state()
+        output = []
+        cpu.emit = output.append
+
+        try:
+            for length in range(1, PROBE_WINDOW + 1):
+                reason = cpu.step()
+                if reason is not None or output:
+                    return 0, reason
+                if self.state() == start:
+                    return length, None
+        finally:
+            cpu.emit = cpu.output.write
+            for data in output:
+                cpu.emit(data)
+
+        return 0, None
+
+    async def idle(self, length, limit, deadline):
+        """
+        The guest is going round a loop of length instructions that only an
+        interrupt can break. Wait until one might come. Returns IDLE if none
+        ever can, else None.
+        """
+        cpu = self.cpu
+        im = cpu.reg[IM] if cpu.interrupts_enabled else 0
+        timer = im & 1 << TIMER_INTERRUPT
+        keyboard = im & 1 << KEYBOARD_INTERRUPT
+
+        if keyboard and cpu.keys:
+            # about to be delivered
+            return None
+
+        if cpu.virtual_time is not None:
+            # virtual time only moves as instructions run, so skip whole
+            # trips round the loop, which leave the state as it is
+            if timer:
+                target = min(cpu.next_tick, limit)
+                cpu.cycles += (target - cpu.cycles) // length * length
+                return None
+            if not (keyboard and self.inputs):
+                return IDLE
+            self.wakeup.clear()
+            await self.suspend(None if deadline is None
+                               else deadline - time.perf_counter())
+            return None
+
+        if not (timer or keyboard and self.inputs):
+            return IDLE
+
+        now = time.perf_counter()
+        timeout = cpu.next_tick - now if timer else None
+        if deadline is not None:
+            timeout = deadline - now if timeout is None else min(timeout, deadline - now)
+        self.wakeup.clear()
+        await self.suspend(timeout)
+        return None
+
+    async def suspend(self, timeout):
+        """Sleep until a device wakes the machine up, or timeout seconds."""
+        suspended = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(),
+                                   None if timeout is None else max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+        self.idle_time += time.perf_counter() - suspended
+
+    async def run(self, max_cycles=None, max_time=None):
+        """
+        Like CPU.run(), but yields to the event loop between slices and
+        sleeps while the guest is idle. A guest that waits for an interrupt
+        that can never come (IM is 0, or the input is closed) stops with
+        IDLE.
+        """
+        cpu = self.cpu
+        start = cpu.cycles
+        started = time.perf_counter()
+        limit = float('inf') if max_cycles is None else start + max_cycles
+        deadline = None if max_time is None else started + max_time
+
+        while True:
+            reason = cpu.execute(min(limit, cpu.cycles + self.slice))
+            cpu.output.flush()
+
+            if reason is None and cpu.cycles + PROBE_WINDOW <= limit:
+                length, reason = self.probe()
+                if length:
+                    reason = await self.idle(length, limit, deadline)
+
+            if reason is None and (cpu.cycles >= limit or (
+                    deadline is not None and time.perf_counter() >= deadline)):
+                reason = BUDGET
+            if reason is not None:
+                break
+
+            await asyncio.sleep(0)
+
+        cpu.output.flush()
+        return RunResult(cpu, reason, cpu.cycles - start,
+                         time.perf_counter() - started)
+
+
+class StdinKeyboard:
+    """
+    Keystrokes from stdin, read without blocking as the event loop sees them
+    arrive. A terminal is put in cbreak mode so keys come through as they're
+    typed, not a line at a time.
+    """
+
+    def __init__(self, machine, fd=None):
+        self.machine = machine
+        self.fd = sys.stdin.fileno() if fd is None else fd
+        self.saved_mode = None
+        self.open = False
+
+    def start(self):
+        self.machine.open_input()
+        self.open = True
+
+        if os.isatty(self.fd):
+            try:
+                import termios
+                import tty
+            except ImportError:  # not on Unix
+                pass
+            else:
+                self.saved_mode = termios.tcgetattr(self.fd)
+                tty.setcbreak(self.fd)
+
+        try:
+            asyncio.get_running_loop().add_reader(self.fd, self.readable)
+        except (PermissionError, NotImplementedError):
+            # a regular file, which is always readable: take it all now
+            self.machine.press(os.read(self.fd, 1 << 16))
+            self.stop()
+
+    def readable(self):
+        data = os.read(self.fd, 1024)
+        if data:
+            self.machine.press(data)
+        else:
+            self.stop()
+
+    def stop(self):
+        if not self.open:
+            return
+        self.open = False
+        try:
+            asyncio.get_running_loop().remove_reader(self.fd)
+        except (ValueError, NotImplementedError, RuntimeError):
+            pass
+        if self.saved_mode is not None:
+            import termios
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved_mode)
+            self.saved_mode = None
+        self.machine.close_input()
+
+
+class ScriptedKeyboard:
+    """
+    Types a script for tests: a list of (delay, keys) pairs, each pressing
+    keys delay seconds after the previous one.
+    """
+
+    def __init__(self, machine, script):
+        self.machine = machine
+        self.script = list(script)
+        self.task = None
+
+    def start(self):
+        self.machine.open_input()
+        self.task = asyncio.get_running_loop().create_task(self.type())
+
+    async def type(self):
+        try:
+            for delay, keys in self.script:
+                await asyncio.sleep(delay)
+                self.machine.press(keys)
+        finally:
+            self.machine.close_input()
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+async def run_with_devices(cpu, devices=(StdinKeyboard,), max_cycles=None,
+                           max_time=None):
+    """
+    Run cpu on a Machine with the given devices (classes taking the machine)
+    attached, and return the RunResult.
+    """
+    machine = Machine(cpu)
+    attached = [device(machine) for device in devices]
+    for device in attached:
+        device.start()
+    try:
+        return await machine.run(max_cycles, max_time)
+    finally:
+        for device in attached:
+            device.stop()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+Differential test for superinstructions (see fusion.py).
+
+Every program runs on two interpreters in lockstep, one with fused pairs
+and one without, for the same random slices of instructions at a time, so
+a fused pair also gets split across the end of a slice. After every slice
+both must be in the same state (the whole snapshot: RAM, registers, PC, FL,
+cycle count, keys) and have stopped for the same reason with the same
+output.
+
+The programs are the examples, with keys to read, and random programs
+made mostly of the instructions that get fused.
+
+Usage: fusecheck.py [--random N] [--seed S] [file ...]
+"""
+
+import argparse
+import glob
+import os
+import random
+import sys
+
+from cpu import *
+from fusion import FUSED
+from output import CaptureOutput
+from program import Program, read as read_program
+
+# instructions to run each example, and each random program, for
+MAX_CYCLES = 30000
+RANDOM_CYCLES = 3000
+
+# keystrokes for programs that read the keyboard
+KEYS = b"abc"
+
+# slice lengths, in instructions
+SLICES = (1, 2, 3, 7, 100, 1001)
+
+# what random programs are made of: everything in a fused pair, and the
+# loads and stores that break them up, mostly in the pairs themselves
+RANDOM_OPCODES = sorted({op for pair in FUSED for op in pair} | {LD, ST, PRN})
+PAIRS = sorted(FUSED)
+
+
+def random_instruction(rng, ram, address, ir):
+    """Put ir at address with random operands. Returns the next address."""
+    ram[address] = ir
+    if ir == LDI:
+        ram[address + 1] = rng.randrange(5) if rng.random() < 0.7 else rng.randrange(8)
+        ram[address + 2] = rng.randrange(200) if rng.random() < 0.8 else rng.randrange(256)
+    else:
+        ram[address + 1] = rng.randrange(8) if rng.random() < 0.9 else rng.randrange(256)
+        ram[address + 2] = rng.randrange(8)
+    return address + SIZES[ir]
+
+
+def random_program(rng):
+    """
+    Random instructions up to address 200, mostly in the pairs that get
+    fused, then random bytes. Register operands are mostly valid and LDI
+    mostly loads an address in the code.
+    """
+    ram = bytearray(rng.randrange(256) for _ in range(256))
+    address = 0
+    while address < 200:
+        if rng.random() < 0.7:
+            pair = rng.choice(PAIRS)
+        else:
+            pair = (rng.choice(RANDOM_OPCODES),)
+        for ir in pair:
+            address = random_instruction(rng, ram, address, ir)
+    return Program(bytes(ram))
+
+
+def compare(program, rng, max_cycles, virtual_time=None, keys=b""):
+    """Check one program. Returns a list of the differences found."""
+    fused, plain = [CPU(output=CaptureOutput(), virtual_time=virtual_time,
+                        fuse=fuse) for fuse in (True, False)]
+    for cpu in fused, plain:
+        cpu.load_program(program)
+        cpu.press(keys)
+
+    done = 0
+    while done < max_cycles:
+        n = rng.choice(SLICES)
+        a = fused.run(max_cycles=n)
+        b = plain.run(max_cycles=n)
+        problems = []
+        if a.reason != b.reason:
+            problems.append(f"stopped with {a.reason}, unfused {b.reason}")
+        if fused.snapshot() != plain.snapshot():
+            problems.append(f"state {a}, unfused {b}")
+        if a.output != b.output:
+            problems.append("output differs")
+        if problems:
+            return [f"after {plain.cycles} instructions: {problem}"
+                    for problem in problems]
+        if a.reason != BUDGET:
+            break
+        done += n
+    return []
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Check that fused pairs do what the two instructions do.")
+    parser.add_argument("files", nargs="*",
+                        help="programs to check (default: the examples)")
+    parser.add_argument("--random", type=int, default=3000, metavar="N",
+                        help="random programs to check (default: 3000)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first random program")
+    args = parser.parse_args(argv[1:])
+
+    files = args.files or sorted(
+        glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "examples", "*.ls8")))
+
+    failures = 0
+    for path in files:
+        program = read_program(path)
+        problems = []
+        for seed in range(3):
+            problems = compare(program, random.Random(seed), MAX_CYCLES,
+                               virtual_time=777, keys=KEYS)
+            if problems:
+                break
+        print(f"{os.path.basename(path):<20} {'FAIL' if problems else 'ok'}")
+        for problem in problems:
+            print(f"    {problem}")
+        failures += bool(problems)
+
+    random_failures = 0
+    for seed in range(args.seed, args.seed + args.random):
+        rng = random.Random(seed)
+        problems = compare(random_program(rng), rng, RANDOM_CYCLES)
+        if problems:
+            print(f"random seed {seed:<8} FAIL")
+            for problem in problems:
+                print(f"    {problem}")
+            random_failures += 1
+    if args.random:
+        print(f"{args.random} random programs, {random_failures} failed")
+
+    return 1 if failures or random_failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
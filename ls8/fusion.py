@@ -0,0 +1,260 @@
+"""
+Superinstructions: pairs of instructions the dispatch loop runs as one.
+
+When CPU.dispatch() first meets an instruction that starts one of the pairs
+in FUSED, it builds a single handler that does the work of both, with the
+operands baked in, and caches it in place of the first instruction. The
+pair then costs one trip round the loop and one call instead of two of
+each.
+
+A fused handler leaves the registers, flags, memory and PC exactly as the
+two instructions would, and returns 2 so the loop counts both. If the first
+of the two stores to an address with flags in CPU.code (decoded code or a
+device), the handler stops after it and returns 1, and the second is decoded
+again before it runs. Pairs that load from memory aren't fused while
+devices are mapped, since a load might be a device read.
+
+The pairs are the most frequent ones in the profiles of the examples and
+the bench workloads (see profiler.py, which counts opcode pairs):
+
+* CMP then a conditional jump
+* LDI then JMP, a conditional jump, or CALL (loading the target first)
+* an ALU operation, LD or LDI then CMP (a counter, then testing it)
+* LDI then an ALU operation
+* PUSH then PUSH, POP then POP, and PUSH then CALL
+
+Instructions that touch the interrupt registers (see touches_interrupts()),
+DIV and MOD, which can fail, and HLT are never fused.
+"""
+
+from opcodes import *
+
+SP = 7
+
+# what the conditional jumps test, exactly as CPU.handle_jeq() and friends
+CONDITIONS = {
+    JEQ: lambda fl: fl & 0b00000001,
+    JNE: lambda fl: not fl & 0b00000001,
+    JGT: lambda fl: fl >> 1 == 1,
+    JLT: lambda fl: fl >> 2,
+    JGE: lambda fl: fl >> 1 == 1 or fl & 0b00000001,
+    JLE: lambda fl: fl >> 2 or fl & 0b00000001,
+}
+
+# for each conditional jump, whether it's taken for each value of FL
+TAKEN = {ir: tuple(bool(condition(fl)) for fl in range(256))
+         for ir, condition in CONDITIONS.items()}
+
+# the ALU operations that can be fused: they only ever set a register
+FUSIBLE_ALU = {ADD, SUB, MUL, INC, DEC, AND, NOT, OR, XOR, SHL, SHR}
+
+
+def cmp_jcc(cpu, first, second, alu_ops):
+    reg = cpu.reg
+    _, a, b, _ = first
+    ir, target, _ = second
+    # CMP leaves exactly one flag set, so whether the jump is taken only
+    # depends on which
+    on_equal = TAKEN[ir][0b001]
+    on_greater = TAKEN[ir][0b010]
+    on_less = TAKEN[ir][0b100]
+
+    def fused(operand_a, operand_b):
+        diff = reg[a] - reg[b]
+        if diff == 0:
+            cpu.fl = 0b00000001
+            taken = on_equal
+        elif diff > 0:
+            cpu.fl = 0b00000010
+            taken = on_greater
+        else:
+            cpu.fl = 0b00000100
+            taken = on_less
+        if taken:
+            cpu.pc = reg[target]
+        return 2
+
+    return fused
+
+
+def ldi_jump(cpu, first, second, alu_ops):
+    reg = cpu.reg
+    _, a, value, _ = first
+    ir, target, _ = second
+
+    if ir == JMP:
+        def fused(operand_a, operand_b):
+            reg[a] = value
+            cpu.pc = reg[target]
+            return 2
+    else:
+        taken = TAKEN[ir]
+
+        def fused(operand_a, operand_b):
+            reg[a] = value
+            if taken[cpu.fl]:
+                cpu.pc = reg[target]
+            return 2
+
+    return fused
+
+
+def ldi_call(cpu, first, second, alu_ops):
+    reg = cpu.reg
+    ram = cpu.ram
+    code = cpu.code
+    _, a, value, _ = first
+    _, target, _ = second
+
+    def fused(operand_a, operand_b):
+        reg[a] = value
+        # the dispatch loop has already pointed the pc past the CALL, which
+        # is the return address
+        sp = reg[SP] = (reg[SP] - 1) & 0xff
+        ram[sp] = cpu.pc
+        if code[sp]:
+            cpu.written(sp)
+        cpu.pc = reg[target]
+        return 2
+
+    return fused
+
+
+def set_then_cmp(cpu, first, second, alu_ops):
+    """An ALU operation, LD or LDI, then CMP."""
+    reg = cpu.reg
+    ram = cpu.ram
+    ir, a, b, _ = first
+    _, c, d = second
+
+    if ir == LD and cpu.mapped:
+        # the load might be from a device
+        return None
+
+    if ir == LDI:
+        def fused(operand_a, operand_b):
+            reg[a] = b
+            # CMP, as CPU.handle_cmp()
+            diff = reg[c] - reg[d]
+            if diff == 0:
+                cpu.fl = 0b00000001
+            elif diff > 0:
+                cpu.fl = 0b00000010
+            else:
+                cpu.fl = 0b00000100
+            return 2
+    elif ir == LD:
+        def fused(operand_a, operand_b):
+            reg[a] = ram[reg[b]]
+            # CMP, as CPU.handle_cmp()
+            diff = reg[c] - reg[d]
+            if diff == 0:
+                cpu.fl = 0b00000001
+            elif diff > 0:
+                cpu.fl = 0b00000010
+            else:
+                cpu.fl = 0b00000100
+            return 2
+    else:
+        fn = alu_ops[instruction_id(ir)]
+
+        def fused(operand_a, operand_b):
+            reg[a] = fn(reg[a], reg[b])
+            # CMP, as CPU.handle_cmp()
+            diff = reg[c] - reg[d]
+            if diff == 0:
+                cpu.fl = 0b00000001
+            elif diff > 0:
+                cpu.fl = 0b00000010
+            else:
+                cpu.fl = 0b00000100
+            return 2
+
+    return fused
+
+
+def ldi_alu(cpu, first, second, alu_ops):
+    reg = cpu.reg
+    _, a, value, _ = first
+    ir, c, d = second
+    fn = alu_ops[instruction_id(ir)]
+
+    def fused(operand_a, operand_b):
+        reg[a] = value
+        reg[c] = fn(reg[c], reg[d])
+        return 2
+
+    return fused
+
+
+def push_then(cpu, first, second, alu_ops):
+    """PUSH, then PUSH or CALL."""
+    reg = cpu.reg
+    ram = cpu.ram
+    code = cpu.code
+    _, a, _, second_pc = first
+    ir, b, _ = second
+    call = ir == CALL
+
+    def fused(operand_a, operand_b):
+        sp = reg[SP] = (reg[SP] - 1) & 0xff
+        ram[sp] = reg[a]
+        if code[sp]:
+            # pushed over code, which might be the second instruction, or
+            # to a device
+            cpu.written(sp)
+            cpu.pc = second_pc
+            return 1
+        sp = reg[SP] = (sp - 1) & 0xff
+        if call:
+            # the dispatch loop has already pointed the pc past the CALL
+            ram[sp] = cpu.pc
+            cpu.pc = reg[b]
+        else:
+            # PUSH R7 pushes the stack pointer after the decrement
+            ram[sp] = reg[b]
+        if code[sp]:
+            cpu.written(sp)
+        return 2
+
+    return fused
+
+
+def pop_pop(cpu, first, second, alu_ops):
+    if cpu.mapped:
+        # the stack might reach up into device registers
+        return None
+
+    reg = cpu.reg
+    ram = cpu.ram
+    _, a, _, _ = first
+    _, b, _ = second
+
+    def fused(operand_a, operand_b):
+        reg[a] = ram[reg[SP]]
+        reg[SP] = (reg[SP] + 1) & 0xff
+        reg[b] = ram[reg[SP]]
+        reg[SP] = (reg[SP] + 1) & 0xff
+        return 2
+
+    return fused
+
+
+# (first opcode, second opcode) -> function building the fused handler,
+# given the CPU, the first instruction's decoded entry with its opcode in
+# place of the handler, the second as (opcode, operand_a, operand_b), and
+# the ALU operations; it returns None if the pair can't be fused after all
+FUSED = {}
+for jump in CONDITIONS:
+    FUSED[CMP, jump] = cmp_jcc
+    FUSED[LDI, jump] = ldi_jump
+FUSED[LDI, JMP] = ldi_jump
+FUSED[LDI, CALL] = ldi_call
+for op in FUSIBLE_ALU:
+    FUSED[op, CMP] = set_then_cmp
+    FUSED[LDI, op] = ldi_alu
+FUSED[LD, CMP] = set_then_cmp
+FUSED[LDI, CMP] = set_then_cmp
+FUSED[PUSH, PUSH] = push_then
+FUSED[PUSH, CALL] = push_then
+FUSED[POP, POP] = pop_pop
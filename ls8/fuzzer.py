@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+
+"""
+Coverage-guided fuzzer for LS-8 programs.
+
+CoverageCPU counts every edge the program takes, a pair (previous PC, PC),
+in a bitmap of MAP_SIZE bytes indexed by previous PC << 8 | PC; the counts
+stop at 255. The counting is done by its own dispatch loop, so a plain CPU
+doesn't pay for it. It also stops with STACK_OVERFLOW as soon as the stack
+pointer goes below stack_limit, down into the program.
+
+The fuzzer varies what a program starts with: R0-R4, the bytes of a range
+of RAM (--ram, e.g. the program's data), and the keys pressed. It keeps a
+corpus of inputs, starting from all zeros, mutates them, and keeps every
+mutant that takes an edge no input has taken before, or takes one a number
+of times in a new bucket (1, 2, 3, 4-7, 8-15, 16-31, 32-127, 128+), as AFL
+does. Runs that end in an unknown opcode, a division by zero or a stack
+overflow, or that run out of --max-cycles, are crashes, reported once per
+reason and PC.
+
+Worker processes, one per core by default, each run batches of mutants on
+their own CPU, and send back only the ones new to them; the parent keeps
+the corpus and the overall coverage. Runs use virtual time, so every input
+does the same thing every time it's run.
+
+Usage: fuzzer.py [options] program
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from cpu import *
+from output import NullOutput
+from program import Program, read as read_program
+
+MAP_SIZE = 256 * 256
+
+# stop reason for a stack that has grown down into the program
+STACK_OVERFLOW = "stack overflow"
+
+# reasons a run counts as a crash
+CRASHES = {UNKNOWN_OPCODE, DIVISION_BY_ZERO, STACK_OVERFLOW, BUDGET}
+
+# the bucket (one bit) of every edge count, as AFL buckets them
+BUCKETS = bytes(
+    0 if n == 0 else 1 if n == 1 else 2 if n == 2 else 4 if n == 3
+    else 8 if n < 8 else 16 if n < 16 else 32 if n < 32 else 64 if n < 128
+    else 128
+    for n in range(256))
+
+# byte values worth trying, as AFL's interesting values
+INTERESTING = (0, 1, 2, 0x0f, 0x10, 0x7f, 0x80, 0xf4, 0xfe, 0xff)
+
+# instructions per run, keys at most, and runs per batch, by default
+MAX_CYCLES = 10000
+MAX_KEYS = 16
+BATCH = 200
+
+# timer period; in virtual time runs are repeatable
+VIRTUAL_TIME = 1000
+
+# what a run starts with: R0-R4, the fuzzed range of RAM, and the keys
+Input = namedtuple("Input", "registers ram keys")
+
+
+class CoverageCPU(CPU):
+    """CPU that counts the edges it takes in a bitmap."""
+
+    def __init__(self, *args, stack_limit=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bitmap = bytearray(MAP_SIZE)
+        # the edges taken so far, in the order first taken
+        self.touched = []
+        self.previous_pc = 0
+        # SP below this is a stack overflow
+        self.stack_limit = stack_limit
+
+    def clear_coverage(self):
+        bitmap = self.bitmap
+        for edge in self.touched:
+            bitmap[edge] = 0
+        self.touched.clear()
+        self.previous_pc = 0
+
+    def edges(self):
+        """The edges taken, as [(previous PC << 8 | PC, count)]."""
+        bitmap = self.bitmap
+        return [(edge, bitmap[edge]) for edge in self.touched]
+
+    def dispatch(self, stop):
+        decoded = self.decoded
+        reg = self.reg
+        bitmap = self.bitmap
+        touched = self.touched
+        limit = self.stack_limit
+        previous = self.previous_pc
+        cycles = self.cycles
+
+        try:
+            while cycles < stop:
+                pc = self.pc
+                edge = previous << 8 | pc
+                count = bitmap[edge]
+                if count != 255:
+                    if not count:
+                        touched.append(edge)
+                    bitmap[edge] = count + 1
+                previous = pc
+
+                entry = decoded[pc]
+                if entry is None:
+                    entry = self.decode(pc)
+                    if entry is None:
+                        return UNKNOWN_OPCODE
+
+                handler, operand_a, operand_b, self.pc = entry
+                handler(operand_a, operand_b)
+                cycles += 1
+                if reg[SP] < limit:
+                    return STACK_OVERFLOW
+        except Reschedule:
+            cycles += 1
+        except Halt as e:
+            cycles += 1
+            return e.reason
+        except ZeroDivisionError:
+            self.pc = (self.pc - 3) & 0xff
+            return DIVISION_BY_ZERO
+        finally:
+            self.cycles = cycles
+            self.previous_pc = previous
+
+        return None
+
+
+def is_new(edges, seen):
+    """True if edges reach any bucket not in seen, which is updated."""
+    new = False
+    for edge, count in edges:
+        bucket = BUCKETS[count]
+        if bucket & ~seen[edge]:
+            seen[edge] |= bucket
+            new = True
+    return new
+
+
+def mutate(parent, rng, corpus, max_keys):
+    """A mutant of parent: a few random changes, AFL style."""
+    fields = {"registers": bytearray(parent.registers),
+              "ram": bytearray(parent.ram), "keys": bytearray(parent.keys)}
+    names = [name for name in ("registers", "ram", "keys")
+             if fields[name] or name == "keys"]
+
+    for _ in range(rng.choice((1, 1, 2, 4))):
+        name = rng.choice(names)
+        data = fields[name]
+        choice = rng.randrange(7 if name == "keys" else 4)
+        if not data:
+            choice = 4
+        elif name == "keys" and len(data) >= max_keys and choice == 4:
+            choice = 5
+
+        if choice == 0:
+            data[rng.randrange(len(data))] ^= 1 << rng.randrange(8)
+        elif choice == 1:
+            data[rng.randrange(len(data))] = rng.randrange(256)
+        elif choice == 2:
+            data[rng.randrange(len(data))] = rng.choice(INTERESTING)
+        elif choice == 3:
+            i = rng.randrange(len(data))
+            data[i] = (data[i] + rng.choice((-1, 1)) * rng.randint(1, 16)) & 0xff
+        elif choice == 4:
+            data.insert(rng.randint(0, len(data)), rng.randrange(256))
+        elif choice == 5:
+            del data[rng.randrange(len(data))]
+        else:
+            # splice in the keys of another input
+            other = rng.choice(corpus).keys
+            data[rng.randint(0, len(data)):] = other[rng.randint(0, len(other)):]
+        del fields["keys"][max_keys:]
+
+    return Input(bytes(fields["registers"]), bytes(fields["ram"]),
+                 bytes(fields["keys"]))
+
+
+class Target:
+    """A program and a CPU to run inputs to it on."""
+
+    def __init__(self, program, ram_start=None, max_cycles=MAX_CYCLES):
+        self.program = program
+        self.ram_start = ram_start
+        self.max_cycles = max_cycles
+        self.cpu = CoverageCPU(output=NullOutput(), virtual_time=VIRTUAL_TIME,
+                               stack_limit=len(program.code))
+
+    def run(self, case):
+        """Run one input. Returns (stop reason, PC, edges)."""
+        cpu = self.cpu
+        cpu.reset()
+        cpu.load_program(self.program)
+        cpu.clear_coverage()
+        cpu.reg[:len(case.registers)] = case.registers
+        if case.ram:
+            cpu.ram[self.ram_start:self.ram_start + len(case.ram)] = case.ram
+        cpu.press(case.keys)
+        result = cpu.run(max_cycles=self.max_cycles)
+        return result.reason, result.pc, cpu.edges()
+
+
+# the worker process's Target and coverage so far
+_target = None
+_seen = None
+
+
+def init_worker(image, ram_start, max_cycles):
+    global _target, _seen
+    _target = Target(Program.from_bytes(image), ram_start, max_cycles)
+    _seen = bytearray(MAP_SIZE)
+
+
+def fuzz_batch(corpus, seed, count, max_keys):
+    """
+    Run count mutants of the corpus in a worker. Returns (runs, finds,
+    crashes): the inputs new to this worker with their edges, and the
+    crashes as (input, reason, PC).
+    """
+    rng = random.Random(seed)
+    finds = []
+    crashes = []
+    for _ in range(count):
+        case = mutate(rng.choice(corpus), rng, corpus, max_keys)
+        reason, pc, edges = _target.run(case)
+        if reason in CRASHES:
+            crashes.append((case, reason, pc))
+        if is_new(edges, _seen):
+            finds.append((case, edges))
+    return count, finds, crashes
+
+
+class Fuzzer:
+    """The corpus, coverage and crashes, fed by a pool of workers."""
+
+    def __init__(self, program, ram=None, max_cycles=MAX_CYCLES,
+                 max_keys=MAX_KEYS, workers=None, seed=None):
+        self.program = program
+        self.ram_start, self.ram_end = ram if ram is not None else (0, 0)
+        self.max_cycles = max_cycles
+        self.max_keys = max_keys
+        self.workers = workers or os.cpu_count()
+        self.rng = random.Random(seed)
+
+        self.seen = bytearray(MAP_SIZE)
+        self.corpus = []
+        # (reason, PC) -> the first input found to crash there
+        self.crashes = {}
+        self.runs = 0
+        self.started = None
+
+        empty = Input(bytes(5), bytes(self.ram_end - self.ram_start), b"")
+        self.add(empty, *Target(program, self.ram_start, max_cycles).run(empty))
+
+    def add(self, case, reason, pc, edges):
+        """Take a run's result into the corpus and the crashes."""
+        if reason in CRASHES:
+            self.crashes.setdefault((reason, pc), case)
+        if is_new(edges, self.seen):
+            self.corpus.append(case)
+
+    @property
+    def coverage(self):
+        """The number of edges taken so far."""
+        return MAP_SIZE - self.seen.count(0)
+
+    def run(self, runs=None, seconds=None, report=None, every=1.0):
+        """
+        Fuzz until runs inputs have run, or seconds have gone by (or until
+        interrupted, with neither), calling report(self) every `every`
+        seconds.
+        """
+        self.started = time.perf_counter()
+        deadline = None if seconds is None else self.started + seconds
+        last_report = self.started
+        image = self.program.to_bytes()
+        submitted = 0
+
+        with ProcessPoolExecutor(self.workers, initializer=init_worker,
+                                 initargs=(image, self.ram_start,
+                                           self.max_cycles)) as pool:
+            pending = set()
+            try:
+                while True:
+                    done = (runs is not None and submitted >= runs
+                            or deadline is not None
+                            and time.perf_counter() >= deadline)
+                    # two batches per worker, so none waits on the parent
+                    while not done and len(pending) < 2 * self.workers:
+                        count = BATCH if runs is None else min(BATCH, runs - submitted)
+                        if count <= 0:
+                            break
+                        pending.add(pool.submit(fuzz_batch, self.corpus,
+                                                self.rng.getrandbits(64), count,
+                                                self.max_keys))
+                        submitted += count
+                    if not pending:
+                        break
+
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        count, finds, crashes = future.result()
+                        self.runs += count
+                        for case, reason, pc in crashes:
+                            self.crashes.setdefault((reason, pc), case)
+                        for case, edges in finds:
+                            if is_new(edges, self.seen):
+                                self.corpus.append(case)
+
+                    now = time.perf_counter()
+                    if report is not None and now - last_report >= every:
+                        report(self)
+                        last_report = now
+            except KeyboardInterrupt:
+                for future in pending:
+                    future.cancel()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.started
+        kinds = {}
+        for reason, _ in self.crashes:
+            kinds[reason] = kinds.get(reason, 0) + 1
+        return {
+            "runs": self.runs,
+            "runs_per_sec": self.runs / elapsed if elapsed else 0.0,
+            "corpus": len(self.corpus),
+            "edges": self.coverage,
+            "crashes": kinds,
+        }
+
+
+def case_json(case, ram_start):
+    return {"registers": list(case.registers), "ram_start": ram_start,
+            "ram": case.ram.hex(), "keys": case.keys.hex()}
+
+
+def print_stats(fuzzer, file=sys.stderr):
+    stats = fuzzer.stats()
+    crashes = ", ".join(f"{n} {reason}" for reason, n in sorted(stats["crashes"].items()))
+    print(f"{stats['runs']} runs ({stats['runs_per_sec']:.0f}/s), "
+          f"corpus {stats['corpus']}, {stats['edges']} edges, "
+          f"crashes: {crashes or 'none'}", file=file)
+
+
+def parse_range(text):
+    start, _, end = text.partition("-")
+    start, end = int(start, 0), int(end or start, 0)
+    if not 0 <= start <= end <= 0xff:
+        raise argparse.ArgumentTypeError(f"bad RAM range {text!r}")
+    return start, end + 1
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Fuzz an LS-8 program's registers, RAM and keyboard input.")
+    parser.add_argument("program", help="the .asm, .ls8 or .ls8b file to fuzz")
+    parser.add_argument("-j", "--workers", type=int,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--runs", type=int, help="stop after this many runs")
+    parser.add_argument("--time", type=float,
+                        help="stop after this many seconds (default: when interrupted)")
+    parser.add_argument("--ram", type=parse_range, metavar="START-END",
+                        help="also fuzz the bytes of RAM from START to END")
+    parser.add_argument("--max-cycles", type=int, default=MAX_CYCLES,
+                        help=f"instructions before a run counts as runaway (default: {MAX_CYCLES})")
+    parser.add_argument("--max-keys", type=int, default=MAX_KEYS,
+                        help=f"most keys pressed in a run (default: {MAX_KEYS})")
+    parser.add_argument("--seed", type=int, help="seed for the mutations")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write the crashes and the corpus here as JSON")
+    args = parser.parse_args(argv[1:])
+
+    fuzzer = Fuzzer(read_program(args.program), args.ram, args.max_cycles,
+                    args.max_keys, args.workers, args.seed)
+    fuzzer.run(args.runs, args.time, report=print_stats)
+    print_stats(fuzzer)
+
+    for (reason, pc), case in sorted(fuzzer.crashes.items()):
+        print(f"{reason} at {pc:02X}: {json.dumps(case_json(case, fuzzer.ram_start))}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "stats": fuzzer.stats(),
+                "crashes": [dict(case_json(case, fuzzer.ram_start),
+                                 reason=reason, pc=pc)
+                            for (reason, pc), case in sorted(fuzzer.crashes.items())],
+                "corpus": [case_json(case, fuzzer.ram_start)
+                           for case in fuzzer.corpus],
+            }, f, indent=2)
+
+    return 1 if fuzzer.crashes else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
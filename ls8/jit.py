@@ -0,0 +1,316 @@
+"""Basic-block JIT: runs LS-8 code as compiled Python functions."""
+
+from cpu import *
+
+# instructions the JIT leaves to the interpreter; a block stops just before
+# them and run() steps over them one at a time. So do instructions that
+# write IM or IS, see touches_interrupts().
+INTERPRETED = {HLT, INT, IRET}
+
+# longest block compiled in one go
+MAX_BLOCK = 64
+
+# conditions for the conditional jumps, written like the matching CPU methods
+CONDITIONS = {
+    JEQ: "fl & 0b00000001",
+    JGE: "fl >> 1 == 1 or fl & 0b00000001",
+    JGT: "fl >> 1 == 1",
+    JLE: "fl >> 2 or fl & 0b00000001",
+    JLT: "fl >> 2",
+    JNE: "not fl & 0b00000001",
+}
+
+# ALU instructions as Python expressions on the operand registers, wrapped
+# to 8 bits like the matching ALU_OPS
+ALU_EXPRS = {
+    ADD: "(r{a} + r{b}) & 0xff",
+    SUB: "(r{a} - r{b}) & 0xff",
+    MUL: "(r{a} * r{b}) & 0xff",
+    DIV: "r{a} // r{b}",
+    INC: "(r{a} + 1) & 0xff",
+    DEC: "(r{a} - 1) & 0xff",
+    AND: "r{a} & r{b}",
+    OR: "r{a} | r{b}",
+    XOR: "r{a} ^ r{b}",
+    NOT: "~r{a} & 0xff",
+    SHL: "(r{a} << r{b}) & 0xff",
+    SHR: "r{a} >> r{b}",
+    MOD: "r{a} % r{b}",
+}
+
+
+class Block:
+    """A compiled basic block covering RAM[start:end]."""
+
+    def __init__(self, start, end, length, fn, source):
+        self.start = start
+        self.end = end
+        self.length = length  # number of instructions
+        self.fn = fn
+        self.source = source
+
+
+class JITCPU(CPU):
+    """
+    CPU that compiles straight-line runs of instructions into Python
+    functions, keeping registers in local variables while a block runs.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # compiled blocks by start address
+        self.blocks = [None] * 256
+        # start addresses of the blocks each RAM byte belongs to
+        self.block_owners = [[] for _ in range(256)]
+
+    def compile_block(self, start):
+        """
+        Generate, compile and cache the block starting at start. Returns None
+        if the first instruction has to be interpreted.
+        """
+        ram = self.ram
+        body = []
+        used = set()
+        written = set()
+        uses_fl = False
+        count = 0
+        pc = start
+        terminated = False
+
+        def exit(target):
+            # write every register the block touched back, then leave; the
+            # block loops, so that's every register written anywhere in it,
+            # filled in for WRITEBACK once the whole block has been scanned
+            return ["WRITEBACK", f"return {target}, n + {count}"]
+
+        def jump(target):
+            # a jump back to the start of this block just goes round the
+            # loop again, as long as the budget allows another full pass
+            return [
+                f"if {target} == {start} and n + {count} + LENGTH <= budget:",
+                f"    n += LENGTH",
+                f"    continue",
+                *exit(target),
+            ]
+
+        def load(addr):
+            # loads go through the CPU if a device might be at addr
+            return f"cpu.ram_read({addr})" if self.mapped else f"ram[{addr}]"
+
+        def store(addr, value, next_pc):
+            # a store into code drops the stale cached code and leaves the
+            # block, since the rest of it might have just been overwritten
+            return [
+                f"ram[{addr}] = {value}",
+                f"if code[{addr}]:",
+                f"    cpu.written({addr})",
+                *("    " + line for line in exit(next_pc)),
+            ]
+
+        while count < MAX_BLOCK:
+            ir = ram[pc]
+            if ir in INTERPRETED or self.branchtable[ir] is None:
+                break
+
+            size = SIZES[ir]
+            if pc + size > 256:
+                break
+            # register operands only use their low three bits, as in decode()
+            a = ram[pc + 1] & 0b111 if size > 1 else 0
+            b = ram[pc + 2] if size > 2 else 0
+            if touches_interrupts(ir, a):
+                break
+            if ir not in IMMEDIATE:
+                b &= 0b111
+            next_pc = pc + size
+            count += 1
+
+            if ir == LDI:
+                written.add(a)
+                body.append(f"r{a} = {b}")
+            elif ir in ALU_EXPRS:
+                used.update((a, b) if operand_count(ir) == 2 else (a,))
+                written.add(a)
+                if ir in (DIV, MOD):
+                    # leave division by zero to the interpreter, which
+                    # reports it
+                    count -= 1
+                    body.append(f"if not r{b}:")
+                    body.extend("    " + line for line in exit(pc))
+                    count += 1
+                body.append(f"r{a} = " + ALU_EXPRS[ir].format(a=a, b=b))
+            elif ir == CMP:
+                used.update((a, b))
+                uses_fl = True
+                body.append(f"fl = 1 if r{a} == r{b} else 2 if r{a} > r{b} else 4")
+            elif ir == PRN:
+                used.add(a)
+                body.append(f"cpu.emit(PRN_TEXT[r{a}])")
+            elif ir == PRA:
+                used.add(a)
+                body.append(f"cpu.emit(PRA_TEXT[r{a}])")
+            elif ir == PUSH:
+                used.update((a, 7))
+                written.add(7)
+                body.append("r7 = (r7 - 1) & 0xff")
+                body.extend(store("r7", f"r{a}", next_pc))
+            elif ir == POP:
+                used.add(7)
+                written.update((a, 7))
+                body.append(f"r{a} = {load('r7')}")
+                body.append("r7 = (r7 + 1) & 0xff")
+            elif ir == ST:
+                used.update((a, b))
+                body.extend(store(f"r{a}", f"r{b}", next_pc))
+            elif ir == LD:
+                used.add(b)
+                written.add(a)
+                body.append(f"r{a} = {load(f'r{b}')}")
+            elif ir == NOP:
+                pass
+            elif ir == CALL:
+                used.update((a, 7))
+                written.add(7)
+                body.append("r7 = (r7 - 1) & 0xff")
+                body.append(f"ram[r7] = {next_pc & 0xff}")
+                body.append("if code[r7]:")
+                body.append("    cpu.written(r7)")
+                body.extend(exit(f"r{a}"))
+            elif ir == RET:
+                used.add(7)
+                written.add(7)
+                body.append("r7 = (r7 + 1) & 0xff")
+                body.extend(exit(load("(r7 - 1) & 0xff")))
+            elif ir == JMP:
+                used.add(a)
+                body.extend(jump(f"r{a}"))
+            elif ir in CONDITIONS:
+                used.add(a)
+                uses_fl = True
+                body.append(f"if {CONDITIONS[ir]}:")
+                body.extend("    " + line for line in jump(f"r{a}"))
+                body.extend(exit(next_pc))
+            else:
+                # an instruction the JIT doesn't know how to compile
+                count -= 1
+                break
+
+            pc = next_pc
+            if sets_pc(ir):
+                # CALL, RET and the jumps end the block
+                terminated = True
+                break
+            if pc == 256:
+                break
+
+        if count == 0:
+            return None
+        if not terminated:
+            body.extend(exit(pc if pc < 256 else 0))
+
+        prologue = [f"r{r} = reg[{r}]" for r in sorted(used | written)]
+        if uses_fl:
+            prologue.append("fl = cpu.fl")
+        prologue.append("n = 0")
+        writeback = [f"reg[{r}] = r{r}" for r in sorted(written)]
+        if uses_fl:
+            writeback.append("cpu.fl = fl")
+        lines = []
+        for line in body:
+            if line.strip() == "WRITEBACK":
+                indent = line[:line.index("WRITEBACK")]
+                lines.extend(indent + assignment for assignment in writeback)
+            else:
+                lines.append(line.replace("LENGTH", str(count)))
+        body = lines
+        name = f"block_{start:02x}"
+        source = (f"def {name}(cpu, reg, ram, code, budget):\n"
+                  + "".join(f"    {line}\n" for line in prologue)
+                  + "    while True:\n"
+                  + "".join(f"        {line}\n" for line in body))
+
+        namespace = {"PRN_TEXT": PRN_TEXT, "PRA_TEXT": PRA_TEXT}
+        exec(compile(source, f"<ls8 block {start:02x}>", "exec"), namespace)
+
+        block = Block(start, pc, count, namespace[name], source)
+        self.blocks[start] = block
+        for addr in range(start, pc):
+            self.block_owners[addr].append(start)
+            self.code[addr] |= CODE_FLAG
+        return block
+
+    def invalidate(self, mar):
+        """Drop cached instructions and compiled blocks that cover mar."""
+        for start in self.block_owners[mar]:
+            block = self.blocks[start]
+            if block is not None:
+                self.blocks[start] = None
+                for addr in range(block.start, block.end):
+                    if addr != mar:
+                        self.block_owners[addr].remove(start)
+        self.block_owners[mar] = []
+        super().invalidate(mar)
+
+    def fork(self, output=None, **kwargs):
+        child = super().fork(output, **kwargs)
+        # blocks don't refer to the CPU that compiled them, so the child can
+        # start with the same ones, RAM being the same
+        child.blocks[:] = self.blocks
+        child.block_owners = [list(owners) for owners in self.block_owners]
+        child.code[:] = self.code
+        return child
+
+    def flush_decoded(self):
+        super().flush_decoded()
+        self.blocks = [None] * 256
+        self.block_owners = [[] for _ in range(256)]
+
+    def execute(self, stop):
+        """
+        Run blocks until self.cycles reaches stop, stepping through single
+        instructions where a block would overshoot. Returns the reason the
+        CPU stopped early, or None.
+        """
+        if self.exact_cycles:
+            # blocks only add up the instruction count as they leave, so a
+            # device that reads it needs the interpreter
+            return CPU.execute(self, stop)
+
+        reg = self.reg
+
+        while self.cycles < stop:
+            limit = stop
+            if reg[IM]:
+                limit = self.poll_interrupts(stop)
+            reason = self.run_blocks(limit)
+            if reason is not None:
+                return reason
+
+        return None
+
+    def run_blocks(self, stop):
+        """
+        The JIT's dispatch loop: run blocks until self.cycles reaches stop.
+        Returns after every interpreted instruction, since it may have
+        changed IM or IS.
+        """
+        blocks = self.blocks
+        reg = self.reg
+        ram = self.ram
+        code = self.code
+
+        while self.cycles < stop:
+            block = blocks[self.pc] or self.compile_block(self.pc)
+            if block is None or self.cycles + block.length > stop:
+                # interpreted instruction, or not enough budget left for the
+                # whole block
+                return self.dispatch(self.cycles + 1)
+
+            self.pc, count = block.fn(self, reg, ram, code, stop - self.cycles)
+            self.cycles += count
+            if not count:
+                # the block bailed out on its first instruction (a division
+                # by zero), so let the interpreter deal with it
+                return self.dispatch(self.cycles + 1)
+
+        return None
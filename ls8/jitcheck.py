@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""
+Differential test for the JIT.
+
+Every program is run on the interpreter and on JITCPU, and both must stop
+for the same reason after the same number of instructions, with the same
+PC, FL, registers, RAM and output.
+
+The programs are the examples, a few loops that leave their block half way
+round (a store into the block's own code, a division by zero) after writing
+registers further down, and random programs.
+
+Usage: jitcheck.py [--random N] [--seed S] [file ...]
+"""
+
+import argparse
+import glob
+import os
+import random
+import sys
+
+from cpu import *
+from jit import JITCPU
+from output import CaptureOutput
+from program import Program, read as read_program
+
+# instructions to run each program for
+MAX_CYCLES = 20000
+
+# keystrokes for programs that read the keyboard
+KEYS = b"hello"
+
+# loops that leave their block early, as machine code (address: bytes)
+LOOPS = {
+    # stores wrap round into the loop itself; R3 counts passes
+    "store into code": [
+        LDI, 0, 0xfd,       # 00 R0 = FD
+        LDI, 1, 0x0f,       # 03 R1 = 0F
+        LDI, 2, 0x09,       # 06 R2 = Loop
+        ST, 0, 1,           # 09 Loop: [R0] = R1
+        INC, 0,             # 0C
+        INC, 3,             # 0E
+        CMP, 0, 3,          # 10
+        JMP, 2,             # 13
+    ],
+    # R1 counts down to 0 and the DIV fails; R2 and FL change after it
+    "division by zero": [
+        LDI, 0, 0xc8,       # 00 R0 = 200
+        LDI, 1, 0x05,       # 03 R1 = 5
+        LDI, 3, 0x09,       # 06 R3 = Loop
+        DIV, 0, 1,          # 09 Loop: R0 /= R1
+        INC, 2,             # 0C
+        CMP, 2, 1,          # 0E
+        DEC, 1,             # 11
+        JMP, 3,             # 13
+    ],
+    # as above, with MOD, and a store to the stack after it
+    "modulo by zero": [
+        LDI, 0, 0xc8,       # 00 R0 = 200
+        LDI, 1, 0x07,       # 03 R1 = 7
+        LDI, 3, 0x09,       # 06 R3 = Loop
+        MOD, 0, 1,          # 09 Loop: R0 %= R1
+        PUSH, 0,            # 0C
+        POP, 4,             # 0E
+        CMP, 4, 1,          # 10
+        DEC, 1,             # 13
+        JMP, 3,             # 15
+    ],
+}
+
+# what random programs are made of
+RANDOM_OPCODES = sorted(set(OPCODES.values()) - {INT, IRET})
+
+
+def random_program(rng):
+    """A random run of instructions, which jump to random addresses."""
+    code = []
+    while len(code) < 48:
+        ir = rng.choice(RANDOM_OPCODES)
+        code.append(ir)
+        if operand_count(ir) >= 1:
+            code.append(rng.randrange(5))
+        if operand_count(ir) == 2:
+            # immediates mostly land somewhere in the program
+            code.append(rng.randrange(64) if ir in IMMEDIATE
+                        else rng.randrange(5))
+    code.append(HLT)
+    return Program(bytes(code))
+
+
+def run(cpu_class, program):
+    cpu = cpu_class(output=CaptureOutput(), virtual_time=1000)
+    cpu.load_program(program)
+    cpu.press(KEYS)
+    result = cpu.run(max_cycles=MAX_CYCLES)
+    return result, bytes(cpu.ram)
+
+
+def compare(program):
+    """Check one program. Returns a list of the differences found."""
+    a, ram_a = run(CPU, program)
+    b, ram_b = run(JITCPU, program)
+
+    problems = []
+    if a.reason != b.reason:
+        problems.append(f"stopped with {a.reason}, JIT {b.reason}")
+    if a.cycles != b.cycles:
+        problems.append(f"{a.cycles} cycles, JIT {b.cycles}")
+    if a.pc != b.pc:
+        problems.append(f"PC {a.pc:02X}, JIT {b.pc:02X}")
+    if a.fl != b.fl:
+        problems.append(f"FL {a.fl:03b}, JIT {b.fl:03b}")
+    for r, (x, y) in enumerate(zip(a.registers, b.registers)):
+        if x != y:
+            problems.append(f"R{r} {x:02X}, JIT {y:02X}")
+    if ram_a != ram_b:
+        problems.append("RAM differs")
+    if a.output != b.output:
+        problems.append("output differs")
+    return problems
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Check that the JIT does what the interpreter does.")
+    parser.add_argument("files", nargs="*",
+                        help="programs to check (default: the examples)")
+    parser.add_argument("--random", type=int, default=2000, metavar="N",
+                        help="random programs to check (default: 2000)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first random program")
+    args = parser.parse_args(argv[1:])
+
+    files = args.files or sorted(
+        glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "examples", "*.ls8")))
+    programs = [(os.path.basename(path), read_program(path)) for path in files]
+    programs.extend((name, Program(bytes(code))) for name, code in LOOPS.items())
+
+    failures = 0
+    for name, program in programs:
+        problems = compare(program)
+        print(f"{name:<20} {'FAIL' if problems else 'ok'}")
+        for problem in problems:
+            print(f"    {problem}")
+        failures += bool(problems)
+
+    random_failures = 0
+    for seed in range(args.seed, args.seed + args.random):
+        problems = compare(random_program(random.Random(seed)))
+        if problems:
+            print(f"random seed {seed:<8} FAIL")
+            for problem in problems:
+                print(f"    {problem}")
+            random_failures += 1
+    if args.random:
+        print(f"{args.random} random programs, {random_failures} failed")
+
+    return 1 if failures or random_failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
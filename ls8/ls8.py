@@ -2,10 +2,66 @@
 
 """Main."""
 
+import argparse
+import asyncio
 import sys
 from cpu import *
+from devices import run_with_devices
+from jit import JITCPU
+from mmio import DEVICES
+from runcache import RunCache
 
-cpu = CPU()
+parser = argparse.ArgumentParser(description="Run an LS-8 program.")
+parser.add_argument("program", help="the .asm, .ls8 or .ls8b file to run")
+parser.add_argument("--jit", action="store_true",
+                    help="compile basic blocks to Python instead of interpreting")
+parser.add_argument("--no-fuse", action="store_true",
+                    help="run every instruction on its own, without superinstructions")
+parser.add_argument("--device", action="append", default=[],
+                    choices=sorted(DEVICES),
+                    help="map a device into memory, see mmio.py (repeatable)")
+parser.add_argument("--max-cycles", type=int,
+                    help="stop after this many instructions")
+parser.add_argument("--max-time", type=float,
+                    help="stop after this many seconds")
+parser.add_argument("--virtual-time", type=int, metavar="N",
+                    help="fire the timer every N instructions instead of every second")
+parser.add_argument("--keyboard", action="store_true",
+                    help="send stdin to the keyboard interrupt, and sleep while the program is idle")
+parser.add_argument("--resume", metavar="SNAPSHOT",
+                    help="start from a snapshot saved with --snapshot")
+parser.add_argument("--snapshot", metavar="FILE",
+                    help="save the machine state to FILE when the run stops")
+parser.add_argument("--cache", metavar="FILE",
+                    help="reuse the results of identical runs from this cache, see runcache.py")
+args = parser.parse_args()
 
-cpu.load(sys.argv[1])
-cpu.run()
\ No newline at end of file
+cpu_class = JITCPU if args.jit else CPU
+cpu = cpu_class(virtual_time=args.virtual_time, fuse=not args.no_fuse,
+                devices=[DEVICES[name] for name in args.device])
+
+cpu.load(args.program)
+if args.resume:
+    cpu.restore(Snapshot.load(args.resume))
+
+if args.keyboard:
+    result = asyncio.run(run_with_devices(cpu, max_cycles=args.max_cycles,
+                                          max_time=args.max_time))
+elif args.cache:
+    cache = RunCache(args.cache)
+    result = cache.run(cpu, max_cycles=args.max_cycles, max_time=args.max_time)
+    cache.close()
+else:
+    result = cpu.run(max_cycles=args.max_cycles, max_time=args.max_time)
+
+if args.snapshot:
+    cpu.snapshot().save(args.snapshot)
+
+if result.reason == UNKNOWN_OPCODE:
+    print('Unknown instruction', file=sys.stderr)
+    print(result.ir, result.pc, file=sys.stderr)
+elif result.reason != HALTED:
+    print(f"Stopped: {result.reason} after {result.cycles} instructions",
+          file=sys.stderr)
+
+sys.exit(0 if result.halted else 1)
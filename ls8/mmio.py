@@ -0,0 +1,86 @@
+"""
+Memory-mapped devices.
+
+A device claims addresses with CPU.attach(), from its constructor, and from
+then on loads from those addresses call its read() and stores call its
+write(). Every other address stays plain RAM. The CPU finds the device for
+an address in CPU.devices, a table with an entry per address, and stores
+already check CPU.code, the per-address flags that keep the decode cache
+right, so a mapped device only adds a bit to that table: ordinary loads and
+stores cost the same however many devices there are.
+
+Devices are given to the CPU as classes (or any callable taking the CPU),
+CPU(devices=[Console, CycleCounter]), and built when it is.
+
+The top of memory:
+
+    F4     keyboard, the last key pressed; plain RAM, written by the CPU
+           when it raises the keyboard interrupt
+    F5     the inter-core register on a multi-core machine, see multicore.py
+    F6     console: each byte stored here is printed as a character
+    F7     cycle counter: reads as the low byte of the instruction count
+    F8-FF  interrupt vectors, plain RAM
+"""
+
+from output import PRA_TEXT
+
+CONSOLE_ADDRESS = 0xf6
+CYCLE_COUNTER_ADDRESS = 0xf7
+
+
+class Device:
+    """
+    A memory-mapped device at addresses. The base class behaves like RAM;
+    subclasses override read() and write().
+    """
+
+    # True for devices that read CPU.cycles, which the CPU then keeps
+    # exact as every instruction runs rather than once per slice
+    needs_cycles = False
+
+    # True for devices that act the same on every run, so runs using them
+    # can be cached, see runcache.py
+    deterministic = True
+
+    def __init__(self, cpu, *addresses):
+        self.cpu = cpu
+        cpu.attach(self, addresses)
+
+    def read(self, address):
+        """Return the byte a load from address sees."""
+        return self.cpu.ram[address]
+
+    def write(self, address, value):
+        """Called after value has been stored in RAM at address."""
+
+
+class Console(Device):
+    """Prints every byte stored to it as a character, like PRA."""
+
+    def __init__(self, cpu, address=CONSOLE_ADDRESS):
+        super().__init__(cpu, address)
+
+    def write(self, address, value):
+        self.cpu.emit(PRA_TEXT[value])
+
+
+class CycleCounter(Device):
+    """
+    Reads as the low byte of the number of instructions run before the one
+    reading it, for timing code from inside the program.
+    """
+
+    needs_cycles = True
+
+    def __init__(self, cpu, address=CYCLE_COUNTER_ADDRESS):
+        super().__init__(cpu, address)
+
+    def read(self, address):
+        return self.cpu.cycles & 0xff
+
+
+# devices by name, for command line options
+DEVICES = {
+    "console": Console,
+    "cycle-counter": CycleCounter,
+}
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+"""
+Multi-core LS-8: several CPUs running one program on one shared RAM.
+
+Every core has its own registers, PC, FL and decode cache, and its own
+slice of the stack: core k's SP starts at F4 - k * stack_size. All cores
+start at the program's entry, with R0 holding the core's number and R1 the
+number of cores, and go their own ways from there.
+
+The cores synchronize through memory and two additions to the machine:
+
+* TAS registerA registerB, test and set: loads registerA from the address
+  in registerB, and stores 1 there if it was 0, as one atomic step. A
+  spinlock takes the lock with TAS until it reads 0, and releases it with
+  a plain ST of 0.
+* The inter-core register at F5: storing k there raises interrupt 2 on
+  core k, which sees it the next time it polls for interrupts (while its
+  IM is nonzero). Loading from F5 gives the core's own number.
+
+There are two ways to run them:
+
+* run_parallel(): one OS process per core, with RAM in shared memory, so
+  the cores really run at the same time, on as many host cores as there
+  are.
+* run_round_robin(): all the cores in this process, taking turns of
+  quantum instructions, so the interleaving, and with it the result, is
+  the same on every run. For testing what run_parallel() does.
+
+Each core only drops the code it has cached when it stores over it itself,
+so a program mustn't modify code another core might be running.
+
+Usage: multicore.py [options] program
+"""
+
+import argparse
+import gc
+import multiprocessing
+import sys
+import time
+from multiprocessing import shared_memory
+
+from cpu import *
+from jit import JITCPU
+from mmio import Device
+from output import CaptureOutput
+from program import read as read_program
+
+CORE_INTERRUPT = 2
+CORE_ADDRESS = 0xf5
+
+# bytes of stack each core gets
+STACK_SIZE = 16
+
+# instructions each core runs per turn in round-robin mode
+QUANTUM = 1000
+
+# the shared memory: RAM, then a pending inter-core interrupt flag per core
+RAM_SIZE = 256
+
+
+class CoreRegister(Device):
+    """
+    The inter-core register: reads as the core's number; storing k raises
+    the inter-core interrupt on core k.
+    """
+
+    # the other cores write to the same RAM
+    deterministic = False
+
+    def __init__(self, cpu, address=CORE_ADDRESS):
+        super().__init__(cpu, address)
+
+    def read(self, address):
+        return self.cpu.core_id
+
+    def write(self, address, value):
+        pending = self.cpu.pending
+        if value < len(pending):
+            pending[value] = 1
+
+
+class CoreMixin:
+    """What makes a CPU one core of several, see make_core()."""
+
+    def setup_core(self, core_id, cores, pending, lock, stack_size):
+        self.core_id = core_id
+        self.cores = cores
+        # a flag per core, set while it has an inter-core interrupt coming
+        self.pending = pending
+        # held while TAS runs; None when every core is in one thread
+        self.lock = lock
+        self.reg[0] = core_id
+        self.reg[1] = cores
+        self.reg[SP] = 0xf4 - core_id * stack_size
+
+    def handle_tas(self, reg_a, reg_b):
+        lock = self.lock
+        if lock is None:
+            super().handle_tas(reg_a, reg_b)
+        else:
+            with lock:
+                super().handle_tas(reg_a, reg_b)
+
+    def poll_interrupts(self, stop):
+        pending = self.pending
+        if pending[self.core_id]:
+            pending[self.core_id] = 0
+            self.reg[IS] |= 1 << CORE_INTERRUPT
+        return super().poll_interrupts(stop)
+
+
+class Core(CoreMixin, CPU):
+    """An interpreting core."""
+
+
+class JITCore(CoreMixin, JITCPU):
+    """A core on the basic-block JIT."""
+
+
+def make_core(core_id, cores, ram, pending, entry, lock=None,
+              stack_size=STACK_SIZE, jit=False, **kwargs):
+    """
+    Build core core_id of cores, working on ram in place, with its PC at
+    entry. kwargs go to the CPU constructor.
+    """
+    devices = (CoreRegister,) + tuple(kwargs.pop("devices", ()))
+    core_class = JITCore if jit else Core
+    cpu = core_class(ram=ram, output=CaptureOutput(), devices=devices, **kwargs)
+    cpu.setup_core(core_id, cores, pending, lock, stack_size)
+    cpu.pc = entry
+    return cpu
+
+
+def check_fits(program, cores, stack_size):
+    """Raise ValueError if program and the cores' stacks overlap."""
+    room = 0xf4 - cores * stack_size
+    if len(program.code) > room:
+        raise ValueError(f"a {len(program.code)} byte program doesn't fit "
+                         f"under {cores} stacks of {stack_size} bytes")
+
+
+def core_result(cpu, reason, elapsed):
+    """A core's final state as a dict, like batch.py's results."""
+    return {
+        "core": cpu.core_id,
+        "reason": reason,
+        "cycles": cpu.cycles,
+        "output": cpu.output.getvalue(),
+        "pc": cpu.pc,
+        "fl": cpu.fl,
+        "registers": list(cpu.reg),
+        "wall_time": elapsed,
+    }
+
+
+def run_core(name, core_id, cores, entry, lock, results, options,
+             max_cycles=None, max_time=None):
+    """Process target: run one core on the shared memory called name."""
+    started = time.perf_counter()
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        cpu = make_core(core_id, cores, shm.buf[:RAM_SIZE],
+                        shm.buf[RAM_SIZE:RAM_SIZE + cores], entry, lock,
+                        **options)
+        run = cpu.run(max_cycles=max_cycles, max_time=max_time)
+        result = core_result(cpu, run.reason, time.perf_counter() - started)
+    except Exception as e:
+        result = {"core": core_id, "error": f"{type(e).__name__}: {e}",
+                  "wall_time": time.perf_counter() - started}
+    results.put(result)
+
+    # the CPU and its cached code hold views of the shared memory, which
+    # can't be closed until they're all gone
+    cpu = None
+    gc.collect()
+    shm.close()
+
+
+def run_parallel(program, cores, max_cycles=None, max_time=None, **options):
+    """
+    Run program on cores cores, one process each, until they have all
+    stopped. max_cycles and max_time are per core. options go to
+    make_core(). Returns (a result dict per core, the final RAM).
+    """
+    check_fits(program, cores, options.get("stack_size", STACK_SIZE))
+    shm = shared_memory.SharedMemory(create=True, size=RAM_SIZE + cores)
+    try:
+        shm.buf[:RAM_SIZE + cores] = bytes(RAM_SIZE + cores)
+        shm.buf[:len(program.code)] = program.code
+        lock = multiprocessing.Lock()
+        results = multiprocessing.Queue()
+
+        processes = [
+            multiprocessing.Process(
+                target=run_core,
+                args=(shm.name, i, cores, program.entry, lock, results,
+                      options, max_cycles, max_time))
+            for i in range(cores)
+        ]
+        for process in processes:
+            process.start()
+        # drain the queue before joining, or a child can block putting
+        done = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        ram = bytes(shm.buf[:RAM_SIZE])
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return sorted(done, key=lambda result: result["core"]), ram
+
+
+def run_round_robin(program, cores, quantum=QUANTUM, max_cycles=None,
+                    max_time=None, **options):
+    """
+    Run program on cores cores in this process, taking turns of quantum
+    instructions in core order, until they have all stopped. Takes the same
+    options as run_parallel(), and returns the same.
+    """
+    check_fits(program, cores, options.get("stack_size", STACK_SIZE))
+    ram = bytearray(RAM_SIZE)
+    ram[:len(program.code)] = program.code
+    pending = bytearray(cores)
+    cpus = [make_core(i, cores, ram, pending, program.entry, **options)
+            for i in range(cores)]
+
+    started = time.perf_counter()
+    deadline = None if max_time is None else started + max_time
+    results = [None] * cores
+    running = list(range(cores))
+
+    while running:
+        for i in list(running):
+            cpu = cpus[i]
+            turn = quantum
+            if max_cycles is not None:
+                turn = min(turn, max_cycles - cpu.cycles)
+            reason = cpu.run(max_cycles=turn).reason
+            if reason == BUDGET and (max_cycles is None or cpu.cycles < max_cycles):
+                continue
+            results[i] = core_result(cpu, reason, time.perf_counter() - started)
+            running.remove(i)
+
+        if deadline is not None and time.perf_counter() >= deadline:
+            for i in running:
+                results[i] = core_result(cpus[i], BUDGET,
+                                         time.perf_counter() - started)
+            break
+
+    return results, bytes(ram)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run an LS-8 program on several cores sharing RAM.")
+    parser.add_argument("program", help="the .asm, .ls8 or .ls8b file to run")
+    parser.add_argument("-n", "--cores", type=int, default=2,
+                        help="number of cores (default: 2)")
+    parser.add_argument("--round-robin", action="store_true",
+                        help="run the cores in turns in one process, the same way every time")
+    parser.add_argument("--quantum", type=int, default=QUANTUM,
+                        help=f"instructions per turn with --round-robin (default: {QUANTUM})")
+    parser.add_argument("--stack-size", type=int, default=STACK_SIZE,
+                        help=f"bytes of stack per core (default: {STACK_SIZE})")
+    parser.add_argument("--jit", action="store_true",
+                        help="compile basic blocks to Python instead of interpreting")
+    parser.add_argument("--max-cycles", type=int,
+                        help="stop each core after this many instructions")
+    parser.add_argument("--max-time", type=float,
+                        help="stop after this many seconds")
+    parser.add_argument("--virtual-time", type=int, metavar="N",
+                        help="fire the timer every N instructions instead of every second")
+    args = parser.parse_args(argv[1:])
+
+    program = read_program(args.program)
+    options = dict(stack_size=args.stack_size, jit=args.jit,
+                   virtual_time=args.virtual_time)
+    try:
+        check_fits(program, args.cores, args.stack_size)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.round_robin:
+        results, _ = run_round_robin(program, args.cores, args.quantum,
+                                     args.max_cycles, args.max_time, **options)
+    else:
+        results, _ = run_parallel(program, args.cores, args.max_cycles,
+                                  args.max_time, **options)
+
+    ok = True
+    for result in results:
+        if "error" in result:
+            print(f"core {result['core']}: {result['error']}", file=sys.stderr)
+            ok = False
+            continue
+        sys.stdout.write(result["output"])
+        if result["reason"] != HALTED:
+            print(f"core {result['core']} stopped: {result['reason']} after "
+                  f"{result['cycles']} instructions", file=sys.stderr)
+            ok = False
+    sys.stdout.flush()
+
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,92 @@
+"""
+LS-8 instruction set, shared by the emulator (cpu.py) and the assembler
+(asm/asm.py).
+
+Meanings of the bits in the first byte of each instruction: AABCDDDD
+
+* AA   Number of operands for this opcode, 0-2
+* B    1 if this is an ALU operation
+* C    1 if this instruction sets the PC
+* DDDD Instruction identifier
+"""
+
+NOP = 0b00000000
+HLT = 0b00000001
+LDI = 0b10000010
+LD = 0b10000011
+ST = 0b10000100
+TAS = 0b10000101  # test and set, for multi-core locks, see multicore.py
+PUSH = 0b01000101
+POP = 0b01000110
+PRN = 0b01000111
+PRA = 0b01001000
+
+# handled by ALU, DDDD selects the operation
+ADD = 0b10100000
+SUB = 0b10100001
+MUL = 0b10100010
+DIV = 0b10100011
+MOD = 0b10100100
+INC = 0b01100101
+DEC = 0b01100110
+CMP = 0b10100111
+AND = 0b10101000
+NOT = 0b01101001
+OR = 0b10101010
+XOR = 0b10101011
+SHL = 0b10101100
+SHR = 0b10101101
+
+# the following explicitly set the PC
+CALL = 0b01010000
+RET = 0b00010001
+INT = 0b01010010
+IRET = 0b00010011
+JMP = 0b01010100
+JEQ = 0b01010101
+JNE = 0b01010110
+JGT = 0b01010111
+JLT = 0b01011000
+JLE = 0b01011001
+JGE = 0b01011010
+
+# mnemonic -> machine code, for every instruction
+OPCODES = {
+    name: globals()[name] for name in (
+        "NOP", "HLT", "LDI", "LD", "ST", "TAS", "PUSH", "POP", "PRN", "PRA",
+        "ADD", "SUB", "MUL", "DIV", "MOD", "INC", "DEC", "CMP", "AND",
+        "NOT", "OR", "XOR", "SHL", "SHR",
+        "CALL", "RET", "INT", "IRET", "JMP", "JEQ", "JNE", "JGT", "JLT",
+        "JLE", "JGE",
+    )
+}
+
+# machine code -> mnemonic
+MNEMONICS = {code: name for name, code in OPCODES.items()}
+
+# instructions whose second operand is an immediate value, not a register
+IMMEDIATE = {LDI}
+
+
+def operand_count(ir):
+    """Number of operand bytes that follow the opcode (AA)."""
+    return ir >> 6
+
+
+def is_alu(ir):
+    """True for instructions handled by the ALU (B)."""
+    return bool(ir & 0b00100000)
+
+
+def sets_pc(ir):
+    """True for instructions that set the PC themselves (C)."""
+    return bool(ir & 0b00010000)
+
+
+def instruction_id(ir):
+    """The instruction identifier (DDDD); for ALU ops, the operation."""
+    return ir & 0b00001111
+
+
+# total instruction length in bytes, for every possible opcode
+SIZES = [operand_count(ir) + 1 for ir in range(256)]
@@ -0,0 +1,91 @@
+"""
+Output devices for PRN and PRA.
+
+A sink takes already-formatted bytes through write(), so the instruction
+handlers do no formatting or I/O of their own:
+
+* BufferedOutput collects output and writes it to a stream in large chunks
+* CaptureOutput keeps everything in memory, for tests and batch runs
+* NullOutput throws it away, for benchmarks
+"""
+
+import sys
+
+# what PRN prints for each register value, and PRA for each character
+PRN_TEXT = [b"%d\n" % value for value in range(256)]
+PRA_TEXT = [bytes([value]) for value in range(256)]
+
+
+class BufferedOutput:
+    """
+    Buffer output and write it to stream once flush_at bytes have built up,
+    and whenever flush() is called (CPU.run does every FLUSH_INTERVAL and at
+    the end of every run). flush_at=1 writes straight through, the default
+    for a terminal, where someone is watching.
+    """
+
+    def __init__(self, stream=None, flush_at=None):
+        self.stream = sys.stdout if stream is None else stream
+        if flush_at is None:
+            isatty = getattr(self.stream, "isatty", None)
+            flush_at = 1 if isatty is not None and isatty() else 8192
+        self.flush_at = flush_at
+        self.buffer = bytearray()
+
+    def write(self, data):
+        buffer = self.buffer
+        buffer += data
+        if len(buffer) >= self.flush_at:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        raw = getattr(self.stream, "buffer", None)
+        if raw is not None:
+            # text stream with a binary layer underneath, like sys.stdout
+            self.stream.flush()
+            raw.write(self.buffer)
+            raw.flush()
+        else:
+            self.stream.write(self.buffer.decode("latin-1"))
+            self.stream.flush()
+
+        self.buffer.clear()
+
+
+class CaptureOutput:
+    """Keep all output in memory."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        """The output so far, as a str."""
+        return self.data.decode("latin-1")
+
+    def clear(self):
+        self.data.clear()
+
+    def fork(self):
+        """A new CaptureOutput holding a copy of the output so far."""
+        output = CaptureOutput()
+        output.data += self.data
+        return output
+
+
+class NullOutput:
+    """Discard all output."""
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
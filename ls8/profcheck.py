@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+Check for the profiler's call stacks.
+
+Every program is profiled, and run again one instruction at a time on the
+interpreter, keeping count of the call depth from the CALLs and RETs it
+runs. The profiler must have counted the same number of instructions at
+every depth, with everything deeper than MAX_DEPTH counted at MAX_DEPTH,
+and its opcode and per-stack counts must add up to the instructions run.
+
+The programs are the examples and a few that recurse deeper than
+MAX_DEPTH.
+
+Usage: profcheck.py [file ...]
+"""
+
+import argparse
+import glob
+import os
+import sys
+
+from cpu import *
+from output import NullOutput
+from profiler import MAX_DEPTH, ProfilingCPU
+from program import read as read_program
+
+# instructions to run each program for
+MAX_CYCLES = 100000
+
+# recursion DEPTH levels deep and back, TIMES times; R1 counts the returns
+RECURSION = """\
+        LDI R3,0
+        LDI R4,{times}
+Again:
+        LDI R0,{depth}
+        LDI R2,Down
+        CALL R2
+        DEC R4
+        CMP R4,R3
+        LDI R2,Again
+        JNE R2
+        PRN R1
+        HLT
+Down:
+        CMP R0,R3
+        LDI R2,Done
+        JEQ R2
+        DEC R0
+        LDI R2,Down
+        CALL R2
+        INC R1
+Done:
+        RET
+"""
+
+DEEP = {
+    "recursion, deep": RECURSION.format(depth=150, times=10),
+    "recursion, at limit": RECURSION.format(depth=MAX_DEPTH - 1, times=3),
+    "recursion, one past": RECURSION.format(depth=MAX_DEPTH, times=3),
+}
+
+
+def depths(program):
+    """Instructions run at each call depth, by stepping the interpreter."""
+    cpu = CPU(output=NullOutput(), virtual_time=1000, fuse=False)
+    cpu.load_program(program)
+    counts = {}
+    depth = 0
+    while cpu.cycles < MAX_CYCLES:
+        ir = cpu.ram[cpu.pc]
+        result = cpu.run(max_cycles=1)
+        if result.cycles:
+            # an unknown opcode or a division by zero doesn't count
+            level = min(depth, MAX_DEPTH)
+            counts[level] = counts.get(level, 0) + 1
+        if result.reason != BUDGET:
+            break
+        if ir == CALL:
+            depth += 1
+        elif ir == RET and depth:
+            depth -= 1
+    return counts
+
+
+def compare(program):
+    """Check one program. Returns a list of the differences found."""
+    cpu = ProfilingCPU(output=NullOutput(), virtual_time=1000)
+    cpu.load_program(program)
+    cpu.run(max_cycles=MAX_CYCLES)
+
+    problems = []
+    if sum(cpu.opcode_counts) != cpu.cycles:
+        problems.append(f"opcode counts add up to {sum(cpu.opcode_counts)}, "
+                        f"not {cpu.cycles}")
+    if sum(cpu.frame_counts) != cpu.cycles:
+        problems.append(f"stack counts add up to {sum(cpu.frame_counts)}, "
+                        f"not {cpu.cycles}")
+
+    profiled = {}
+    for stack, count in zip(cpu.frame_stacks, cpu.frame_counts):
+        if count:
+            profiled[len(stack)] = profiled.get(len(stack), 0) + count
+    expected = depths(program)
+    for depth in sorted(set(profiled) | set(expected)):
+        if profiled.get(depth, 0) != expected.get(depth, 0):
+            problems.append(f"depth {depth}: {profiled.get(depth, 0)} "
+                            f"instructions, expected {expected.get(depth, 0)}")
+    return problems
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Check the profiler's call stack counts.")
+    parser.add_argument("files", nargs="*",
+                        help="programs to check (default: the examples)")
+    args = parser.parse_args(argv[1:])
+
+    files = args.files or sorted(
+        glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "examples", "*.ls8")))
+    programs = [(os.path.basename(path), read_program(path)) for path in files]
+    if not args.files:
+        # the assembler lives next door in asm/, see program.assemble_file()
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     "..", "asm"))
+        from asm import assemble
+        programs.extend((name, assemble(source, name))
+                        for name, source in DEEP.items())
+
+    failures = 0
+    for name, program in programs:
+        problems = compare(program)
+        print(f"{name:<20} {'FAIL' if problems else 'ok'}")
+        for problem in problems:
+            print(f"    {problem}")
+        failures += bool(problems)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
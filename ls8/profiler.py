@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+"""
+Execution profiler.
+
+ProfilingCPU counts instructions per opcode, per pair of consecutive
+opcodes, per PC, and per call stack (derived from CALL/RET), from which it
+works out inclusive and exclusive cycles per subroutine. The pair counts are
+what fusion.FUSED is chosen from. It has its own dispatch loop, so a plain
+CPU pays nothing for it.
+
+With sample_every=N, the regular dispatch loop runs N instructions at a time
+and only the instruction it stopped at is recorded, weighted by N. Counts are
+then estimates, but the overhead is close to zero.
+
+Usage: profiler.py [options] program.ls8
+"""
+
+import argparse
+import json
+import sys
+
+from cpu import *
+
+# deepest call stack tracked; deeper calls are counted against the last frame
+# (and their returns don't pop it)
+MAX_DEPTH = 64
+
+
+class ProfilingCPU(CPU):
+    """CPU that profiles everything it runs."""
+
+    def __init__(self, *args, sample_every=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sample_every = sample_every
+        # every instruction has to go through the profiling CALL and RET
+        # handlers, and be counted on its own
+        self.fuse = False
+
+        # instructions executed, by opcode and by pc, and by opcode and the
+        # opcode before it (pair_counts[previous << 8 | opcode])
+        self.opcode_counts = [0] * 256
+        self.pair_counts = [0] * 65536
+        self.previous = 0
+        self.pc_counts = [0] * 256
+
+        # call stacks are interned as frame ids; frame_counts[id] is the
+        # instructions executed with exactly that stack
+        self.frames = {}
+        self.frame_stacks = []
+        self.frame_counts = []
+        self.calls = [0] * 256
+        self.stack = []
+        # calls made past MAX_DEPTH and not returned from yet
+        self.overflow = 0
+        self.frame = self.intern(())
+
+        self.branchtable[CALL] = self.profile_call
+        self.branchtable[RET] = self.profile_ret
+
+    def intern(self, stack):
+        """Return the frame id of a call stack (a tuple of addresses)."""
+        frame = self.frames.get(stack)
+        if frame is None:
+            frame = self.frames[stack] = len(self.frame_stacks)
+            self.frame_stacks.append(stack)
+            self.frame_counts.append(0)
+        return frame
+
+    def profile_call(self, operand_a, operand_b):
+        self.handle_call(operand_a, operand_b)
+        self.calls[self.pc] += 1
+        if len(self.stack) < MAX_DEPTH:
+            self.stack.append(self.pc)
+            self.frame = self.intern(tuple(self.stack))
+        else:
+            self.overflow += 1
+
+    def profile_ret(self, operand_a, operand_b):
+        self.handle_ret(operand_a, operand_b)
+        if self.overflow:
+            self.overflow -= 1
+        elif self.stack:
+            self.stack.pop()
+            self.frame = self.intern(tuple(self.stack))
+
+    def dispatch(self, stop):
+        if self.sample_every > 1:
+            return self.dispatch_sampled(stop)
+
+        decoded = self.decoded
+        ram = self.ram
+        opcode_counts = self.opcode_counts
+        pair_counts = self.pair_counts
+        previous = self.previous
+        pc_counts = self.pc_counts
+        frame_counts = self.frame_counts
+        cycles = self.cycles
+
+        try:
+            while cycles < stop:
+                pc = self.pc
+                entry = decoded[pc]
+                if entry is None:
+                    entry = self.decode(pc)
+                    if entry is None:
+                        return UNKNOWN_OPCODE
+
+                opcode = ram[pc]
+                opcode_counts[opcode] += 1
+                pair_counts[previous << 8 | opcode] += 1
+                previous = opcode
+                pc_counts[pc] += 1
+                frame_counts[self.frame] += 1
+
+                handler, operand_a, operand_b, self.pc = entry
+                handler(operand_a, operand_b)
+                cycles += 1
+        except Reschedule:
+            cycles += 1
+        except Halt as e:
+            cycles += 1
+            return e.reason
+        except ZeroDivisionError:
+            self.pc = (self.pc - 3) & 0xff
+            return DIVISION_BY_ZERO
+        finally:
+            self.cycles = cycles
+            self.previous = previous
+
+        return None
+
+    def dispatch_sampled(self, stop):
+        """Run the regular loop in slices, sampling where each one stops."""
+        every = self.sample_every
+
+        while self.cycles < stop:
+            pc = self.pc
+            self.opcode_counts[self.ram[pc]] += every
+            self.pc_counts[pc] += every
+            self.frame_counts[self.frame] += every
+
+            cycles = self.cycles
+            reason = CPU.dispatch(self, min(stop, cycles + every))
+            if reason is not None:
+                return reason
+            if self.cycles < min(stop, cycles + every):
+                # rescheduled, let execute() check for interrupts
+                return None
+
+        return None
+
+    def name(self, address):
+        """Label for a subroutine entry address."""
+        if self.program is not None:
+            for label, value in self.program.symbols.items():
+                if value == address:
+                    return label
+        return f"sub_{address:02x}"
+
+    def where(self, pc):
+        """The source location of pc, if the program has a source map."""
+        if self.program is None or not self.program.source_map:
+            return ""
+        return self.program.location(pc)
+
+    def line_counts(self):
+        """Instructions executed per source line, from the source map."""
+        counts = {}
+        if self.program is not None:
+            source_map = self.program.source_map
+            for pc, count in enumerate(self.pc_counts):
+                line = source_map.get(pc)
+                if count and line is not None:
+                    counts[line] = counts.get(line, 0) + count
+        return counts
+
+    def subroutines(self):
+        """
+        Per subroutine: calls, and inclusive and exclusive instruction counts.
+        Returns a dict keyed by entry address.
+        """
+        result = {}
+        for stack, count in zip(self.frame_stacks, self.frame_counts):
+            if not count:
+                continue
+            for address in set(stack):
+                sub = result.setdefault(address, {
+                    "address": address,
+                    "name": self.name(address),
+                    "calls": self.calls[address],
+                    "inclusive": 0,
+                    "exclusive": 0,
+                })
+                sub["inclusive"] += count
+            if stack:
+                result[stack[-1]]["exclusive"] += count
+        return result
+
+    def pairs(self, top=None):
+        """
+        The most frequent pairs of consecutive opcodes, as a list of
+        ("FIRST SECOND", count), most frequent first. Exact profiles only.
+        """
+        pairs = sorted(((count, pair) for pair, count in enumerate(self.pair_counts)
+                        if count), reverse=True)[:top]
+        return [(f"{MNEMONICS.get(pair >> 8, f'{pair >> 8:02X}')} "
+                 f"{MNEMONICS.get(pair & 0xff, f'{pair & 0xff:02X}')}", count)
+                for count, pair in pairs]
+
+    def to_json(self):
+        """The profile as a JSON-serialisable dict."""
+        return {
+            "cycles": self.cycles,
+            "sample_every": self.sample_every,
+            "opcodes": {
+                MNEMONICS.get(op, f"{op:02X}"): count
+                for op, count in enumerate(self.opcode_counts) if count
+            },
+            "pairs": dict(self.pairs()),
+            "pcs": {
+                f"{pc:02X}": count
+                for pc, count in enumerate(self.pc_counts) if count
+            },
+            "lines": {
+                str(line): count
+                for line, count in sorted(self.line_counts().items())
+            },
+            "subroutines": sorted(self.subroutines().values(),
+                                  key=lambda sub: -sub["inclusive"]),
+        }
+
+    def collapsed(self):
+        """
+        The profile in the collapsed-stack format flamegraph tools read: one
+        line per call stack, frames separated by ";", then the count.
+        """
+        lines = []
+        for stack, count in zip(self.frame_stacks, self.frame_counts):
+            if count:
+                names = ["main"] + [self.name(address) for address in stack]
+                lines.append(f"{';'.join(names)} {count}\n")
+        return "".join(lines)
+
+    def print_report(self, file=sys.stderr, top=10):
+        """Print a short human-readable summary."""
+        total = sum(self.opcode_counts) or 1
+        print(f"{self.cycles} instructions", file=file)
+
+        print("\nopcode      count      %", file=file)
+        ops = sorted(range(256), key=lambda op: -self.opcode_counts[op])
+        for op in ops[:top]:
+            count = self.opcode_counts[op]
+            if count:
+                print(f"{MNEMONICS.get(op, hex(op)):<6} {count:>10} {100 * count / total:6.1f}",
+                      file=file)
+
+        if self.sample_every == 1:
+            print("\nopcode pair      count      %", file=file)
+            for pair, count in self.pairs(top):
+                print(f"{pair:<11} {count:>10} {100 * count / total:6.1f}",
+                      file=file)
+
+        print("\npc          count      %", file=file)
+        pcs = sorted(range(256), key=lambda pc: -self.pc_counts[pc])
+        for pc in pcs[:top]:
+            count = self.pc_counts[pc]
+            if count:
+                print(f"{pc:02X}     {count:>10} {100 * count / total:6.1f}  {self.where(pc)}".rstrip(),
+                      file=file)
+
+        subs = self.to_json()["subroutines"]
+        if subs:
+            print("\nsubroutine       calls  inclusive  exclusive", file=file)
+            for sub in subs[:top]:
+                print(f"{sub['name']:<14} {sub['calls']:>7} {sub['inclusive']:>10} {sub['exclusive']:>10}",
+                      file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Profile an LS-8 program.")
+    parser.add_argument("program", help="the .asm, .ls8 or .ls8b file to run")
+    parser.add_argument("--sample", type=int, default=1, metavar="N",
+                        help="only sample every Nth instruction")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the profile as JSON")
+    parser.add_argument("--collapsed", metavar="FILE",
+                        help="write collapsed stacks for flamegraph tools")
+    parser.add_argument("--max-cycles", type=int,
+                        help="stop after this many instructions")
+    args = parser.parse_args(argv[1:])
+
+    cpu = ProfilingCPU(sample_every=args.sample)
+    cpu.load(args.program)
+    cpu.run(max_cycles=args.max_cycles)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(cpu.to_json(), f, indent=2)
+    if args.collapsed:
+        with open(args.collapsed, "w") as f:
+            f.write(cpu.collapsed())
+    cpu.print_report()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+LS-8 program images.
+
+A binary image (.ls8b) is laid out as:
+
+    offset  size  field
+    0       4     magic, b"LS8\\0"
+    4       1     format version
+    5       1     entry point (initial PC)
+    6       2     code length n, little-endian
+    8       n     code, copied to RAM starting at address 0
+    8+n     ...   symbol table: per symbol, a length byte, the name in
+                  ASCII, and the address byte
+
+Text .ls8 files are converted on first use and the image is cached in a
+__ls8cache__ directory next to the source, keyed by the hash of the text, so
+later runs skip the parsing. .asm source is assembled in process, and only
+then does the Program carry a source map; images and .ls8 text don't keep
+one.
+
+Usage: program.py infile.ls8 outfile.ls8b
+"""
+
+import hashlib
+import mmap
+import os
+import re
+import struct
+import sys
+
+MAGIC = b"LS8\0"
+VERSION = 1
+HEADER = struct.Struct("<4sBBH")
+
+CACHE_DIR = "__ls8cache__"
+
+# label comments the assembler writes into .ls8 files
+LABEL_COMMENT = re.compile(r"#\s*(\w+) \(address (\d+)\):")
+
+
+class Program:
+    """
+    Machine code plus the metadata needed to load and run it. source_map maps
+    addresses to the source line each instruction came from, and source is
+    the name of the source file, when the program was assembled in process.
+    """
+
+    def __init__(self, code, entry=0, symbols=None, source_map=None,
+                 source=None):
+        if len(code) > 256:
+            raise ValueError(f"program is {len(code)} bytes, RAM only holds 256")
+        self.code = bytes(code)
+        self.entry = entry
+        self.symbols = dict(symbols or {})
+        self.source_map = dict(source_map or {})
+        self.source = source
+
+    def label(self, address):
+        """
+        The nearest label at or before address, as "LABEL" or "LABEL+n", or
+        None if there isn't one.
+        """
+        best = None
+        for name, value in self.symbols.items():
+            if value <= address and (best is None or value > best[1]):
+                best = (name, value)
+        if best is None:
+            return None
+        name, value = best
+        return name if value == address else f"{name}+{address - value}"
+
+    def location(self, address):
+        """
+        Where address is in the source, e.g. "LOOP+2 (print8.asm:14)", as far
+        as the symbols and source map tell. Falls back to the bare address.
+        """
+        where = self.label(address) or f"{address:02X}"
+        line = self.source_map.get(address)
+        if line is not None:
+            where += f" ({self.source}:{line})" if self.source else f" (line {line})"
+        return where
+
+    def to_bytes(self):
+        """
+        Return the binary image. Raises ValueError if the entry point or a
+        label is outside RAM, since the image keeps them in a byte each.
+        """
+        if not 0 <= self.entry <= 0xff:
+            raise ValueError(f"entry point {self.entry} is outside RAM")
+        for name, address in self.symbols.items():
+            if not 0 <= address <= 0xff:
+                raise ValueError(f"label {name} is at address {address}, outside RAM")
+
+        parts = [HEADER.pack(MAGIC, VERSION, self.entry, len(self.code)),
+                 self.code]
+        for name, address in self.symbols.items():
+            name = name.encode("ascii")
+            parts.append(bytes([len(name)]) + name + bytes([address]))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, image):
+        """Parse a binary image from a buffer (bytes, mmap, memoryview...)."""
+        magic, version, entry, length = HEADER.unpack_from(image)
+        if magic != MAGIC:
+            raise ValueError("not an LS-8 program image")
+        if version != VERSION:
+            raise ValueError(f"unsupported image version {version}")
+
+        start = HEADER.size
+        code = image[start:start + length]
+
+        symbols = {}
+        offset = start + length
+        while offset < len(image):
+            size = image[offset]
+            name = bytes(image[offset + 1:offset + 1 + size]).decode("ascii")
+            symbols[name] = image[offset + 1 + size]
+            offset += size + 2
+
+        return cls(code, entry, symbols)
+
+    @classmethod
+    def from_text(cls, lines):
+        """Parse the lines of a text .ls8 file."""
+        code = bytearray()
+        symbols = {}
+
+        for line in lines:
+            val, _, comment = line.partition("#")
+            val = val.strip()
+            if val != '':
+                code.append(int(val, 2))
+            elif comment:
+                m = LABEL_COMMENT.match("#" + comment)
+                # a label past the last byte of RAM, like an end label
+                # after a full 256 bytes, has nothing to name
+                if m is not None and int(m.group(2)) <= 0xff:
+                    symbols[m.group(1)] = int(m.group(2))
+
+        return cls(code, symbols=symbols)
+
+    def save(self, path):
+        """Write the binary image to path."""
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+
+def is_image(path):
+    """True if the file at path is a binary image rather than .ls8 text."""
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_image(path):
+    """Read a binary image through mmap."""
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as image:
+            return Program.from_bytes(image)
+
+
+def cache_path(path, text):
+    """Where the converted image of the .ls8 text at path is cached."""
+    digest = hashlib.sha256(text).hexdigest()[:16]
+    directory, name = os.path.split(os.path.abspath(path))
+    stem = os.path.splitext(name)[0]
+    return os.path.join(directory, CACHE_DIR, f"{stem}.{digest}.ls8b")
+
+
+def assemble_file(path):
+    """Assemble the .asm file at path in process."""
+    # the assembler lives next door in asm/
+    asm_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                           "asm")
+    if asm_dir not in sys.path:
+        sys.path.append(asm_dir)
+    from asm import assemble
+
+    with open(path) as f:
+        return assemble(f, os.path.basename(path))
+
+
+def read(path):
+    """
+    Read the program at path: a binary image, .asm source, which is
+    assembled in process, or an .ls8 text file, which is converted through
+    the on-disk cache.
+    """
+    if path.endswith(".asm"):
+        return assemble_file(path)
+
+    if is_image(path):
+        return read_image(path)
+
+    with open(path, "rb") as f:
+        text = f.read()
+
+    cached = cache_path(path, text)
+    if os.path.exists(cached):
+        return read_image(cached)
+
+    program = Program.from_text(text.decode().splitlines())
+
+    # write to a temporary file first so concurrent runs never see half an
+    # image; a read-only directory just means no caching
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp = f"{cached}.{os.getpid()}.tmp"
+        program.save(tmp)
+        os.replace(tmp, cached)
+    except OSError:
+        pass
+
+    return program
+
+
+def main(argv):
+    if len(argv) != 3:
+        print("usage: program.py infile.ls8 outfile.ls8b", file=sys.stderr)
+        return 1
+
+    read(argv[1]).save(argv[2])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
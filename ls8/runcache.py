@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""
+A persistent cache of run results.
+
+Runs are deterministic, so a run from the same machine state, with the same
+keys waiting and the same limits, on the same engine, ends the same way
+every time. RunCache.run() keys a run by a hash of all that, and on a hit
+puts the CPU in the state the run ended in and writes out the output it
+printed, without running a single instruction.
+
+Results live in an SQLite database, so worker processes can share one. Once
+the entries add up to more than max_size bytes, the least recently used go.
+Hits, misses and bypasses are counted in the database too.
+
+Some runs can't be cached, and are run as normal:
+
+* in wall clock time, once interrupts are unmasked, since when the timer
+  fires depends on how fast the host is
+* runs stopped by max_time
+* on a CPU with a device that isn't deterministic (see mmio.Device)
+
+Usage: runcache.py stats|clear CACHE
+"""
+
+import argparse
+import hashlib
+import sqlite3
+import sys
+import time
+
+from cpu import *
+from snapshot import Snapshot
+
+# bump when a change to the engines changes what a program does, so
+# results from before it aren't used
+CACHE_VERSION = 1
+
+# default size limit, in bytes
+MAX_SIZE = 64 * 1024 * 1024
+
+# rough size of an entry on top of its output and state
+ENTRY_OVERHEAD = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    key TEXT PRIMARY KEY,
+    reason TEXT NOT NULL,
+    cycles INTEGER NOT NULL,
+    output BLOB NOT NULL,
+    state BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_used ON runs (used);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+COUNTERS = ("hits", "misses", "bypasses", "evictions", "bytes")
+
+
+class RecordingOutput:
+    """Passes output through to another device, keeping a copy."""
+
+    def __init__(self, output):
+        self.inner = output
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        self.inner.write(data)
+
+    def flush(self):
+        self.inner.flush()
+
+    def __getattr__(self, name):
+        # getvalue() and the like, for RunResult
+        return getattr(self.inner, name)
+
+
+def deterministic(cpu):
+    """True if every device on cpu is deterministic."""
+    return all(getattr(device, "deterministic", False)
+               for device in set(cpu.devices) if device is not None)
+
+
+def run_key(cpu, max_cycles):
+    """The cache key of a run from cpu's current state."""
+    h = hashlib.sha256()
+    devices = sorted(type(device).__name__
+                     for device in set(cpu.devices) if device is not None)
+    h.update(repr((CACHE_VERSION, type(cpu).__name__, devices,
+                   cpu.virtual_time, max_cycles)).encode())
+    h.update(cpu.snapshot().to_bytes())
+    return h.hexdigest()
+
+
+class RunCache:
+    """Run results in an SQLite database at path."""
+
+    def __init__(self, path, max_size=MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        # several processes can share the database; wait for their writes
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def count(self, name, n=1):
+        self.db.execute(
+            "INSERT INTO counters VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (name, n))
+
+    def run(self, cpu, max_cycles=None, max_time=None):
+        """
+        Like cpu.run(), but from the cache when it can be. The RunResult's
+        cached attribute says whether it was.
+        """
+        if not deterministic(cpu):
+            self.count("bypasses")
+            result = cpu.run(max_cycles=max_cycles, max_time=max_time)
+            result.cached = False
+            return result
+
+        key = run_key(cpu, max_cycles)
+        row = self.db.execute(
+            "SELECT reason, cycles, output, state FROM runs WHERE key = ?",
+            (key,)).fetchone()
+        if row is not None:
+            reason, cycles, output, state = row
+            self.db.execute("UPDATE runs SET used = ? WHERE key = ?",
+                            (time.time(), key))
+            self.count("hits")
+
+            started = time.perf_counter()
+            cpu.restore(Snapshot.from_bytes(state))
+            cpu.output.write(output)
+            cpu.output.flush()
+            result = RunResult(cpu, reason, cycles,
+                               time.perf_counter() - started)
+            result.cached = True
+            return result
+
+        output = cpu.output
+        recorder = RecordingOutput(output)
+        cpu.output = recorder
+        try:
+            result = cpu.run(max_cycles=max_cycles, max_time=max_time)
+        finally:
+            cpu.output = output
+        result.cached = False
+
+        if cpu.virtual_time is None and cpu.next_tick is not None:
+            # the wall clock timer was running
+            self.count("bypasses")
+        elif result.reason == BUDGET and (max_cycles is None
+                                          or result.cycles < max_cycles):
+            # stopped by max_time
+            self.count("bypasses")
+        else:
+            self.count("misses")
+            self.store(key, result, bytes(recorder.data),
+                       cpu.snapshot().to_bytes())
+        return result
+
+    def store(self, key, result, output, state):
+        size = len(key) + len(output) + len(state) + ENTRY_OVERHEAD
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # another process may have stored the same run meanwhile
+            stored = db.execute(
+                "INSERT OR IGNORE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, result.reason, result.cycles, output, state, size,
+                 time.time())).rowcount
+            if stored:
+                self.count("bytes", size)
+                self.evict()
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def evict(self):
+        """Drop the least recently used entries until under max_size."""
+        db = self.db
+        total = self.counter("bytes")
+        if total <= self.max_size:
+            return
+
+        victims = []
+        freed = 0
+        for key, size in db.execute("SELECT key, size FROM runs ORDER BY used"):
+            if total - freed <= self.max_size:
+                break
+            victims.append((key,))
+            freed += size
+        db.executemany("DELETE FROM runs WHERE key = ?", victims)
+        self.count("bytes", -freed)
+        self.count("evictions", len(victims))
+
+    def counter(self, name):
+        row = self.db.execute("SELECT value FROM counters WHERE name = ?",
+                              (name,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def stats(self):
+        """The counters, the number of entries and the hit rate."""
+        stats = {name: self.counter(name) for name in COUNTERS}
+        stats["entries"] = self.db.execute(
+            "SELECT COUNT(*) FROM runs").fetchone()[0]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        self.db.execute("DELETE FROM runs")
+        self.db.execute("DELETE FROM counters")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Inspect an LS-8 run cache.")
+    parser.add_argument("command", choices=["stats", "clear"])
+    parser.add_argument("cache", help="the cache database")
+    args = parser.parse_args(argv[1:])
+
+    cache = RunCache(args.cache)
+    if args.command == "stats":
+        for name, value in cache.stats().items():
+            print(f"{name}: {value:.2f}" if isinstance(value, float)
+                  else f"{name}: {value}")
+    else:
+        cache.clear()
+    cache.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+
+"""
+Job server: runs LS-8 programs for clients over a local Unix socket, on a
+pool of worker processes that each keep one CPU and reset it between jobs
+(see batch.py), so a job costs neither a Python startup nor a CPU().
+
+Every message, either way, is a frame: a 4-byte big-endian length, then
+that many bytes. A request is a frame of JSON,
+
+    {"op": "run", "id": 7, "input": "hi", "max_cycles": 100000,
+     "max_time": 0.5}
+
+and for "run" a second frame with the program as a binary image (.ls8b,
+see program.py). The answer to a run is a JSON frame with the result, as
+batch.run_job() makes it, sent as soon as the job is done: jobs on one
+connection finish in any order, and the id tells them apart. {"op":
+"stats", "id": 8} is answered with the queue depth, jobs running and done,
+jobs per second over the last STATS_WINDOW seconds, and the 50th, 90th and
+99th percentile latency, from the request coming in to the result going
+out, of the last LATENCY_SAMPLES jobs.
+
+Jobs wait in a queue of at most queue_size. When it's full the server
+stops reading requests until a worker frees up, so a client sending faster
+than the pool can run blocks in its writes, rather than the server
+buffering without bound. The server's max_cycles and max_time cap every
+job; a job can ask for less. There is always a time limit, MAX_TIME unless
+the server is given one, so shutting down, which waits for the jobs
+running, never waits on a program that doesn't halt. A worker moves on to
+the next job as soon as it has a result, while the result is sent; a
+client that doesn't take a result within SEND_TIMEOUT seconds is
+disconnected.
+
+Client talks to a server from the same program as well as another:
+
+    async with Server(path) as server, Client(path) as client:
+        result = await client.run(program, input="hi")
+
+Usage:
+    server.py serve [options] SOCKET
+    server.py run SOCKET program [--input TEXT]
+    server.py stats SOCKET
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import signal
+import struct
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from batch import init_worker, run_job
+from program import Program, read as read_program
+
+FRAME = struct.Struct(">I")
+
+# the largest frame either end accepts; an image is at most a few hundred
+# bytes
+MAX_FRAME = 1 << 16
+
+# jobs waiting for a worker before the server stops reading requests
+QUEUE_SIZE = 64
+
+# time limit for every job when the server isn't given one, in seconds
+MAX_TIME = 10.0
+
+# the stats window for jobs per second, in seconds, and how many of the
+# latest latencies the percentiles are taken over
+STATS_WINDOW = 10.0
+LATENCY_SAMPLES = 1000
+
+# how long a client has to take a result, in seconds
+SEND_TIMEOUT = 30.0
+
+
+async def read_frame(reader):
+    """Read one frame. Returns None at the end of the stream."""
+    try:
+        header = await reader.readexactly(FRAME.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+    length, = FRAME.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError(f"frame of {length} bytes is too big")
+    return await reader.readexactly(length)
+
+
+def frame(data):
+    """data as a frame, ready to write."""
+    return FRAME.pack(len(data)) + data
+
+
+def cap(requested, limit):
+    """The smaller of two limits, either of which may be None."""
+    if limit is None:
+        return requested
+    if requested is None:
+        return limit
+    return min(requested, limit)
+
+
+def percentile(samples, p):
+    """The p-th percentile of sorted samples, by nearest rank."""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+class Connection:
+    """A client connection, with the jobs it's still waiting on."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        # results for one connection are written by many runners
+        self.lock = asyncio.Lock()
+        self.dropped = False
+
+    async def send(self, message):
+        async with self.lock:
+            if self.dropped:
+                return
+            try:
+                self.writer.write(frame(json.dumps(message).encode()))
+                await asyncio.wait_for(self.writer.drain(), SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                # the client isn't reading; drop it, and its other results
+                self.dropped = True
+                self.writer.transport.abort()
+            except ConnectionError:
+                # the client went away; its results have nowhere to go
+                pass
+
+    def started(self):
+        self.pending += 1
+        self.idle.clear()
+
+    def finished(self):
+        self.pending -= 1
+        if self.pending == 0:
+            self.idle.set()
+
+
+class Server:
+    """
+    Serves jobs on the Unix socket at path, with a pool of workers worker
+    processes (default: one per core).
+    """
+
+    def __init__(self, path, workers=None, jit=False, max_cycles=None,
+                 max_time=None, queue_size=QUEUE_SIZE):
+        self.path = path
+        self.workers = workers or os.cpu_count()
+        self.jit = jit
+        self.max_cycles = max_cycles
+        self.max_time = MAX_TIME if max_time is None else max_time
+        self.queue_size = queue_size
+        self.server = None
+        self.pool = None
+        self.runners = []
+        # results being sent
+        self.replies = set()
+
+        self.running = 0
+        self.completed = 0
+        self.errors = 0
+        self.clients = 0
+        self.started_at = None
+        # completion times within the stats window, and the latest latencies
+        self.finish_times = deque()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    async def start(self):
+        """Start the workers, wait until they're up, and start listening."""
+        loop = asyncio.get_running_loop()
+        self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                        initializer=init_worker,
+                                        initargs=(self.jit,))
+        # have every worker built and holding its CPU before the first job
+        await asyncio.gather(*(loop.run_in_executor(self.pool, os.getpid)
+                               for _ in range(self.workers)))
+
+        self.queue = asyncio.Queue(self.queue_size)
+        self.runners = [asyncio.create_task(self.runner())
+                        for _ in range(self.workers)]
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_client,
+                                                      self.path)
+        self.started_at = time.perf_counter()
+
+    async def close(self):
+        """Stop listening, drop queued jobs and shut the workers down."""
+        self.server.close()
+        await self.server.wait_closed()
+        tasks = self.runners + list(self.replies)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.pool.shutdown(cancel_futures=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def handle_client(self, reader, writer):
+        conn = Connection(writer)
+        self.clients += 1
+        try:
+            while True:
+                data = await read_frame(reader)
+                if data is None:
+                    break
+                request = json.loads(data)
+                if not isinstance(request, dict):
+                    raise ValueError("a request is a JSON object")
+                for limit in ("max_cycles", "max_time"):
+                    value = request.get(limit)
+                    if value is not None and not isinstance(value, (int, float)):
+                        raise ValueError(f"{limit} isn't a number")
+                op = request.get("op", "run")
+
+                if op == "stats":
+                    await conn.send(dict(self.stats(), id=request.get("id")))
+                elif op == "run":
+                    image = await read_frame(reader)
+                    if image is None:
+                        break
+                    job = {
+                        "id": request.get("id"),
+                        "image": image,
+                        "max_cycles": cap(request.get("max_cycles"),
+                                          self.max_cycles),
+                        "max_time": cap(request.get("max_time"),
+                                        self.max_time),
+                    }
+                    if "input" in request:
+                        job["input"] = request["input"]
+                    conn.started()
+                    # blocks while the queue is full, which is the
+                    # backpressure: nothing more is read from this client
+                    await self.queue.put((job, conn, time.perf_counter()))
+                else:
+                    await conn.send({"id": request.get("id"),
+                                     "error": f"unknown op {op!r}"})
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError) as e:
+            await conn.send({"error": f"bad request: {e}"})
+        finally:
+            # a client that has finished sending still gets its results
+            await conn.idle.wait()
+            self.clients -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def runner(self):
+        """Feed queued jobs to the pool, one at a time."""
+        loop = asyncio.get_running_loop()
+        while True:
+            job, conn, received = await self.queue.get()
+            self.running += 1
+            try:
+                result = await loop.run_in_executor(self.pool, run_job, job)
+            except Exception as e:
+                # a worker died, say
+                result = {"id": job["id"], "error": f"{type(e).__name__}: {e}"}
+            finally:
+                self.running -= 1
+
+            # send it on the side, so a client slow to read holds up only
+            # its own results, not the worker
+            reply = asyncio.create_task(self.reply(conn, result, received))
+            self.replies.add(reply)
+            reply.add_done_callback(self.replies.discard)
+
+    async def reply(self, conn, result, received):
+        await conn.send(result)
+        conn.finished()
+        self.record(result, time.perf_counter() - received)
+
+    def record(self, result, latency):
+        now = time.perf_counter()
+        self.completed += 1
+        self.errors += "error" in result
+        self.latencies.append(latency)
+        self.finish_times.append(now)
+        while self.finish_times[0] < now - STATS_WINDOW:
+            self.finish_times.popleft()
+
+    def stats(self):
+        """The server's counters, as sent for {"op": "stats"}."""
+        now = time.perf_counter()
+        while self.finish_times and self.finish_times[0] < now - STATS_WINDOW:
+            self.finish_times.popleft()
+        window = min(STATS_WINDOW, now - self.started_at) or STATS_WINDOW
+        latencies = sorted(self.latencies)
+
+        return {
+            "queued": self.queue.qsize(),
+            "running": self.running,
+            "completed": self.completed,
+            "errors": self.errors,
+            "clients": self.clients,
+            "workers": self.workers,
+            "uptime": now - self.started_at,
+            "jobs_per_sec": len(self.finish_times) / window,
+            "latency_ms": {
+                f"p{p}": None if not latencies
+                else percentile(latencies, p) * 1000
+                for p in (50, 90, 99)
+            },
+        }
+
+
+class Client:
+    """
+    A connection to a Server. Any number of jobs can be in flight on it at
+    once, from as many tasks.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = itertools.count()
+        # request id -> the future its answer goes to
+        self.waiting = {}
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.receiver = asyncio.create_task(self.receive())
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.receiver.cancel()
+        await asyncio.gather(self.receiver, return_exceptions=True)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def receive(self):
+        try:
+            while True:
+                data = await read_frame(self.reader)
+                if data is None:
+                    break
+                message = json.loads(data)
+                future = self.waiting.pop(message.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        finally:
+            for future in self.waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("server went away"))
+            self.waiting.clear()
+
+    async def request(self, request, *frames):
+        request["id"] = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[request["id"]] = future
+        self.writer.write(frame(json.dumps(request).encode()) +
+                          b"".join(frame(data) for data in frames))
+        await self.writer.drain()
+        return await future
+
+    async def run(self, program, input=None, max_cycles=None, max_time=None):
+        """
+        Run program, a Program or a binary image, on the server. Returns the
+        result dict.
+        """
+        if isinstance(program, Program):
+            program = program.to_bytes()
+        request = {"op": "run"}
+        if input is not None:
+            request["input"] = input
+        if max_cycles is not None:
+            request["max_cycles"] = max_cycles
+        if max_time is not None:
+            request["max_time"] = max_time
+        return await self.request(request, bytes(program))
+
+    async def stats(self):
+        """The server's stats dict."""
+        return await self.request({"op": "stats"})
+
+
+async def serve(args):
+    server = Server(args.socket, args.workers, args.jit, args.max_cycles,
+                    args.max_time, args.queue_size)
+    # serve until interrupted or told to stop
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    async with server:
+        print(f"serving on {args.socket} with {server.workers} workers",
+              file=sys.stderr)
+        await stop.wait()
+
+
+async def submit(args):
+    async with Client(args.socket) as client:
+        if args.command == "stats":
+            print(json.dumps(await client.stats(), indent=2))
+            return 0
+        result = await client.run(read_program(args.program), args.input,
+                                  args.max_cycles, args.max_time)
+        print(json.dumps(result))
+        return 0 if result.get("reason") == "halted" else 1
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Serve LS-8 jobs on a Unix socket, or send it some.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("serve", help="run the server")
+    p.add_argument("socket", help="path of the Unix socket to listen on")
+    p.add_argument("-j", "--workers", type=int,
+                   help="worker processes (default: one per core)")
+    p.add_argument("--jit", action="store_true",
+                   help="run on the basic-block JIT")
+    p.add_argument("--max-cycles", type=int,
+                   help="instruction limit for every job")
+    p.add_argument("--max-time", type=float, default=MAX_TIME,
+                   help=f"time limit for every job, in seconds (default: {MAX_TIME})")
+    p.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                   help=f"jobs that can wait for a worker (default: {QUEUE_SIZE})")
+
+    p = commands.add_parser("run", help="run a program on a server")
+    p.add_argument("socket", help="the server's Unix socket")
+    p.add_argument("program", help="the .asm, .ls8 or .ls8b file to run")
+    p.add_argument("--input", help="keystrokes for the keyboard")
+    p.add_argument("--max-cycles", type=int,
+                   help="stop after this many instructions")
+    p.add_argument("--max-time", type=float,
+                   help="stop after this many seconds")
+
+    p = commands.add_parser("stats", help="print a server's stats")
+    p.add_argument("socket", help="the server's Unix socket")
+
+    args = parser.parse_args(argv[1:])
+
+    if args.command == "serve":
+        asyncio.run(serve(args))
+        return 0
+    return asyncio.run(submit(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
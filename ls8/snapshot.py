@@ -0,0 +1,79 @@
+"""
+Machine state snapshots, see CPU.snapshot() and CPU.restore().
+
+A snapshot file (.ls8s) is laid out as:
+
+    offset  size  field
+    0       4     magic, b"LS8S"
+    4       1     format version
+    5       1     PC
+    6       1     FL
+    7       1     flags: bit 0 interrupts enabled, bit 1 next_tick is set
+    8       8     instructions executed, little-endian
+    16      8     next virtual timer tick, little-endian
+    24      2     pending keystrokes n, little-endian
+    26      8     R0-R7
+    34      256   RAM
+    290     n     pending keystrokes
+"""
+
+import os
+import struct
+from collections import namedtuple
+
+MAGIC = b"LS8S"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBBQQH8s256s")
+
+INTERRUPTS_ENABLED = 0b01
+HAS_NEXT_TICK = 0b10
+
+
+class Snapshot(namedtuple("Snapshot", [
+        "ram", "reg", "pc", "fl", "cycles", "interrupts_enabled",
+        "next_tick", "keys"])):
+    """
+    The complete state of a CPU, immutable. ram, reg and keys are bytes;
+    next_tick is only kept in virtual time, since a wall clock deadline
+    means nothing once restored.
+    """
+
+    __slots__ = ()
+
+    def to_bytes(self):
+        flags = INTERRUPTS_ENABLED if self.interrupts_enabled else 0
+        if self.next_tick is not None:
+            flags |= HAS_NEXT_TICK
+        return HEADER.pack(MAGIC, VERSION, self.pc, self.fl, flags,
+                           self.cycles, self.next_tick or 0, len(self.keys),
+                           self.reg, self.ram) + self.keys
+
+    @classmethod
+    def from_bytes(cls, data):
+        (magic, version, pc, fl, flags, cycles, next_tick, key_count, reg,
+         ram) = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("not an LS-8 snapshot")
+        if version != VERSION:
+            raise ValueError(f"unsupported snapshot version {version}")
+
+        keys = bytes(data[HEADER.size:HEADER.size + key_count])
+        if len(keys) != key_count:
+            raise ValueError("snapshot is truncated")
+        return cls(ram, reg, pc, fl, cycles, bool(flags & INTERRUPTS_ENABLED),
+                   next_tick if flags & HAS_NEXT_TICK else None, keys)
+
+    def save(self, path):
+        """
+        Write the snapshot to path. A temporary file is renamed into place,
+        so a crash never leaves half a checkpoint behind.
+        """
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.to_bytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
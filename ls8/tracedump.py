@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Decode a binary trace written by tracer.py.
+
+By default every record is printed in the same TRACE: format CPU.trace()
+uses, optionally with the instruction disassembled. With --replay the run is
+instead repeated on a fresh CPU from the initial state in the dump, and every
+record is checked against the state the CPU is actually in, to confirm the
+program is deterministic.
+
+The dump holds no source map, but given the .asm source with --source, each
+record is labelled with the label and source line its PC came from.
+
+Usage: tracedump.py [--disassemble | --replay] [--source prog.asm] trace.ls8t
+"""
+
+import argparse
+import sys
+
+from cpu import *
+from program import assemble_file
+from tracer import Trace
+
+
+def disassemble(ir, operand_a, operand_b):
+    """The instruction as assembly, e.g. "LDI R0,8"."""
+    name = MNEMONICS.get(ir)
+    if name is None:
+        return f"DB 0x{ir:02X}"
+
+    operands = []
+    if operand_count(ir) >= 1:
+        operands.append(f"R{operand_a & 0b111}")
+    if operand_count(ir) >= 2:
+        if ir in IMMEDIATE:
+            operands.append(str(operand_b))
+        else:
+            operands.append(f"R{operand_b & 0b111}")
+    return f"{name} {','.join(operands)}".rstrip()
+
+
+def format_record(pc, ir, operand_a, operand_b, fl, registers):
+    """A record as the line CPU.trace() would have printed."""
+    return "TRACE: %02X | %02X %02X %02X | %s" % (
+        pc, ir, operand_a, operand_b, registers.hex(" ").upper())
+
+
+def replay(trace, virtual_time=None, file=sys.stdout):
+    """
+    Rerun the traced program on a fresh CPU and compare each record with the
+    CPU's state. Returns the number of mismatches. Programs that use the
+    timer only replay the same if they were traced in virtual time, with the
+    same virtual_time, and keyboard input isn't replayed.
+    """
+    cpu = CPU(output=NullOutput(), virtual_time=virtual_time)
+    cpu.ram[:] = trace.ram
+    cpu.reg[:] = trace.registers
+    cpu.pc = trace.pc
+    cpu.fl = trace.fl
+
+    # get to the oldest instruction in the dump; the ones before it weren't
+    # kept, so they can only be run
+    if trace.first:
+        cpu.run(max_cycles=trace.first)
+
+    mismatches = 0
+    for n, record in enumerate(trace, trace.first):
+        if cpu.reg[IM]:
+            # CPU.execute() checks for interrupts before running anything
+            cpu.poll_interrupts(cpu.cycles + 1)
+        pc = cpu.pc
+        actual = (pc, cpu.ram[pc], cpu.ram[(pc + 1) & 0xff],
+                  cpu.ram[(pc + 2) & 0xff], cpu.fl, bytes(cpu.reg))
+        if actual != record:
+            mismatches += 1
+            print(f"instruction {n} differs", file=file)
+            print(f"  traced:   {format_record(*record)}  FL={record[4]:03b}", file=file)
+            print(f"  replayed: {format_record(*actual)}  FL={actual[4]:03b}", file=file)
+            # carry on from the traced state, to find every difference
+            cpu.pc = record[0]
+            cpu.fl = record[4]
+            cpu.reg[:] = record[5]
+        cpu.dispatch(cpu.cycles + 1)
+
+    return mismatches
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Decode or replay an LS-8 trace.")
+    parser.add_argument("trace", help="the dump written by tracer.py")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-d", "--disassemble", action="store_true",
+                       help="print each instruction as assembly too")
+    group.add_argument("--replay", action="store_true",
+                       help="rerun the program and check it against the trace")
+    parser.add_argument("--virtual-time", type=int, metavar="N",
+                        help="replay with the timer firing every N instructions")
+    parser.add_argument("--source", metavar="ASM",
+                        help="the traced program's .asm source, to show labels and line numbers")
+    args = parser.parse_args(argv[1:])
+
+    trace = Trace.read(args.trace)
+    program = assemble_file(args.source) if args.source else None
+
+    if args.replay:
+        mismatches = replay(trace, args.virtual_time)
+        print(f"{len(trace)} of {trace.total} instructions replayed, "
+              f"{mismatches} mismatches", file=sys.stderr)
+        return 1 if mismatches else 0
+
+    out = sys.stdout
+    for record in trace:
+        line = format_record(*record)
+        if args.disassemble:
+            line = f"{line}   {disassemble(*record[1:4])}"
+        if program is not None:
+            line = f"{line}   {program.location(record[0])}"
+        out.write(line + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""
+Binary execution trace.
+
+TracingCPU writes a fixed-width record for every instruction into a
+preallocated ring buffer, so only the last `size` instructions are kept and
+tracing costs a few byte stores per instruction instead of formatting text.
+The buffer is dumped to a file when the program halts or faults, when an
+exception escapes the dispatch loop, or whenever dump() is called.
+
+A record is the machine state before the instruction runs, the same state
+CPU.trace() prints:
+
+    offset  size  field
+    0       1     PC
+    1       3     the instruction bytes at PC, PC+1, PC+2
+    4       1     FL
+    5       8     R0-R7
+    13      3     padding
+
+A dump file is laid out as:
+
+    offset  size  field
+    0       4     magic, b"LS8T"
+    4       1     format version
+    5       1     record size
+    6       2     padding
+    8       8     records written in total, little-endian
+    16      4     records in this dump n, little-endian
+    20      1     initial PC
+    21      1     initial FL
+    22      8     initial registers
+    30      256   initial RAM
+    286     16*n  the last n records, oldest first
+
+With the initial state a run can be replayed from the start, see tracedump.py.
+
+Usage: tracer.py [options] program.ls8
+"""
+
+import argparse
+import struct
+import sys
+
+from cpu import *
+
+MAGIC = b"LS8T"
+VERSION = 1
+RECORD = struct.Struct("<4sB8s3x")
+# RECORD as separate fields, which is quicker to write
+PACK_RECORD = struct.Struct("<5B8s").pack_into
+HEADER = struct.Struct("<4sBB2xQIBB8s256s")
+
+# records kept by default, 16MB of buffer
+DEFAULT_SIZE = 1 << 20
+
+
+class Trace:
+    """A decoded dump: the initial machine state and the last records."""
+
+    def __init__(self, total, pc, fl, registers, ram, records):
+        self.total = total  # records written over the whole run
+        self.pc = pc
+        self.fl = fl
+        self.registers = registers
+        self.ram = ram
+        self.records = records  # bytes, len(self) records of RECORD.size
+
+    def __len__(self):
+        return len(self.records) // RECORD.size
+
+    def __iter__(self):
+        """Yield (pc, ir, operand_a, operand_b, fl, registers) per record."""
+        for instruction, fl, registers in RECORD.iter_unpack(self.records):
+            yield (*instruction, fl, registers)
+
+    @property
+    def first(self):
+        """The instruction number of the oldest record in the dump."""
+        return self.total - len(self)
+
+    @classmethod
+    def read(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+
+        (magic, version, record_size, total, count, pc, fl, registers,
+         ram) = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("not an LS-8 trace")
+        if version != VERSION or record_size != RECORD.size:
+            raise ValueError(f"unsupported trace version {version}")
+
+        records = data[HEADER.size:HEADER.size + count * RECORD.size]
+        if len(records) != count * RECORD.size:
+            raise ValueError("trace is truncated")
+        return cls(total, pc, fl, registers, ram, records)
+
+
+class TracingCPU(CPU):
+    """CPU that records every instruction into a ring buffer."""
+
+    def __init__(self, *args, size=DEFAULT_SIZE, dump_path=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if size < 1:
+            raise ValueError("trace size must be at least 1")
+        self.buffer = bytearray(size * RECORD.size)
+        self.position = 0  # byte offset of the next record
+        self.total = 0  # records written since the trace started
+        self.dump_path = dump_path
+        self.start_trace()
+
+    def start_trace(self):
+        """Start a new trace from the current machine state."""
+        self.initial = (self.pc, self.fl, bytes(self.reg), bytes(self.ram))
+        self.position = 0
+        self.total = 0
+
+    def reset(self):
+        super().reset()
+        self.start_trace()
+
+    def load_program(self, program):
+        program = super().load_program(program)
+        self.start_trace()
+        return program
+
+    def dispatch(self, stop):
+        decoded = self.decoded
+        ram = self.ram
+        reg = self.reg
+        buffer = self.buffer
+        pack_into = PACK_RECORD
+        size = len(buffer)
+        position = self.position
+        written = 0
+        cycles = self.cycles
+        reason = None
+
+        try:
+            while cycles < stop:
+                pc = self.pc
+                pack_into(buffer, position, pc, ram[pc], ram[(pc + 1) & 0xff],
+                          ram[(pc + 2) & 0xff], self.fl, reg)
+                position += 16
+                if position == size:
+                    position = 0
+                written += 1
+
+                entry = decoded[pc]
+                if entry is None:
+                    entry = self.decode(pc)
+                    if entry is None:
+                        reason = UNKNOWN_OPCODE
+                        break
+
+                handler, operand_a, operand_b, self.pc = entry
+                handler(operand_a, operand_b)
+                cycles += 1
+        except Halt as e:
+            cycles += 1
+            reason = e.reason
+        except Reschedule:
+            cycles += 1
+        except ZeroDivisionError:
+            self.pc = (self.pc - 3) & 0xff
+            reason = DIVISION_BY_ZERO
+        except BaseException:
+            self.cycles = cycles
+            self.position = position
+            self.total += written
+            self.auto_dump()
+            raise
+
+        self.cycles = cycles
+        self.position = position
+        self.total += written
+        if reason is not None:
+            self.auto_dump()
+        return reason
+
+    def auto_dump(self):
+        if self.dump_path is not None:
+            self.dump(self.dump_path)
+
+    def records(self):
+        """The records in the buffer, oldest first, as bytes."""
+        buffer = self.buffer
+        if self.total * RECORD.size < len(buffer):
+            return bytes(buffer[:self.position])
+        return bytes(buffer[self.position:] + buffer[:self.position])
+
+    def dump(self, path):
+        """Write the trace so far to path."""
+        pc, fl, registers, ram = self.initial
+        records = self.records()
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, self.total,
+                                len(records) // RECORD.size, pc, fl,
+                                registers, ram))
+            f.write(records)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run an LS-8 program, keeping a binary trace of the last instructions.")
+    parser.add_argument("program", help="the .asm, .ls8 or .ls8b file to run")
+    parser.add_argument("-o", "--output", default="trace.ls8t",
+                        help="where to dump the trace (default: trace.ls8t)")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE,
+                        help="instructions to keep (default: %(default)s)")
+    parser.add_argument("--max-cycles", type=int,
+                        help="stop after this many instructions")
+    parser.add_argument("--virtual-time", type=int, metavar="N",
+                        help="fire the timer every N instructions instead of every second")
+    args = parser.parse_args(argv[1:])
+
+    cpu = TracingCPU(size=args.size, dump_path=args.output,
+                     virtual_time=args.virtual_time)
+    cpu.load(args.program)
+    result = cpu.run(max_cycles=args.max_cycles)
+    if result.reason == BUDGET:
+        cpu.dump(args.output)
+
+    print(f"{result.reason}: {cpu.total} instructions traced to {args.output}",
+          file=sys.stderr)
+    return 0 if result.halted else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,273 @@
+"""
+Lockstep engine: N LS-8 machines held as NumPy arrays, all executing one
+instruction per step.
+
+Every lane gets its own RAM, registers, PC and FL, so lanes can start from
+different states and take different branches. Each step fetches the current
+opcode of every running lane and executes each distinct opcode once, over
+the group of lanes that are on it. Lanes drop out when they halt or fault.
+
+Interrupts and keyboard input are not modelled.
+"""
+
+from cpu import *
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, only this engine needs it
+    np = None
+
+# per-lane status codes
+RUNNING = 0
+LANE_HALTED = 1
+LANE_UNKNOWN_OPCODE = 2
+LANE_DIVISION_BY_ZERO = 3
+
+# status code -> the matching run() stop reason
+REASONS = {
+    RUNNING: BUDGET,
+    LANE_HALTED: HALTED,
+    LANE_UNKNOWN_OPCODE: UNKNOWN_OPCODE,
+    LANE_DIVISION_BY_ZERO: DIVISION_BY_ZERO,
+}
+
+# ALU operations on int64 arrays, wrapped to 8 bits by the caller
+VECTOR_ALU_OPS = {
+    ADD: lambda a, b: a + b,
+    SUB: lambda a, b: a - b,
+    MUL: lambda a, b: a * b,
+    DIV: lambda a, b: a // b,
+    MOD: lambda a, b: a % b,
+    INC: lambda a, b: a + 1,
+    DEC: lambda a, b: a - 1,
+    AND: lambda a, b: a & b,
+    NOT: lambda a, b: ~a,
+    OR: lambda a, b: a | b,
+    XOR: lambda a, b: a ^ b,
+    SHL: lambda a, b: a << b,
+    SHR: lambda a, b: a >> b,
+}
+
+# conditional jumps: FL -> whether the jump is taken
+CONDITIONS = {
+    JEQ: lambda fl: (fl & 0b001) != 0,
+    JNE: lambda fl: (fl & 0b001) == 0,
+    JGT: lambda fl: (fl & 0b010) != 0,
+    JLT: lambda fl: (fl & 0b100) != 0,
+    JGE: lambda fl: (fl & 0b011) != 0,
+    JLE: lambda fl: (fl & 0b101) != 0,
+}
+
+
+class VectorCPU:
+    """N CPUs in lockstep."""
+
+    def __init__(self, n):
+        if np is None:
+            raise RuntimeError("VectorCPU needs numpy")
+
+        self.n = n
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+        self.reg = np.zeros((n, 8), dtype=np.uint8)
+        self.reg[:, 7] = 0xf4
+        self.pc = np.zeros(n, dtype=np.uint8)
+        self.fl = np.zeros(n, dtype=np.uint8)
+        self.status = np.zeros(n, dtype=np.uint8)
+        self.cycles = np.zeros(n, dtype=np.int64)
+        # PRN/PRA output of every lane
+        self.output = [bytearray() for _ in range(n)]
+
+        self.sizes = np.array(SIZES, dtype=np.uint8)
+        self.immediate = np.zeros(256, dtype=bool)
+        self.immediate[list(IMMEDIATE)] = True
+
+        self.handlers = {
+            NOP: self.handle_nop,
+            HLT: self.handle_hlt,
+            LDI: self.handle_ldi,
+            LD: self.handle_ld,
+            ST: self.handle_st,
+            TAS: self.handle_tas,
+            PUSH: self.handle_push,
+            POP: self.handle_pop,
+            PRN: self.handle_prn,
+            PRA: self.handle_pra,
+            CMP: self.handle_cmp,
+            CALL: self.handle_call,
+            RET: self.handle_ret,
+            JMP: self.handle_jmp,
+        }
+        for op in VECTOR_ALU_OPS:
+            self.handlers[op] = self.handle_alu
+        for op in CONDITIONS:
+            self.handlers[op] = self.handle_jcc
+
+    def load(self, file):
+        """Load the same program into every lane."""
+        return self.load_program(read_program(file))
+
+    def load_program(self, program):
+        """Load a Program, e.g. from asm.assemble(), into every lane."""
+        self.load_code(program.code, program.entry)
+        return program
+
+    def load_code(self, code, entry=0):
+        """Copy machine code into RAM at address 0 in every lane."""
+        self.ram[:, :len(code)] = np.frombuffer(bytes(code), dtype=np.uint8)
+        self.pc[:] = entry
+
+    def step(self):
+        """
+        Execute one instruction in every running lane. Returns the number of
+        lanes that ran.
+        """
+        lanes = np.flatnonzero(self.status == RUNNING)
+        if len(lanes) == 0:
+            return 0
+
+        pc = self.pc[lanes]
+        ir = self.ram[lanes, pc]
+        a = self.ram[lanes, (pc + 1) & 0xff] & 0b111
+        b = self.ram[lanes, (pc + 2) & 0xff]
+        b = np.where(self.immediate[ir], b, b & 0b111)
+
+        # as in CPU.execute, the pc moves on before the instruction runs
+        self.pc[lanes] = pc + self.sizes[ir]
+        self.cycles[lanes] += 1
+
+        first = ir[0]
+        if (ir == first).all():
+            # every lane is on the same instruction
+            self.dispatch(first, lanes, a, b, pc)
+        else:
+            for op in np.unique(ir):
+                group = ir == op
+                self.dispatch(op, lanes[group], a[group], b[group], pc[group])
+
+        return len(lanes)
+
+    def dispatch(self, op, lanes, a, b, pc):
+        handler = self.handlers.get(int(op))
+        if handler is None:
+            self.status[lanes] = LANE_UNKNOWN_OPCODE
+            self.pc[lanes] = pc
+            self.cycles[lanes] -= 1
+        else:
+            handler(int(op), lanes, a, b, pc)
+
+    def run(self, max_cycles=None):
+        """
+        Step until every lane has stopped, or max_cycles steps have gone by.
+        Returns the per-lane final state, see final_state().
+        """
+        steps = 0
+        while max_cycles is None or steps < max_cycles:
+            if not self.step():
+                break
+            steps += 1
+        return self.final_state()
+
+    def final_state(self):
+        """
+        A structured array with one record per lane: status, cycles, pc, fl
+        and registers. REASONS maps status to the stop reason.
+        """
+        state = np.zeros(self.n, dtype=[
+            ("status", np.uint8),
+            ("cycles", np.int64),
+            ("pc", np.uint8),
+            ("fl", np.uint8),
+            ("registers", np.uint8, (8,)),
+        ])
+        state["status"] = self.status
+        state["cycles"] = self.cycles
+        state["pc"] = self.pc
+        state["fl"] = self.fl
+        state["registers"] = self.reg
+        return state
+
+    # Instruction handlers. Each gets the opcode, the lanes executing it, and
+    # those lanes' operands and pc.
+
+    def handle_nop(self, op, lanes, a, b, pc):
+        pass
+
+    def handle_hlt(self, op, lanes, a, b, pc):
+        # like CPU.handle_hlt, stay on the HLT
+        self.status[lanes] = LANE_HALTED
+        self.pc[lanes] = pc
+
+    def handle_ldi(self, op, lanes, a, b, pc):
+        self.reg[lanes, a] = b
+
+    def handle_ld(self, op, lanes, a, b, pc):
+        self.reg[lanes, a] = self.ram[lanes, self.reg[lanes, b]]
+
+    def handle_st(self, op, lanes, a, b, pc):
+        self.ram[lanes, self.reg[lanes, a]] = self.reg[lanes, b]
+
+    def handle_tas(self, op, lanes, a, b, pc):
+        address = self.reg[lanes, b]
+        value = self.ram[lanes, address]
+        self.ram[lanes, address] = np.where(value == 0, np.uint8(1), value)
+        self.reg[lanes, a] = value
+
+    def handle_push(self, op, lanes, a, b, pc):
+        sp = self.reg[lanes, 7] - np.uint8(1)
+        self.reg[lanes, 7] = sp
+        self.ram[lanes, sp] = self.reg[lanes, a]
+
+    def handle_pop(self, op, lanes, a, b, pc):
+        self.reg[lanes, a] = self.ram[lanes, self.reg[lanes, 7]]
+        self.reg[lanes, 7] += np.uint8(1)
+
+    def handle_prn(self, op, lanes, a, b, pc):
+        output = self.output
+        for lane, value in zip(lanes.tolist(), self.reg[lanes, a].tolist()):
+            output[lane] += PRN_TEXT[value]
+
+    def handle_pra(self, op, lanes, a, b, pc):
+        output = self.output
+        for lane, value in zip(lanes.tolist(), self.reg[lanes, a].tolist()):
+            output[lane].append(value)
+
+    def handle_alu(self, op, lanes, a, b, pc):
+        x = self.reg[lanes, a].astype(np.int64)
+        y = self.reg[lanes, b].astype(np.int64)
+
+        if op in (DIV, MOD):
+            zero = y == 0
+            if zero.any():
+                # like CPU.execute, stop on the failing instruction, which
+                # doesn't count as executed
+                self.status[lanes[zero]] = LANE_DIVISION_BY_ZERO
+                self.pc[lanes[zero]] = pc[zero]
+                self.cycles[lanes[zero]] -= 1
+                ok = ~zero
+                lanes, a, x, y = lanes[ok], a[ok], x[ok], y[ok]
+
+        self.reg[lanes, a] = VECTOR_ALU_OPS[op](x, y) & 0xff
+
+    def handle_cmp(self, op, lanes, a, b, pc):
+        x = self.reg[lanes, a]
+        y = self.reg[lanes, b]
+        self.fl[lanes] = np.where(x == y, 0b001, np.where(x > y, 0b010, 0b100))
+
+    def handle_call(self, op, lanes, a, b, pc):
+        sp = self.reg[lanes, 7] - np.uint8(1)
+        self.reg[lanes, 7] = sp
+        self.ram[lanes, sp] = self.pc[lanes]
+        self.pc[lanes] = self.reg[lanes, a]
+
+    def handle_ret(self, op, lanes, a, b, pc):
+        sp = self.reg[lanes, 7]
+        self.pc[lanes] = self.ram[lanes, sp]
+        self.reg[lanes, 7] = sp + np.uint8(1)
+
+    def handle_jmp(self, op, lanes, a, b, pc):
+        self.pc[lanes] = self.reg[lanes, a]
+
+    def handle_jcc(self, op, lanes, a, b, pc):
+        taken = CONDITIONS[op](self.fl[lanes])
+        lanes = lanes[taken]
+        self.pc[lanes] = self.reg[lanes, a[taken]]